@@ -0,0 +1,278 @@
+"""Локальная замена Space с эндпоинтом /chat, совместимая с gradio_client.
+
+Сервер реализует подмножество протокола Gradio (sse_v1), которое использует
+gradio_client: /config, /info, /upload, /queue/join, /queue/data и /reset.
+Задержка, потоковая генерация и доля ошибок настраиваются. Запуск:
+
+    python benchmarks/fake_gradio.py --port 7860 --latency 0.5 --chunks 10 --error-rate 0.05
+
+После этого приложение можно направить на него: GRADIO_SRC=http://127.0.0.1:7860/
+"""
+import argparse
+import json
+import os
+import queue
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+CHAT_PARAMETERS = ["message", "param_2", "param_3", "param_4", "param_5", "param_6"]
+
+CONFIG = {
+    "version": "4.44.0",
+    "protocol": "sse_v1",
+    "api_prefix": "",
+    "connect_heartbeat": False,
+    "max_file_size": None,
+    "dependencies": [
+        {
+            "id": 0,
+            "api_name": "chat",
+            "inputs": [1, 2, 3, 4, 5, 6],
+            "outputs": [7],
+            "backend_fn": True,
+            "show_api": True,
+        }
+    ],
+    "components": [
+        {"id": 1, "type": "multimodaltextbox", "props": {"label": "message"}},
+        {"id": 2, "type": "textbox", "props": {"label": "param_2"}},
+        {"id": 3, "type": "slider", "props": {"label": "param_3"}},
+        {"id": 4, "type": "slider", "props": {"label": "param_4"}},
+        {"id": 5, "type": "slider", "props": {"label": "param_5"}},
+        {"id": 6, "type": "slider", "props": {"label": "param_6"}},
+        {"id": 7, "type": "chatbot", "props": {"label": "response"}},
+    ],
+}
+
+API_INFO = {
+    "named_endpoints": {
+        "/chat": {
+            "parameters": [
+                {"parameter_name": name, "parameter_has_default": False, "label": name, "type": {}, "component": ""}
+                for name in CHAT_PARAMETERS
+            ],
+            "returns": [{"label": "response", "type": {}, "component": "Chatbot"}],
+        }
+    },
+    "unnamed_endpoints": {},
+}
+
+
+class FakeGradioState:
+    """Настройки и состояние фейкового Space"""
+
+    def __init__(self, latency=0.5, jitter=0.0, chunks=1, chunk_delay=0.05, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunks = max(1, chunks)
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.upload_dir = tempfile.mkdtemp(prefix="fake_gradio_")
+        self.sessions = {}
+        self.cancelled = set()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.uploads = 0
+        self.upload_bytes = 0
+        self.last_files = []
+
+    def session_queue(self, session_hash):
+        with self.lock:
+            return self.sessions.setdefault(session_hash, queue.Queue())
+
+    @staticmethod
+    def local_path(path):
+        """Путь к файлу сообщения; ссылку на /file= настоящий Space тоже разрешает в свою копию"""
+        url = urlparse(path)
+        if url.scheme in ("http", "https") and url.path.startswith("/file="):
+            return unquote(url.path[len("/file="):])
+        return path
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def delay(self):
+        with self.lock:
+            return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def run_event(self, event_id, session_hash, data):
+        """Имитирует очередь и генерацию ответа, отправляя сообщения в поток сессии"""
+        messages = self.session_queue(session_hash)
+        with self.lock:
+            self.requests += 1
+        message = data[0] if data and isinstance(data[0], dict) else {}
+        prompt = message.get("text", "")
+        files = message.get("files", [])
+        with self.lock:
+            self.last_files = files
+        answer = f"Фейковый ответ на «{prompt}» для {len(files)} файл(ов)."
+        words = answer.split(" ")
+
+        messages.put({"msg": "estimation", "event_id": event_id, "rank": 0, "queue_size": 1, "rank_eta": 0})
+        messages.put({"msg": "process_starts", "event_id": event_id})
+        time.sleep(self.delay())
+
+        if self.should_fail():
+            messages.put({"msg": "process_completed", "event_id": event_id, "success": False,
+                          "output": {"error": "Fake upstream error"}})
+            return
+
+        # Как настоящий Space: ссылка на удаленный из кэша файл приводит к ошибке
+        if any(isinstance(f, dict) and not os.path.isfile(self.local_path(f.get("path", ""))) for f in files):
+            messages.put({"msg": "process_completed", "event_id": event_id, "success": False,
+                          "output": {"error": "File not found"}})
+            return
+
+        if self.chunks > 1:
+            step = max(1, -(-len(words) // self.chunks))
+            for end in range(step, len(words), step):
+                if event_id in self.cancelled:
+                    break
+                messages.put({"msg": "process_generating", "event_id": event_id, "success": True,
+                              "output": {"data": [" ".join(words[:end])]}})
+                time.sleep(self.chunk_delay)
+
+        messages.put({"msg": "process_completed", "event_id": event_id, "success": True,
+                      "output": {"data": [answer]}})
+
+
+class FakeGradioHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None  # задается в make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/config":
+            self.send_json(CONFIG)
+        elif url.path == "/info":
+            self.send_json(API_INFO)
+        elif url.path == "/queue/data":
+            session_hash = parse_qs(url.query).get("session_hash", [""])[0]
+            self.stream_session(session_hash)
+        else:
+            self.send_json({"detail": "Not Found"}, status=404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == "/upload":
+            self.handle_upload()
+        elif url.path == "/queue/join":
+            payload = json.loads(self.read_body() or b"{}")
+            event_id = uuid.uuid4().hex
+            threading.Thread(
+                target=self.state.run_event,
+                args=(event_id, payload.get("session_hash", ""), payload.get("data", [])),
+                daemon=True,
+            ).start()
+            self.send_json({"event_id": event_id})
+        elif url.path == "/reset":
+            payload = json.loads(self.read_body() or b"{}")
+            with self.state.lock:
+                self.state.cancelled.add(payload.get("event_id"))
+            self.send_json({"success": True})
+        else:
+            self.send_json({"detail": "Not Found"}, status=404)
+
+    def handle_upload(self):
+        body = self.read_body()
+        match = re.search(r"boundary=([^;]+)", self.headers.get("Content-Type", ""))
+        paths = []
+        if match:
+            boundary = b"--" + match.group(1).strip('"').encode()
+            for part in body.split(boundary)[1:-1]:
+                headers, _, content = part.partition(b"\r\n\r\n")
+                filename = re.search(rb'filename="([^"]*)"', headers)
+                if not filename:
+                    continue
+                name = os.path.basename(filename.group(1).decode("utf-8", "replace")) or "file"
+                path = os.path.join(self.state.upload_dir, f"{uuid.uuid4().hex}_{name}")
+                with open(path, "wb") as f:
+                    f.write(content[:-2])  # без завершающего \r\n
+                paths.append(path)
+                with self.state.lock:
+                    self.state.uploads += 1
+                    self.state.upload_bytes += len(content) - 2
+        self.send_json(paths)
+
+    def stream_session(self, session_hash):
+        messages = self.state.session_queue(session_hash)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            while True:
+                try:
+                    message = messages.get(timeout=1)
+                except queue.Empty:
+                    message = {"msg": "heartbeat"}
+                self.wfile.write(f"data: {json.dumps(message, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент закрывает поток, когда получил ответы на все свои события
+            pass
+
+
+def make_server(host="127.0.0.1", port=0, **options):
+    """Создает сервер; порт 0 означает любой свободный порт"""
+    handler = type("BoundFakeGradioHandler", (FakeGradioHandler,), {"state": FakeGradioState(**options)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_thread(**options):
+    """Запускает сервер в фоновом потоке и возвращает (server, url)"""
+    server = make_server(**options)
+    threading.Thread(target=server.serve_forever, name="fake-gradio", daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}/"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument("--latency", type=float, default=0.5, help="задержка до начала ответа, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="разброс задержки, ± с")
+    parser.add_argument("--chunks", type=int, default=1, help="число фрагментов потокового ответа")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="пауза между фрагментами, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля запросов, завершающихся ошибкой")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, latency=args.latency, jitter=args.jitter, chunks=args.chunks,
+                         chunk_delay=args.chunk_delay, error_rate=args.error_rate, seed=args.seed)
+    print(f"Фейковый Space запущен: http://{args.host}:{server.server_address[1]}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
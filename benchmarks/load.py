@@ -0,0 +1,305 @@
+"""Нагрузочный бенчмарк приложения против локальной замены Space.
+
+Запускает фейковый Space (benchmarks/fake_gradio.py) и приложение в отдельном
+процессе, затем прогоняет сценарии с заданной конкурентностью и печатает
+пропускную способность, p50/p95/p99 задержки и пиковую память процесса
+приложения. Сеть не нужна. Запуск:
+
+    python benchmarks/load.py --json bench.json
+    python benchmarks/load.py --scenarios form:1 form:16 batch:4 jobs:8 --requests 200
+    python benchmarks/load.py --compare bench.json
+    python benchmarks/load.py --asgi --scenarios form:256
+
+Сценарий задается как маршрут:конкурентность. Маршруты: form (POST /),
+stream (POST /analyze_stream), batch (POST /analyze_batch, --batch-size
+изображений в запросе), jobs (POST /jobs и опрос GET /jobs/<id>).
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fake_gradio  # noqa: E402
+
+DEFAULT_SCENARIOS = ["form:1", "form:8", "form:32", "stream:8", "batch:4", "jobs:8"]
+
+SERVE_SNIPPET = """
+import logging, sys
+logging.getLogger("werkzeug").setLevel(logging.ERROR)
+import main
+main.app.run(host="127.0.0.1", port=int(sys.argv[1]), debug=False, threaded=True)
+"""
+
+ASGI_SERVE_SNIPPET = """
+import sys
+import uvicorn
+import main
+uvicorn.run(main.asgi_app, host="127.0.0.1", port=int(sys.argv[1]), log_level="error")
+"""
+
+
+def png_chunk(kind, data):
+    return (len(data).to_bytes(4, "big") + kind + data
+            + zlib.crc32(kind + data).to_bytes(4, "big"))
+
+
+def make_png(width=64, height=64):
+    """Небольшой валидный PNG без сторонних библиотек"""
+    row = b"\x00" + b"".join(bytes((x * 4 % 256, 128, 200)) for x in range(width))
+    raw = row * height
+    header = width.to_bytes(4, "big") + height.to_bytes(4, "big") + b"\x08\x02\x00\x00\x00"
+    return (b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", header)
+            + png_chunk(b"IDAT", zlib.compress(raw)) + png_chunk(b"IEND", b""))
+
+
+BASE_IMAGE = make_png()
+
+
+def unique_image():
+    # Данные после IEND декодеры игнорируют, но хэш изображения становится уникальным,
+    # поэтому кэш и объединение запросов не искажают замер (поиск похожих отключен в start_app)
+    return BASE_IMAGE + uuid.uuid4().bytes
+
+
+def encode_multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, content in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: image/png\r\n\r\n'.encode() + content + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def post(url, fields, files, timeout):
+    body, content_type = encode_multipart(fields, files)
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": content_type}, method="POST")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status, response.read()
+
+
+def run_form(base_url, timeout, **_):
+    status, body = post(base_url, [("prompt", "Что на картинке?")], [("image", "image.png", unique_image())], timeout)
+    return status == 200 and "Результат анализа".encode() in body
+
+
+def run_stream(base_url, timeout, **_):
+    status, body = post(base_url + "analyze_stream", [("prompt", "Что на картинке?")],
+                        [("image", "image.png", unique_image())], timeout)
+    return status == 200 and b"event: done" in body
+
+
+def run_batch(base_url, timeout, batch_size=8, **_):
+    files = [("images", f"image{i}.png", unique_image()) for i in range(batch_size)]
+    status, body = post(base_url + "analyze_batch", [("prompt", "Что на картинке?")], files, timeout)
+    return status == 200 and json.loads(body)["success"]
+
+
+def run_jobs(base_url, timeout, **_):
+    status, body = post(base_url + "jobs", [("prompt", "Что на картинке?")],
+                        [("image", "image.png", unique_image())], timeout)
+    if status != 202:
+        return False
+    job_url = base_url + "jobs/" + json.loads(body)["job_id"]
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with urllib.request.urlopen(job_url, timeout=timeout) as response:
+            job = json.loads(response.read())
+        if job["status"] in ("done", "failed"):
+            return job["status"] == "done"
+        time.sleep(0.02)
+    return False
+
+
+ROUTES = {"form": run_form, "stream": run_stream, "batch": run_batch, "jobs": run_jobs}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def read_rss(pid):
+    """Текущий RSS процесса в байтах (Linux)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def start_app(gradio_url, extra_env, asgi=False):
+    port = free_port()
+    # История отключена: замер не должен писать базу в каталог приложения и зависеть от диска
+    env = dict(os.environ, GRADIO_SRC=gradio_url, TOKEN_HUGGI=os.environ.get("TOKEN_HUGGI", "bench"),
+               HF_HUB_DISABLE_TELEMETRY="1", RESULT_CACHE_SIZE="0", NEAR_DUP_SIZE="0", TENANT_RATE="0",
+               HISTORY_DB="", **extra_env)
+    snippet = ASGI_SERVE_SNIPPET if asgi else SERVE_SNIPPET
+    process = subprocess.Popen([sys.executable, "-c", snippet, str(port)], cwd=ROOT_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}/"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(base_url, timeout=1):
+                return process, base_url
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.02)
+    process.terminate()
+    raise RuntimeError("Приложение не запустилось")
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_scenario(base_url, pid, route, concurrency, requests, timeout, batch_size):
+    fn = ROUTES[route]
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    peak_rss = read_rss(pid)
+    stop = threading.Event()
+
+    def sample_memory():
+        nonlocal peak_rss
+        while not stop.wait(0.05):
+            peak_rss = max(peak_rss, read_rss(pid))
+
+    def one(_):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            ok = fn(base_url, timeout, batch_size=batch_size)
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors += 1
+
+    sampler = threading.Thread(target=sample_memory, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    wall = time.perf_counter() - started
+    stop.set()
+    sampler.join()
+
+    items = requests * (batch_size if route == "batch" else 1)
+    return {
+        "scenario": f"{route}:{concurrency}",
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": requests / wall if wall else 0.0,
+        "images_per_second": items / wall if wall else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "peak_rss_mb": peak_rss / (1024 * 1024),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_report(results, baseline=None):
+    baseline = {item["scenario"]: item for item in (baseline or {}).get("results", [])}
+    print(f"{'сценарий':<12} {'запр/с':>9} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'ошибки':>7} {'RSS, МБ':>8}")
+    for item in results:
+        line = (f"{item['scenario']:<12} {item['throughput_rps']:>9.1f} {item['p50_ms']:>9.1f} "
+                f"{item['p95_ms']:>9.1f} {item['p99_ms']:>9.1f} {item['errors']:>7} {item['peak_rss_mb']:>8.1f}")
+        old = baseline.get(item["scenario"])
+        if old:
+            change = (item["throughput_rps"] / old["throughput_rps"] - 1) * 100 if old["throughput_rps"] else 0.0
+            p99_change = (item["p99_ms"] / old["p99_ms"] - 1) * 100 if old["p99_ms"] else 0.0
+            line += f"   запр/с {change:+.1f}%, p99 {p99_change:+.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", default=DEFAULT_SCENARIOS, help="маршрут:конкурентность")
+    parser.add_argument("--requests", type=int, default=100, help="число запросов в сценарии")
+    parser.add_argument("--batch-size", type=int, default=8, help="изображений в одном пакетном запросе")
+    parser.add_argument("--timeout", type=float, default=120.0, help="таймаут одного запроса, с")
+    parser.add_argument("--latency", type=float, default=0.2, help="задержка фейкового Space, с")
+    parser.add_argument("--jitter", type=float, default=0.05, help="разброс задержки фейкового Space, ± с")
+    parser.add_argument("--chunks", type=int, default=5, help="фрагментов потокового ответа")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ошибок фейкового Space")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", nargs="*", default=[], help="переменные окружения приложения KEY=VALUE")
+    parser.add_argument("--asgi", action="store_true", help="запустить приложение через uvicorn (режим ASGI)")
+    parser.add_argument("--json", help="сохранить результат в JSON-файл")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для сравнения")
+    args = parser.parse_args()
+
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    server, gradio_url = fake_gradio.start_in_thread(latency=args.latency, jitter=args.jitter, chunks=args.chunks,
+                                                     error_rate=args.error_rate, seed=args.seed)
+    process, base_url = start_app(gradio_url, extra_env, asgi=args.asgi)
+    results = []
+    try:
+        for scenario in args.scenarios:
+            route, _, concurrency = scenario.partition(":")
+            if route not in ROUTES:
+                parser.error(f"неизвестный маршрут: {route}")
+            results.append(run_scenario(base_url, process.pid, route, int(concurrency or 1), args.requests,
+                                        args.timeout, args.batch_size))
+    finally:
+        process.terminate()
+        process.wait()
+        server.shutdown()
+
+    report = {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "settings": {key: value for key, value in vars(args).items() if key not in ("json", "compare")},
+        "results": results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"Сравнение с {baseline.get('revision', '?')} -> {report['revision']}")
+    print_report(results, baseline)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
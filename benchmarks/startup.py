@@ -0,0 +1,120 @@
+"""Бенчмарк холодного старта: время импорта main и время до первого обслуженного запроса.
+
+Каждый замер выполняется в новом процессе Python, чтобы учитывать полный
+холодный импорт. Запуск:
+
+    python benchmarks/startup.py --runs 10
+    python benchmarks/startup.py --runs 10 --json startup.json
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = """
+import sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+heavy = [name for name in ("gradio_client", "pytest", "unittest.mock", "PIL", "numpy") if name in sys.modules]
+print(elapsed)
+print(",".join(heavy))
+"""
+
+SERVE_SNIPPET = """
+import logging, sys
+logging.getLogger("werkzeug").setLevel(logging.ERROR)
+import main
+main.app.run(host="127.0.0.1", port=int(sys.argv[1]), debug=False)
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_import():
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        cwd=ROOT_DIR, capture_output=True, text=True, check=True,
+    ).stdout.splitlines()
+    heavy = output[1].split(",") if len(output) > 1 and output[1] else []
+    return float(output[0]), heavy
+
+
+def measure_first_request(timeout=30.0):
+    """Время от запуска процесса до первого ответа 200 на GET /"""
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-c", SERVE_SNIPPET, str(port)],
+        cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.005)
+        raise RuntimeError("Сервер не ответил за отведенное время")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def summarize(values):
+    return {
+        "min": min(values),
+        "median": statistics.median(values),
+        "max": max(values),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="число замеров каждого вида")
+    parser.add_argument("--json", help="сохранить результат в JSON-файл")
+    args = parser.parse_args()
+
+    import_times = []
+    heavy_modules = set()
+    for _ in range(args.runs):
+        elapsed, heavy = measure_import()
+        import_times.append(elapsed)
+        heavy_modules.update(heavy)
+
+    first_request_times = [measure_first_request() for _ in range(args.runs)]
+
+    report = {
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "import_seconds": summarize(import_times),
+        "first_request_seconds": summarize(first_request_times),
+        "heavy_modules_loaded": sorted(heavy_modules),
+    }
+
+    print(f"Импорт main:             медиана {report['import_seconds']['median'] * 1000:.1f} мс "
+          f"(мин {report['import_seconds']['min'] * 1000:.1f}, макс {report['import_seconds']['max'] * 1000:.1f})")
+    print(f"До первого запроса:      медиана {report['first_request_seconds']['median'] * 1000:.1f} мс "
+          f"(мин {report['first_request_seconds']['min'] * 1000:.1f}, макс {report['first_request_seconds']['max'] * 1000:.1f})")
+    print(f"Тяжелые модули при старте: {', '.join(report['heavy_modules_loaded']) or 'нет'}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,29 @@
-from flask import Flask, render_template_string, request, jsonify, redirect, url_for, flash
-from gradio_client import Client, file, handle_file
+from flask import (Flask, Request, render_template, request, jsonify, redirect, url_for, flash, g, session, Response,
+                   stream_with_context)
 import warnings
+import asyncio
 import os
 import sys
-import pytest
+import json
+import time
+import hashlib
+import gzip
+import functools
+import threading
+import bisect
+import heapq
+import contextvars
+import contextlib
+import uuid
+import shutil
+import subprocess
+import random
+import struct
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait, FIRST_COMPLETED
 import tempfile
-from unittest.mock import Mock, patch, mock_open
+from werkzeug.exceptions import ClientDisconnected, HTTPException, RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 
@@ -20,53 +38,3896 @@ app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Space с моделью или URL Gradio-приложения (например, локальной замены для бенчмарков)
+GRADIO_SRC = os.environ.get('GRADIO_SRC', "amd/llama4-maverick-17b-128e-mi-amd")
+
 # Разрешенные расширения файлов
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+
+# Сколько изображений можно отправить с одним промптом
+MAX_IMAGES_PER_REQUEST = int(os.environ.get('MAX_IMAGES_PER_REQUEST', 8))
+
+
+# =================== МЕТРИКИ ===================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(2 ** power for power in range(10, 25))  # 1 КБ .. 16 МБ
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for key, value in labels)
+    return '{' + pairs + '}'
+
+
+class Counter:
+    """Счетчик Prometheus с необязательной одной меткой"""
+
+    def __init__(self, name, documentation, label=None):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value=None, amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def value(self, label_value=None):
+        return self._values.get(label_value, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_value, value in sorted(self._values.items(), key=lambda item: str(item[0])):
+                labels = [(self.label, label_value)] if self.label else []
+                lines.append(f'{self.name}{format_labels(labels)} {value}')
+        return lines
+
+
+class Gauge:
+    """Мгновенное значение Prometheus"""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    @contextlib.contextmanager
+    def track(self):
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+    def render(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge', f'{self.name} {self.value}']
+
+
+class Histogram:
+    """Гистограмма Prometheus с фиксированными границами корзин"""
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextlib.contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            cumulative = 0
+            for bound, count in zip(self.buckets, self._counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+            lines.append(f'{self.name}_sum {self.sum}')
+            lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+
+class Metrics:
+    """Метрики пути распознавания"""
 
+    def __init__(self):
+        self.upload_receive = Histogram('paligemma_upload_receive_seconds', 'Время приема и разбора multipart-запроса')
+        self.file_save = Histogram('paligemma_file_save_seconds', 'Время сохранения загрузки в спул')
+        self.predict = Histogram('paligemma_predict_seconds', 'Время вызова модели (client.predict)')
+        self.render = Histogram('paligemma_render_seconds', 'Время рендеринга HTML-шаблона')
+        self.upload_size = Histogram('paligemma_upload_bytes', 'Размер загруженных изображений', SIZE_BUCKETS)
+        self.upload_rejections = Counter('paligemma_upload_rejections_total',
+                                         'Загрузки, отклоненные при приеме, по причине', 'reason')
+        self.analyses = Counter('paligemma_analyses_total', 'Вызовы модели по результату', 'result')
+        self.errors = Counter('paligemma_errors_total', 'Ошибки вызова модели по типу исключения', 'type')
+        self.upstream_attempts = Counter('paligemma_upstream_attempts_total',
+                                         'Попытки вызова модели: первая, повтор или хедж', 'kind')
+        self.hedge_wins = Counter('paligemma_hedge_wins_total', 'Ответы, которые первым вернул хедж-запрос')
+        self.requests_in_flight = Gauge('paligemma_requests_in_flight', 'Запросы, обрабатываемые сейчас')
+        self.upstream_in_flight = Gauge('paligemma_upstream_in_flight', 'Вызовы модели, выполняемые сейчас')
 
-def get_client():
+    def __iter__(self):
+        return iter(vars(self).values())
+
+
+metrics = Metrics()
+
+
+def render_stats(prefix, stats, counters=()):
+    """Превращает словарь статистики подсистемы в метрики Prometheus"""
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        name = f'{prefix}_{key}'
+        lines.append(f'# TYPE {name} {"counter" if key in counters else "gauge"}')
+        lines.append(f'{name} {value}')
+    return lines
+
+
+def render_labeled_stats(prefix, label, stats_by_value, counters=()):
+    """Как render_stats, но для нескольких экземпляров подсистемы с меткой label"""
+    lines = []
+    keys = []
+    for stats in stats_by_value.values():
+        keys.extend(key for key, value in stats.items()
+                    if key not in keys and not isinstance(value, bool) and isinstance(value, (int, float)))
+    for key in keys:
+        name = f'{prefix}_{key}'
+        lines.append(f'# TYPE {name} {"counter" if key in counters else "gauge"}')
+        for label_value, stats in stats_by_value.items():
+            if key in stats:
+                lines.append(f'{name}{format_labels([(label, label_value)])} {stats[key]}')
+    return lines
+
+
+def get_token():
     # Загружаем токен из переменной окружения
     haggi_token = os.environ.get("TOKEN_HUGGI")
     if not haggi_token:
         raise ValueError("Токен не найден. Убедитесь, что переменная окружения TOKEN_HUGGI установлена.")
+    return haggi_token
+
+
+def get_client(src=None):
+    get_token()
+
+    # gradio_client импортируется при первом обращении к Space, а не при старте процесса
+    from gradio_client import Client
 
     # Инициализация клиента
-    return Client("amd/llama4-maverick-17b-128e-mi-amd")
+    return Client(src or GRADIO_SRC)
+
+
+def handle_file(image_path):
+    from gradio_client import handle_file as gradio_handle_file
+    return gradio_handle_file(image_path)
+
+
+# =================== ТРАССИРОВКА ===================
+
+# Доля запросов, трасса которых выводится в журнал и коллектор
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))
+# Трассы запросов дольше порога (в секундах) выводятся независимо от выборки; 0 отключает
+TRACE_SLOW_THRESHOLD = float(os.environ.get('TRACE_SLOW_THRESHOLD', 0))
+TRACE_LOG = os.environ.get('TRACE_LOG', '1') == '1'
+# OTLP/HTTP-приемник локального коллектора (JSON), например http://localhost:4318/v1/traces
+TRACE_EXPORT_URL = os.environ.get('TRACE_EXPORT_URL', '')
+TRACE_EXPORT_BATCH = int(os.environ.get('TRACE_EXPORT_BATCH', 64))
+TRACE_EXPORT_INTERVAL = float(os.environ.get('TRACE_EXPORT_INTERVAL', 2))
+TRACE_EXPORT_QUEUE_MAX = int(os.environ.get('TRACE_EXPORT_QUEUE_MAX', 1000))
+TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'paligemma-web')
+
+# (трасса, id текущего спана) запроса, который обслуживается в этом контексте
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def new_span_id():
+    return uuid.uuid4().hex[:16]
+
+
+def parse_traceparent(header):
+    """(trace_id, parent_id, sampled) из заголовка W3C traceparent или None"""
+    parts = (header or '').strip().lower().split('-')
+    if len(parts) < 4 or parts[0] == 'ff' or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    try:
+        trace_id, parent_id, flags = int(parts[1], 16), int(parts[2], 16), int(parts[3], 16)
+    except ValueError:
+        return None
+    if not trace_id or not parent_id:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+class Trace:
+    """Трасса одного запроса: корневой спан и завершенные дочерние спаны"""
+
+    def __init__(self, name, trace_id=None, parent_id=None, sampled=False, recording=True):
+        self.name = name
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        # Невыводимые трассы только несут идентификатор, спаны для них не собираются
+        self.recording = recording
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.attributes = {}
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, span_id, parent_id, start, duration, attributes=None, error=None):
+        with self._lock:
+            # Спаны, завершившиеся после ответа (например, проигравший хедж), в трассу уже не попадают
+            if self.recording and self.duration is None:
+                self.spans.append({"name": name, "span_id": span_id, "parent_id": parent_id, "start": start,
+                                   "duration": duration, "attributes": dict(attributes or {}), "error": error})
+
+    def finish(self):
+        with self._lock:
+            self.duration = time.perf_counter() - self._started
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_dict(self):
+        """Запись для журнала: смещения и длительности спанов в миллисекундах от начала запроса"""
+        spans = sorted(self.spans, key=lambda item: item["start"])
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round(self.duration * 1000, 3),
+            "error": self.error,
+            "attributes": self.attributes,
+            "spans": [
+                {
+                    "name": item["name"],
+                    "span_id": item["span_id"],
+                    "parent_id": item["parent_id"],
+                    "offset_ms": round((item["start"] - self.start) * 1000, 3),
+                    "duration_ms": round(item["duration"] * 1000, 3),
+                    "attributes": item["attributes"],
+                    "error": item["error"],
+                }
+                for item in spans
+            ],
+        }
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_span(trace_id, span_id, parent_id, name, start, duration, attributes, error, kind):
+    span = {
+        "traceId": trace_id,
+        "spanId": span_id,
+        "name": name,
+        "kind": kind,
+        "startTimeUnixNano": str(int(start * 1e9)),
+        "endTimeUnixNano": str(int((start + duration) * 1e9)),
+        "attributes": [{"key": key, "value": otlp_value(value)} for key, value in attributes.items()],
+    }
+    if parent_id:
+        span["parentSpanId"] = parent_id
+    if error:
+        span["status"] = {"code": 2, "message": error}
+    return span
+
+
+def otlp_payload(traces, service_name):
+    """Тело запроса OTLP/HTTP JSON: корневой спан запроса (SERVER) и его этапы (INTERNAL)"""
+    spans = []
+    for trace in traces:
+        spans.append(otlp_span(trace.trace_id, trace.span_id, trace.parent_id, trace.name, trace.start,
+                               trace.duration, trace.attributes, trace.error, 2))
+        spans.extend(otlp_span(trace.trace_id, item["span_id"], item["parent_id"], item["name"], item["start"],
+                               item["duration"], item["attributes"], item["error"], 1) for item in trace.spans)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+        "scopeSpans": [{"scope": {"name": "main"}, "spans": spans}],
+    }]}
+
+
+class OtlpExporter:
+    """Отправка трасс в локальный коллектор по OTLP/HTTP пачками из фонового потока.
+
+    Если коллектор недоступен или не успевает, трассы отбрасываются: запросы
+    пользователей от экспорта не зависят.
+    """
+
+    def __init__(self, url, batch_size=64, interval=2.0, max_pending=1000, service_name='paligemma-web', timeout=5):
+        self.url = url
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.max_pending = max_pending
+        self.service_name = service_name
+        self.timeout = timeout
+        self._pending = deque()
+        self._sending = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self.exported = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def submit(self, trace):
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending.append(trace)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, name='trace-exporter', daemon=True)
+                self._thread.start()
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                if len(self._pending) < self.batch_size:
+                    self._cond.wait(self.interval)
+                batch = [self._pending.popleft() for _ in range(min(len(self._pending), self.batch_size))]
+                self._sending = len(batch)
+            if batch:
+                self._send(batch)
+            with self._cond:
+                self._sending = 0
+                self._cond.notify_all()
+
+    def _send(self, batch):
+        import urllib.request
+
+        body = json.dumps(otlp_payload(batch, self.service_name)).encode('utf-8')
+        request_ = urllib.request.Request(self.url, data=body, method='POST',
+                                          headers={'Content-Type': 'application/json'})
+        try:
+            urllib.request.urlopen(request_, timeout=self.timeout).close()
+        except Exception:
+            with self._cond:
+                self.errors += 1
+                self.dropped += len(batch)
+            return
+        with self._cond:
+            self.exported += len(batch)
+
+    def flush(self, timeout=10):
+        """Ждет отправки всех накопленных трасс; False по таймауту"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._pending or self._sending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._cond:
+            return {"pending": len(self._pending) + self._sending, "exported": self.exported,
+                    "dropped": self.dropped, "errors": self.errors}
+
+
+class Tracer:
+    """Начинает трассы запросов и выводит завершенные.
+
+    Идентификатор трассы есть у каждого запроса. Спаны собираются, только если
+    трассу есть кому вывести: запрос попал в выборку (или выборку включил вызывающий
+    через traceparent), либо включен порог медленных запросов — тогда спаны
+    собираются всегда, а выводятся только трассы из выборки и медленные.
+    """
+
+    def __init__(self, sample_rate=0.01, slow_threshold=0, log=True, exporter=None):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.log = log
+        self.exporter = exporter
+        self._lock = threading.Lock()
+        self.started = 0
+        self.sampled = 0
+        self.slow = 0
+        self.emitted = 0
+
+    def start(self, name, headers):
+        parent = parse_traceparent(headers.get('traceparent'))
+        if parent:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id = headers.get('X-Trace-Id', '').strip().lower()
+            if len(trace_id) != 32 or trace_id.strip('0123456789abcdef') or not trace_id.strip('0'):
+                trace_id = None
+            parent_id = None
+            sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        has_output = self.log or self.exporter is not None
+        recording = has_output and (sampled or self.slow_threshold > 0)
+        with self._lock:
+            self.started += 1
+            self.sampled += sampled
+        return Trace(name, trace_id, parent_id, sampled, recording)
+
+    def finish(self, trace):
+        trace.finish()
+        slow = self.slow_threshold > 0 and trace.duration >= self.slow_threshold
+        if not trace.recording or not (trace.sampled or slow):
+            return
+        with self._lock:
+            self.slow += slow
+            self.emitted += 1
+        if self.log:
+            print(json.dumps(trace.to_dict(), ensure_ascii=False), flush=True)
+        if self.exporter is not None:
+            self.exporter.submit(trace)
+
+    def stats(self):
+        with self._lock:
+            stats = {"sample_rate": self.sample_rate, "started": self.started, "sampled": self.sampled,
+                     "slow": self.slow, "emitted": self.emitted}
+        if self.exporter is not None:
+            stats.update({f"export_{key}": value for key, value in self.exporter.stats().items()})
+        return stats
+
+
+tracer = Tracer(
+    TRACE_SAMPLE_RATE, TRACE_SLOW_THRESHOLD, TRACE_LOG,
+    OtlpExporter(TRACE_EXPORT_URL, TRACE_EXPORT_BATCH, TRACE_EXPORT_INTERVAL, TRACE_EXPORT_QUEUE_MAX,
+                 TRACE_SERVICE_NAME) if TRACE_EXPORT_URL else None,
+)
+
+
+def tracing():
+    """Собираются ли спаны для текущего запроса"""
+    parent = current_span.get()
+    return parent is not None and parent[0].recording
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Замер этапа как дочернего спана текущего; возвращает словарь атрибутов спана.
+
+    Без трассы или для невыводимой трассы ничего не замеряет.
+    """
+    parent = current_span.get()
+    if parent is None or not parent[0].recording:
+        yield attributes
+        return
+    trace, parent_id = parent
+    span_id = new_span_id()
+    token = current_span.set((trace, span_id))
+    start = time.time()
+    started = time.perf_counter()
+    error = None
+    try:
+        yield attributes
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        try:
+            current_span.reset(token)
+        except ValueError:
+            # Генератор со спаном продолжили в другом контексте
+            current_span.set(parent)
+        trace.add(name, span_id, parent_id, start, time.perf_counter() - started, attributes, error)
+
+
+def record_span(name, start, end, **attributes):
+    """Спан с уже известными границами (время Unix), например этап на стороне Space"""
+    parent = current_span.get()
+    if parent is not None and end >= start:
+        trace, parent_id = parent
+        trace.add(name, new_span_id(), parent_id, start, end - start, attributes)
+
+
+def record_space_phases(job, submitted):
+    """Спаны этапов вызова на стороне Space по статусам задачи gradio_client.
+
+    space.upload — от отправки до первого сообщения очереди (загрузка файлов
+    и постановка в очередь), space.queue — ожидание в очереди Space,
+    space.generate — генерация ответа. Время статуса — момент его обработки
+    клиентом, который читает сообщения раз в 50 мс.
+    """
+    updates = getattr(getattr(job, 'communicator', None), 'updates', None)
+    # Статусы с отметками времени копятся в очереди задачи, пока их никто не читает
+    if not tracing() or not isinstance(updates, asyncio.Queue):
+        return
+    times = {}
+    while not updates.empty():
+        update = updates.get_nowait()
+        code = getattr(getattr(update, 'code', None), 'value', None)
+        when = getattr(update, 'time', None)
+        if code and when is not None:
+            times.setdefault(code, when.timestamp())
+    queued = times.get('JOINING_QUEUE', times.get('IN_QUEUE'))
+    processing = times.get('PROCESSING')
+    finished = times.get('FINISHED', time.time())
+    first = min((t for t in (queued, processing) if t is not None), default=None)
+    if first is not None:
+        record_span('space.upload', submitted, first)
+    if queued is not None and processing is not None:
+        record_span('space.queue', queued, processing)
+    if processing is not None:
+        record_span('space.generate', processing, finished)
+
+
+@app.before_request
+def start_trace():
+    rule = request.url_rule.rule if request.url_rule is not None else request.path
+    trace = tracer.start(f'{request.method} {rule}', request.headers)
+    trace.attributes.update({"http.method": request.method, "http.route": rule})
+    g.trace = trace
+    g.trace_token = current_span.set((trace, trace.span_id))
+
+
+@app.after_request
+def add_trace_headers(response):
+    trace = g.get('trace')
+    if trace is not None:
+        trace.attributes["http.status_code"] = response.status_code
+        response.headers['X-Trace-Id'] = trace.trace_id
+        response.headers['traceparent'] = trace.traceparent()
+    return response
+
+
+@app.teardown_request
+def finish_trace(exc=None):
+    trace = g.pop('trace', None)
+    if trace is None:
+        return
+    try:
+        current_span.reset(g.pop('trace_token'))
+    except ValueError:
+        current_span.set(None)
+    if exc is not None:
+        trace.error = type(exc).__name__
+        trace.attributes.setdefault("http.status_code", 500)
+    tracer.finish(trace)
+
+
+# =================== ПУЛ КЛИЕНТОВ ===================
+
+CLIENT_POOL_SIZE = int(os.environ.get('CLIENT_POOL_SIZE', 4))
+CLIENT_POOL_TIMEOUT = float(os.environ.get('CLIENT_POOL_TIMEOUT', 30))
+CLIENT_HEALTH_INTERVAL = float(os.environ.get('CLIENT_HEALTH_INTERVAL', 60))
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+def is_broken_client_error(error):
+    """Сетевые ошибки означают, что соединение клиента нужно пересоздать"""
+    import httpx
+    return isinstance(error, (ConnectionError, TimeoutError, httpx.TransportError))
+
+
+def check_client_health(client):
+    """Легкий запрос конфигурации Space без запуска модели"""
+    import httpx
+    from urllib.parse import urljoin
+    response = httpx.get(urljoin(client.src, "config"), headers=client.headers, timeout=10)
+    return response.is_success
+
+
+class ClientPool:
+    """Потокобезопасный пул клиентов Gradio.
+
+    Клиенты создаются лениво (или заранее через warm_up) и выдаются
+    на время одного запроса. Клиент, на котором произошла сетевая ошибка
+    или который не прошел проверку здоровья, заменяется новым.
+    """
+
+    def __init__(self, size=4, factory=None, acquire_timeout=30, health_check=None):
+        self.size = size
+        self.factory = factory or (lambda: get_client())
+        self.acquire_timeout = acquire_timeout
+        self.health_check = health_check or check_client_health
+        self._idle = deque()
+        self._created = 0
+        # Не прошедшие проверку клиенты, которые были заняты: заменяются при возврате
+        self._unhealthy = set()
+        self._cond = threading.Condition()
+        self._health_thread = None
+        self.acquisitions = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.replaced = 0
+        self.health_failures = 0
+
+    @contextlib.contextmanager
+    def acquire(self, timeout=None):
+        timeout = self.acquire_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        client = None
+        with self._cond:
+            while not self._idle and self._created >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError(f"Нет свободного клиента Gradio за {timeout:g} с")
+                self._cond.wait(remaining)
+            if self._idle:
+                client = self._idle.popleft()
+            else:
+                # Резервируем место, сам клиент создаем вне блокировки
+                self._created += 1
+
+        if client is None:
+            try:
+                client = self.factory()
+            except Exception:
+                with self._cond:
+                    self._created -= 1
+                    self._cond.notify()
+                raise
 
+        waited = time.monotonic() - started
+        with self._cond:
+            self.acquisitions += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+        broken = False
+        try:
+            yield client
+        except Exception as e:
+            broken = is_broken_client_error(e)
+            raise
+        finally:
+            self._release(client, broken)
+
+    def _release(self, client, broken):
+        with self._cond:
+            if client in self._unhealthy:
+                self._unhealthy.discard(client)
+                broken = True
+            if broken:
+                self._created -= 1
+                self.replaced += 1
+            else:
+                self._idle.append(client)
+            self._cond.notify()
+
+    def warm_up(self):
+        """Заполняет пул клиентами в фоновом потоке"""
+        def fill():
+            for _ in range(self.size):
+                with self._cond:
+                    if self._created >= self.size:
+                        break
+                    self._created += 1
+                try:
+                    client = self.factory()
+                except Exception as e:
+                    with self._cond:
+                        self._created -= 1
+                    print(f"❌ Не удалось создать клиента Gradio: {e}")
+                    break
+                self._release(client, False)
+
+        thread = threading.Thread(target=fill, name='client-pool-warmup', daemon=True)
+        thread.start()
+        return thread
+
+    def check_health(self):
+        """Проверяет свободных клиентов и удаляет неисправных.
+
+        Проверка — отдельный HTTP-запрос, клиент на это время остается
+        в пуле: иначе запросы ждали бы, пока проверяются все клиенты.
+        """
+        with self._cond:
+            idle = list(self._idle)
+        for client in idle:
+            try:
+                healthy = self.health_check(client)
+            except Exception:
+                healthy = False
+            if healthy:
+                continue
+            with self._cond:
+                self.health_failures += 1
+                if client in self._idle:
+                    self._idle.remove(client)
+                    self._created -= 1
+                    self.replaced += 1
+                    self._cond.notify()
+                else:
+                    # Клиента уже взял запрос — заменим его, когда вернется
+                    self._unhealthy.add(client)
+
+    def start_health_checks(self, interval):
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.check_health()
+
+        if self._health_thread is None and interval > 0:
+            self._health_thread = threading.Thread(target=loop, name='client-pool-health', daemon=True)
+            self._health_thread.start()
+
+    def reset(self):
+        with self._cond:
+            self._idle.clear()
+            self._unhealthy.clear()
+            self._created = 0
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "created": self._created,
+                "idle": len(self._idle),
+                "in_use": self._created - len(self._idle),
+                "acquisitions": self.acquisitions,
+                "wait_time_total": self.wait_time_total,
+                "wait_time_max": self.wait_time_max,
+                "wait_time_avg": self.wait_time_total / self.acquisitions if self.acquisitions else 0.0,
+                "replaced": self.replaced,
+                "health_failures": self.health_failures,
+            }
+
+
+client_pool = ClientPool(CLIENT_POOL_SIZE, acquire_timeout=CLIENT_POOL_TIMEOUT)
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def selected_images():
+    """Выбранные файлы поля image: их может быть несколько"""
+    return [file for file in request.files.getlist('image') if file.filename]
+
+
+def check_images(images):
+    """Текст ошибки для API или None, если файлы можно анализировать"""
+    if not images:
+        return "Файл не был загружен"
+    if len(images) > MAX_IMAGES_PER_REQUEST:
+        return f"Слишком много изображений: не больше {MAX_IMAGES_PER_REQUEST} за запрос"
+    if not all(allowed_file(file.filename) for file in images):
+        return "Неподдерживаемый формат файла"
+    return None
+
+
+# =================== ЗАГРУЗКА ФАЙЛОВ ===================
+
+def default_spool_dir():
+    # /dev/shm — tmpfs: принятые файлы остаются в памяти и не попадают на диск
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+UPLOAD_SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR') or default_spool_dir()
+UPLOAD_MEMORY_LIMIT = int(os.environ.get('UPLOAD_MEMORY_LIMIT', 256 * 1024 * 1024))
+UPLOAD_BUDGET_TIMEOUT = float(os.environ.get('UPLOAD_BUDGET_TIMEOUT', 5))
+
+
+class UploadBudget:
+    """Ограничение суммарного объема одновременно принимаемых загрузок"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size, timeout):
+        # Запрос больше лимита целиком занимает бюджет, иначе он не пройдет никогда
+        size = min(size, self.limit)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.in_use + size > self.limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    return 0
+                self._cond.wait(remaining)
+            self.in_use += size
+            return size
+
+    def release(self, size):
+        with self._cond:
+            self.in_use -= size
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"limit": self.limit, "in_use": self.in_use, "rejected": self.rejected}
+
+
+upload_budget = UploadBudget(UPLOAD_MEMORY_LIMIT)
+
+
+# =================== ПРОВЕРКА ЗАГРУЗОК ===================
+
+UPLOAD_MAX_FILE_SIZE = int(os.environ.get('UPLOAD_MAX_FILE_SIZE', app.config['MAX_CONTENT_LENGTH']))
+UPLOAD_MAX_PIXELS = int(os.environ.get('UPLOAD_MAX_PIXELS', 40_000_000))
+# Сколько первых байтов файла ждем, чтобы найти размеры в заголовке (JPEG с большим EXIF)
+UPLOAD_SNIFF_LIMIT = int(os.environ.get('UPLOAD_SNIFF_LIMIT', 256 * 1024))
+
+UPLOAD_REJECT_MESSAGES = {
+    'signature': 'Файл не является изображением PNG, JPEG, GIF или WebP',
+    'truncated': 'Файл изображения поврежден или обрезан',
+    'dimensions': 'Недопустимые размеры изображения',
+    'size': 'Файл слишком большой',
+}
+
+
+class UploadRejected(HTTPException):
+    """Загрузка отклонена при приеме, до записи остатка тела запроса"""
+
+    def __init__(self, reason, description=None):
+        super().__init__(description or UPLOAD_REJECT_MESSAGES[reason])
+        self.reason = reason
+        self.code = 413 if reason == 'size' else 415
+
+
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+
+# Маркеры SOF: C0-CF, кроме DHT (C4), JPG (C8) и DAC (CC)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def sniff_format(header):
+    """Формат по сигнатуре; None — байтов пока недостаточно"""
+    if header[:4] == b'RIFF'[:len(header)] and len(header) < 12:
+        return None
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    for signature, image_format in IMAGE_SIGNATURES:
+        if header[:len(signature)] == signature:
+            return image_format
+        if len(header) < len(signature) and signature.startswith(header):
+            return None
+    raise UploadRejected('signature')
+
+
+def jpeg_dimensions(header):
+    # Проходим сегменты до первого SOF: в нем высота и ширина
+    pos = 2
+    while True:
+        if pos + 4 > len(header):
+            return None
+        if header[pos] != 0xFF:
+            raise UploadRejected('signature')
+        marker = header[pos + 1]
+        if marker == 0xFF:  # байт-заполнитель
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # маркеры без длины
+            pos += 2
+            continue
+        if marker in (0xD9, 0xDA):  # конец файла или данные раньше заголовка кадра
+            raise UploadRejected('truncated')
+        if marker in JPEG_SOF_MARKERS:
+            if pos + 9 > len(header):
+                return None
+            height, width = struct.unpack('>HH', header[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + struct.unpack('>H', header[pos + 2:pos + 4])[0]
+
+
+def webp_dimensions(header):
+    if len(header) < 30:
+        return None
+    chunk = header[12:16]
+    if chunk == b'VP8 ':
+        if header[23:26] != b'\x9d\x01\x2a':
+            raise UploadRejected('signature')
+        width, height = struct.unpack('<HH', header[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L':
+        if header[20] != 0x2F:
+            raise UploadRejected('signature')
+        bits = int.from_bytes(header[21:25], 'little')
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X':
+        return int.from_bytes(header[24:27], 'little') + 1, int.from_bytes(header[27:30], 'little') + 1
+    raise UploadRejected('signature')
+
+
+def sniff_image(header):
+    """Формат и размеры изображения по первым байтам файла.
+
+    Возвращает (формат, (ширина, высота)) или None, если байтов пока
+    недостаточно. Для не изображений бросает UploadRejected.
+    """
+    image_format = sniff_format(header)
+    if image_format is None:
+        return None
+    if image_format == 'png':
+        if len(header) < 24:
+            return None
+        if header[12:16] != b'IHDR':
+            raise UploadRejected('signature')
+        size = struct.unpack('>II', header[16:24])
+    elif image_format == 'gif':
+        if len(header) < 10:
+            return None
+        size = struct.unpack('<HH', header[6:10])
+    elif image_format == 'webp':
+        size = webp_dimensions(header)
+    else:
+        size = jpeg_dimensions(header)
+    return None if size is None else (image_format, size)
+
+
+def check_dimensions(size):
+    width, height = size
+    if not width or not height or width * height > UPLOAD_MAX_PIXELS:
+        raise UploadRejected('dimensions', f'Недопустимые размеры изображения: {width}x{height}')
+
+
+class ValidatingUpload:
+    """Файл в спуле, который проверяет загрузку по мере записи.
+
+    Размер ограничивается на каждой записи, а формат и размеры изображения
+    определяются по первым байтам, поэтому мусор и слишком большие файлы
+    отклоняются до приема остатка тела запроса. Остальное делегируется файлу.
+
+    С per_part=True отказ не прерывает запрос: он сохраняется в rejected,
+    а остаток части отбрасывается без записи — так пакет отвечает ошибкой
+    только для этого файла.
+    """
+
+    def __init__(self, file, check_image=True, max_size=None, sniff_limit=None, per_part=False):
+        self._file = file
+        self.max_size = max_size or UPLOAD_MAX_FILE_SIZE
+        self.sniff_limit = sniff_limit or UPLOAD_SNIFF_LIMIT
+        self.per_part = per_part
+        self.size = 0
+        self.image = None
+        self.rejected = None
+        self._header = b''
+        self._pending = check_image
+
+    def write(self, data):
+        if self.rejected:
+            return len(data)
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.reject('size')
+            return len(data)
+        if self._pending:
+            self._header += data[:self.sniff_limit - len(self._header)]
+            self._sniff(final=len(self._header) >= self.sniff_limit)
+            if self.rejected:
+                return len(data)
+        return self._file.write(data)
+
+    def seek(self, *args):
+        # Werkzeug перематывает файл, когда часть multipart принята целиком
+        if self._pending:
+            self._sniff(final=True)
+        if self.rejected:
+            return 0
+        return self._file.seek(*args)
+
+    def _sniff(self, final):
+        try:
+            self.image = sniff_image(self._header)
+            if self.image is None:
+                if not final:
+                    return
+                if len(self._header) < self.sniff_limit:
+                    raise UploadRejected('truncated')
+                # Сигнатура верная, но размеры за пределами просмотренного заголовка — проверит Pillow
+                self.image = (sniff_format(self._header), None)
+            else:
+                check_dimensions(self.image[1])
+        except UploadRejected as e:
+            self._fail(e)
+            return
+        self._pending = False
+        self._header = b''
+
+    def _fail(self, error):
+        self._pending = False
+        self._header = b''
+        self._file.close()
+        if not self.per_part:
+            raise error
+        self.rejected = error
+        metrics.upload_rejections.inc(error.reason)
+
+    def reject(self, reason):
+        self._fail(UploadRejected(reason))
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+@app.errorhandler(UploadRejected)
+@app.errorhandler(RequestEntityTooLarge)
+def upload_rejected(e):
+    metrics.upload_rejections.inc(getattr(e, 'reason', 'request_size'))
+    message = e.description if isinstance(e, UploadRejected) else UPLOAD_REJECT_MESSAGES['size']
+    return error_response(message, e.code)
+
+
+def error_response(message, status, headers=None):
+    """Отказ до вызова view: страница с сообщением для формы, JSON для API"""
+    if request.endpoint == 'index':
+        flash(message, 'error')
+        return render_page(), status, headers or {}
+    return jsonify({"success": False, "error": message}), status, headers or {}
+
+
+# Пакетные эндпоинты: ошибка одного файла не должна отклонять остальные
+PER_PART_UPLOAD_ENDPOINTS = {'analyze_batch_api'}
+
+
+class SpoolRequest(Request):
+    """Запрос, который принимает файлы сразу в уникальный файл в спуле.
+
+    Файл удаляется автоматически при закрытии запроса, поэтому отдельного
+    сохранения и удаления во view не требуется. Загрузки с расширением
+    изображения проверяются по содержимому еще во время приема; эндпоинты
+    из PER_PART_UPLOAD_ENDPOINTS получают отказ отдельно для каждого файла.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        suffix = os.path.splitext(secure_filename(filename or ''))[1]
+        file = tempfile.NamedTemporaryFile(dir=UPLOAD_SPOOL_DIR, prefix='upload_', suffix=suffix)
+        # Файлы с другими расширениями отклоняет view с понятным сообщением; размер ограничен для всех
+        upload = ValidatingUpload(file, check_image=bool(filename) and allowed_file(filename),
+                                  per_part=self.endpoint in PER_PART_UPLOAD_ENDPOINTS)
+        if content_length and content_length > upload.max_size:
+            upload.reject('size')
+        return upload
+
+
+app.request_class = SpoolRequest
+
+
+@app.before_request
+def track_request_start():
+    metrics.requests_in_flight.inc()
+    g.in_flight = True
+
+
+@app.teardown_request
+def track_request_end(exc=None):
+    if g.pop('in_flight', False):
+        metrics.requests_in_flight.dec()
+
+
+@app.before_request
+def reserve_upload_budget():
+    if request.mimetype != 'multipart/form-data':
+        return None
+    size = request.content_length or app.config['MAX_CONTENT_LENGTH']
+    reserved = upload_budget.acquire(size, UPLOAD_BUDGET_TIMEOUT)
+    if not reserved:
+        return Response('Сервер перегружен загрузками, повторите запрос позже', status=503,
+                        headers={'Retry-After': '1'}, mimetype='text/plain')
+    g.upload_reserved = reserved
+    return None
+
+
+@app.teardown_request
+def release_upload_budget(exc=None):
+    reserved = g.pop('upload_reserved', 0)
+    if reserved:
+        upload_budget.release(reserved)
+
+
+def upload_path(file):
+    """Путь к принятому файлу в спуле (действителен до конца запроса)"""
+    stream = file.stream
+    path = getattr(stream, 'name', None)
+    if isinstance(path, str) and os.path.isfile(path):
+        stream.flush()
+        return path
+
+    # Файл принят не через SpoolRequest — сохраняем его в спул сами
+    spooled = tempfile.NamedTemporaryFile(dir=UPLOAD_SPOOL_DIR, prefix='upload_',
+                                          suffix=os.path.splitext(secure_filename(file.filename))[1])
+    file.save(spooled)
+    spooled.flush()
+    g.setdefault('spooled_files', []).append(spooled)
+    return spooled.name
+
+
+@app.teardown_request
+def close_spooled_files(exc=None):
+    for spooled in g.pop('spooled_files', []):
+        spooled.close()
+
+
+# Ссылки на загрузки, пережившие запрос, и занятый ими объем upload_budget
+detached_uploads = {}
+detached_uploads_lock = threading.Lock()
+
+
+def detach_upload(file):
+    """Отдельная ссылка на загрузку, переживающая запрос; удаляет вызывающий через remove_files.
+
+    Объем файла переходит из бюджета запроса к ссылке: очередь задач и
+    открытые потоки занимают место в UPLOAD_MEMORY_LIMIT, пока файл в спуле.
+    """
+    source = upload_path(file)
+    path = os.path.join(UPLOAD_SPOOL_DIR, f"job_{uuid.uuid4().hex}{os.path.splitext(source)[1]}")
+    try:
+        # Жесткая ссылка вместо копирования байтов
+        os.link(source, path)
+    except OSError:
+        shutil.copyfile(source, path)
+    charge = min(os.path.getsize(path), g.get('upload_reserved', 0))
+    if charge:
+        g.upload_reserved -= charge
+        with detached_uploads_lock:
+            detached_uploads[path] = charge
+    return path
+
+
+# =================== ПРЕДОБРАБОТКА ИЗОБРАЖЕНИЙ ===================
+
+PREPROCESS_ENABLED = os.environ.get('PREPROCESS_ENABLED', '1') == '1'
+PREPROCESS_MAX_SIDE = int(os.environ.get('PREPROCESS_MAX_SIDE', 1536))
+PREPROCESS_FORMAT = os.environ.get('PREPROCESS_FORMAT', 'JPEG').upper()
+PREPROCESS_QUALITY = int(os.environ.get('PREPROCESS_QUALITY', 85))
+
+PREPROCESS_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp'}
+
+
+class PreprocessStats:
+    """Счетчики предобработки: сколько байт было и сколько ушло в Space"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.processed = 0
+        self.skipped = 0
+        self.errors = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def record(self, outcome, bytes_before=0, bytes_after=0):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            self.bytes_before += bytes_before
+            self.bytes_after += bytes_after
+
+    def stats(self):
+        with self._lock:
+            return {
+                "processed": self.processed,
+                "skipped": self.skipped,
+                "errors": self.errors,
+                "bytes_before": self.bytes_before,
+                "bytes_after": self.bytes_after,
+                "bytes_saved": self.bytes_before - self.bytes_after,
+            }
+
+
+preprocess_stats = PreprocessStats()
+
+
+def preprocess_image(image_path, max_side=None, image_format=None, quality=None):
+    """Уменьшает изображение и перекодирует его без метаданных.
+
+    Возвращает путь к новому файлу в спуле или None, если обработка
+    не уменьшила объем или изображение не удалось прочитать.
+    """
+    from PIL import Image, ImageOps
+
+    max_side = max_side or PREPROCESS_MAX_SIDE
+    image_format = (image_format or PREPROCESS_FORMAT).upper()
+    quality = quality or PREPROCESS_QUALITY
+    size_before = os.path.getsize(image_path)
+
+    with Image.open(image_path) as img:
+        # Для JPEG декодер сразу уменьшает изображение кратно 1/2..1/8
+        img.draft('RGB', (max_side, max_side))
+        # Для анимированного GIF Image.open уже стоит на первом кадре
+        img = ImageOps.exif_transpose(img)
+        resized = max(img.size) > max_side
+        if resized:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+        if image_format == 'JPEG' or not has_alpha:
+            if has_alpha:
+                # JPEG не поддерживает прозрачность — накладываем на белый фон
+                rgba = img.convert('RGBA')
+                img = Image.new('RGB', rgba.size, (255, 255, 255))
+                img.paste(rgba, mask=rgba.getchannel('A'))
+            else:
+                img = img.convert('RGB')
+        else:
+            img = img.convert('RGBA')
+
+        fd, output_path = tempfile.mkstemp(dir=UPLOAD_SPOOL_DIR, prefix='prep_',
+                                           suffix=PREPROCESS_EXTENSIONS.get(image_format, '.jpg'))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # Метаданные (EXIF, ICC, комментарии) не передаются в save и отбрасываются
+                img.save(f, format=image_format, quality=quality, optimize=True)
+        except Exception:
+            os.remove(output_path)
+            raise
 
-# Глобальный клиент (будет инициализирован при первом использовании)
-client = None
+    size_after = os.path.getsize(output_path)
+    if size_after >= size_before and not resized:
+        os.remove(output_path)
+        return None
+    return output_path
 
 
-def get_or_create_client():
-    global client
-    if client is None:
-        client = get_client()
-    return client
+GIF_KEYFRAMES = int(os.environ.get('GIF_KEYFRAMES', 4))
+GIF_KEYFRAME_MIN_DIFF = float(os.environ.get('GIF_KEYFRAME_MIN_DIFF', 8))
+GIF_SCAN_FRAMES = int(os.environ.get('GIF_SCAN_FRAMES', 64))
+GIF_THUMB_SIZE = 32
 
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def select_keyframes(thumbs, max_frames, min_diff):
+    """Выбирает индексы наиболее непохожих кадров.
+
+    thumbs — массив (кадры, высота, ширина) уменьшенных серых кадров.
+    Первый кадр берется всегда, затем жадно добавляется кадр, дальше всех
+    отстоящий от уже выбранных (средняя абсолютная разность пикселей), пока
+    расстояние не станет меньше min_diff или не наберется max_frames кадров.
+    """
+    import numpy as np
+
+    frames = np.asarray(thumbs, dtype=np.float32).reshape(len(thumbs), -1)
+    selected = [0]
+    distance = np.abs(frames - frames[0]).mean(axis=1)
+    while len(selected) < max_frames:
+        candidate = int(distance.argmax())
+        if distance[candidate] < min_diff:
+            break
+        selected.append(candidate)
+        distance = np.minimum(distance, np.abs(frames - frames[candidate]).mean(axis=1))
+    return sorted(selected)
+
+
+def extract_keyframes(image_path, max_frames=None, min_diff=None, scan_frames=None):
+    """Сохраняет ключевые кадры анимированного GIF в спул.
+
+    Возвращает список путей (в порядке кадров) или None, если файл не
+    анимированный GIF. Кадры уменьшаются и перекодируются так же, как
+    при обычной предобработке.
+    """
+    from PIL import Image
+    import numpy as np
+
+    max_frames = max_frames or GIF_KEYFRAMES
+    min_diff = GIF_KEYFRAME_MIN_DIFF if min_diff is None else min_diff
+    scan_frames = scan_frames or GIF_SCAN_FRAMES
+
+    with Image.open(image_path) as img:
+        n_frames = getattr(img, 'n_frames', 1)
+        if img.format != 'GIF' or n_frames < 2:
+            return None
+        # Длинные анимации просматриваем не целиком, а равномерной выборкой кадров
+        indices = np.unique(np.linspace(0, n_frames - 1, min(n_frames, scan_frames)).astype(int))
+        thumbs = []
+        for index in indices:
+            img.seek(int(index))
+            thumbs.append(np.asarray(img.convert('L').resize((GIF_THUMB_SIZE, GIF_THUMB_SIZE), Image.BILINEAR)))
+        chosen = [int(indices[i]) for i in select_keyframes(np.stack(thumbs), max_frames, min_diff)]
+
+        paths = []
+        try:
+            for index in chosen:
+                img.seek(index)
+                frame = img.convert('RGB')
+                frame.thumbnail((PREPROCESS_MAX_SIDE, PREPROCESS_MAX_SIDE), Image.LANCZOS)
+                fd, output_path = tempfile.mkstemp(dir=UPLOAD_SPOOL_DIR, prefix='frame_', suffix='.jpg')
+                paths.append(output_path)
+                with os.fdopen(fd, 'wb') as f:
+                    frame.save(f, format='JPEG', quality=PREPROCESS_QUALITY, optimize=True)
+        except Exception:
+            for path in paths:
+                os.remove(path)
+            raise
+    return paths
+
+
+@contextlib.contextmanager
+def prepared_image(image_path):
+    """Путь к изображению для отправки в Space; временный файл удаляется на выходе"""
+    output_path = None
+    if PREPROCESS_ENABLED:
+        try:
+            size_before = os.path.getsize(image_path)
+            output_path = preprocess_image(image_path)
+            if output_path:
+                preprocess_stats.record('processed', size_before, os.path.getsize(output_path))
+            else:
+                preprocess_stats.record('skipped', size_before, size_before)
+        except Exception:
+            # Не изображение, нет Pillow или файл недоступен — отправляем как есть
+            output_path = None
+            preprocess_stats.record('errors')
+    try:
+        yield output_path or image_path
+    finally:
+        if output_path:
+            try:
+                os.remove(output_path)
+            except OSError:
+                pass
+
+
+@contextlib.contextmanager
+def prepared_images(image_paths):
+    """Список файлов для отправки в Space.
+
+    Анимированный GIF раскрывается в несколько ключевых кадров, остальные
+    изображения проходят обычную предобработку.
+    """
+    with contextlib.ExitStack() as stack:
+        upload_files = []
+        for image_path in image_paths:
+            keyframes = None
+            if PREPROCESS_ENABLED and GIF_KEYFRAMES > 1 and image_path.lower().endswith('.gif'):
+                try:
+                    keyframes = extract_keyframes(image_path)
+                except Exception:
+                    # Не удалось разобрать кадры (или нет NumPy) — отправляем как обычное изображение
+                    keyframes = None
+            if keyframes:
+                stack.callback(remove_files, keyframes)
+                upload_files.extend(keyframes)
+            else:
+                upload_files.append(stack.enter_context(prepared_image(image_path)))
+        yield upload_files
+
+
+def remove_files(paths):
+    with detached_uploads_lock:
+        released = sum(detached_uploads.pop(path, 0) for path in paths)
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    if released:
+        upload_budget.release(released)
+
+
+# =================== КЭШ РЕЗУЛЬТАТОВ ===================
+
+# Параметры генерации для /chat по умолчанию
+DEFAULT_PARAMS = {
+    "param_2": "",
+    "param_3": 2048,
+    "param_4": 0.3,
+    "param_5": 0,
+    "param_6": 0,
+}
+
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 256))
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 3600))
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', '')
+# Пределы дискового уровня: при превышении вытесняются давно не читанные записи
+RESULT_CACHE_DISK_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_DISK_MAX_ENTRIES', 10000))
+RESULT_CACHE_DISK_MAX_BYTES = int(os.environ.get('RESULT_CACHE_DISK_MAX_BYTES', 256 * 1024 * 1024))
+# Как часто удалять с диска истекшие записи, которые никто не читает
+RESULT_CACHE_DISK_SWEEP_INTERVAL = float(os.environ.get('RESULT_CACHE_DISK_SWEEP_INTERVAL', 300))
+
+
+def hash_file(path):
+    """SHA-256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def normalize_prompt(prompt):
+    return ' '.join(prompt.split())
+
+
+def make_cache_key(image_hash, prompt, params):
+    payload = json.dumps([image_hash, normalize_prompt(prompt), params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """LRU-кэш результатов анализа с TTL и опциональным дисковым уровнем.
+
+    Дисковый уровень ограничен числом записей и объемом: индекс файлов
+    (размер и срок) хранится в памяти в порядке LRU, чтобы не обходить
+    каталог на медленном томе при каждой записи.
+    """
+
+    def __init__(self, max_size=256, ttl=3600, disk_dir=None, disk_max_entries=10000,
+                 disk_max_bytes=256 * 1024 * 1024, disk_sweep_interval=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk_dir = disk_dir or None
+        self.disk_max_entries = disk_max_entries
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_sweep_interval = disk_sweep_interval
+        self._items = OrderedDict()
+        self._disk = OrderedDict()  # ключ -> (размер файла, срок)
+        self._disk_bytes = 0
+        self._next_sweep = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _load_disk_index(self):
+        """Индекс записей, оставшихся с прошлого запуска; срок оценивается по времени записи файла"""
+        entries = []
+        with os.scandir(self.disk_dir) as it:
+            for entry in it:
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, entry.name[:-len('.json')], stat.st_size))
+        for mtime, key, size in sorted(entries):
+            self._disk[key] = (size, mtime + self.ttl)
+            self._disk_bytes += size
+        self._remove_files(self._trim_disk(time.time(), sweep=True))
+
+    def _forget_disk(self, key):
+        entry = self._disk.pop(key, None)
+        if entry is not None:
+            self._disk_bytes -= entry[0]
+
+    def _trim_disk(self, now, sweep=False):
+        """Ключи, которые нужно удалить с диска: истекшие (при sweep) и лишние по LRU"""
+        removed = []
+        if sweep:
+            for key, (_, expires) in list(self._disk.items()):
+                if expires < now:
+                    self._forget_disk(key)
+                    removed.append(key)
+        while self._disk and (len(self._disk) > self.disk_max_entries or self._disk_bytes > self.disk_max_bytes):
+            key = next(iter(self._disk))
+            self._forget_disk(key)
+            removed.append(key)
+            self.disk_evictions += 1
+        return removed
+
+    def _remove_files(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def _read_disk(self, key):
+        try:
+            with open(self._disk_path(key), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("expires", 0) < time.time():
+            with self._lock:
+                self._forget_disk(key)
+            self._remove_files([key])
+            return None
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+        return entry
+
+    def _write_disk(self, key, value, expires):
+        # Пишем через временный файл, чтобы не оставить обрезанную запись
+        tmp_path = f"{self._disk_path(key)}.{threading.get_ident()}.tmp"
+        try:
+            data = json.dumps({"expires": expires, "result": value}, ensure_ascii=False).encode('utf-8')
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            size = len(data)
+            os.replace(tmp_path, self._disk_path(key))
+        except (OSError, TypeError, ValueError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        now = time.time()
+        with self._lock:
+            self._forget_disk(key)
+            self._disk[key] = (size, expires)
+            self._disk_bytes += size
+            sweep = now >= self._next_sweep
+            if sweep:
+                self._next_sweep = now + self.disk_sweep_interval
+            removed = self._trim_disk(now, sweep)
+        self._remove_files(removed)
+
+    def _put(self, key, value, expires):
+        self._items[key] = (value, expires)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key):
+        """Возвращает (True, значение) при попадании и (False, None) при промахе"""
+        now = time.time()
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None:
+                if entry[1] >= now:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[0]
+                del self._items[key]
+                self.evictions += 1
+        if self.disk_dir:
+            disk_entry = self._read_disk(key)
+            if disk_entry is not None:
+                with self._lock:
+                    self._put(key, disk_entry["result"], disk_entry["expires"])
+                    self.hits += 1
+                    self.disk_hits += 1
+                return True, disk_entry["result"]
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._put(key, value, expires)
+        if self.disk_dir:
+            self._write_disk(key, value, expires)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+            self._forget_disk(key)
+        if self.disk_dir:
+            self._remove_files([key])
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            removed = list(self._disk)
+            self._disk.clear()
+            self._disk_bytes = 0
+            self.hits = self.disk_hits = self.misses = self.evictions = self.disk_evictions = 0
+        if self.disk_dir:
+            self._remove_files(removed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._items),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "disk_enabled": bool(self.disk_dir),
+                "disk_size": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_evictions": self.disk_evictions,
+            }
+
+
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_CACHE_DIR, RESULT_CACHE_DISK_MAX_ENTRIES,
+                           RESULT_CACHE_DISK_MAX_BYTES, RESULT_CACHE_DISK_SWEEP_INTERVAL)
+
+
+def get_cache_key(image_paths, prompt, params):
+    """Ключ кэша: хэши содержимого изображений (с учетом порядка) + нормализованный промпт + параметры"""
+    try:
+        hashes = [hash_file(path) for path in image_paths]
+    except OSError:
+        return None
+    # Для одного изображения ключ совпадает с ключом до поддержки нескольких файлов
+    return make_cache_key(hashes[0] if len(hashes) == 1 else hashes, prompt, params)
+
+
+# =================== ФАЙЛЫ В SPACE ===================
+
+# Включается явно (например, 1024). Space хранит загруженные файлы, пока не очистит кэш
+# или не перезапустится: срок ссылки не должен быть дольше
+REMOTE_FILE_CACHE_SIZE = int(os.environ.get('REMOTE_FILE_CACHE_SIZE', 0))
+REMOTE_FILE_TTL = float(os.environ.get('REMOTE_FILE_TTL', 3600))
+
+# (бэкенд, SHA-256 содержимого) -> путь к копии файла на стороне Space
+remote_files = ResultCache(REMOTE_FILE_CACHE_SIZE, REMOTE_FILE_TTL)
+
+
+def upload_to_space(client, path):
+    """Загружает файл в Space тем же запросом, что и gradio_client, и возвращает путь к копии в Space.
+
+    Публичного метода загрузки у gradio_client нет, поэтому запрос собирается из
+    атрибутов Client (upload_url, headers, cookies, ssl_verify, httpx_kwargs).
+    Версия gradio_client закреплена в requirements.txt; при обновлении нужно
+    прогнать TestRemoteFiles — он проверяет загрузку на настоящем Client.
+    """
+    import httpx
+
+    with open(path, 'rb') as f:
+        response = httpx.post(client.upload_url, headers=client.headers, cookies=client.cookies,
+                              verify=client.ssl_verify, files=[('files', (os.path.basename(path), f))],
+                              **client.httpx_kwargs)
+    response.raise_for_status()
+    return response.json()[0]
+
+
+def space_file_url(client, remote_path):
+    """Ссылка на копию файла в Space — та же, по которой gradio_client скачивает файлы ответа"""
+    from gradio_client.utils import encode_file_path
+    return f"{client.src_prefixed}file={encode_file_path(remote_path)}"
+
+
+def upload_hashes(upload_files):
+    """SHA-256 подготовленных файлов для ссылок на копии в Space; None, если повторное использование выключено.
+
+    Считается один раз на запрос: повторы и хедж получают готовые хэши.
+    """
+    if remote_files.max_size <= 0:
+        return None
+    return [hash_file(path) for path in upload_files]
+
+
+def space_files(backend, client, upload_files, hashes):
+    """Файлы для сообщения /chat и ключи ссылок, взятых из кэша.
+
+    Файл, который уже загружали в этот бэкенд, передается ссылкой на копию
+    в Space, и повторный вопрос о том же изображении отправляет только текст.
+    Ссылка оформляется полноценной FileData через handle_file: URL gradio_client
+    передает как есть, не загружая файл повторно.
+    """
+    if hashes is None:
+        return [handle_file(path) for path in upload_files], []
+    files, reused = [], []
+    for path, file_hash in zip(upload_files, hashes):
+        key = f"{backend.name}:{file_hash}"
+        hit, remote_path = remote_files.get(key)
+        if hit:
+            reused.append(key)
+        else:
+            with span('file.upload', bytes=os.path.getsize(path)):
+                remote_path = upload_to_space(client, path)
+            remote_files.set(key, remote_path)
+        files.append(handle_file(space_file_url(client, remote_path)))
+    return files, reused
+
+
+def forget_space_files(keys):
+    # Space мог удалить файлы раньше срока (перезапуск, очистка кэша) — следующий вызов загрузит их заново
+    for key in keys:
+        remote_files.delete(key)
+
+
+# =================== ПОХОЖИЕ ИЗОБРАЖЕНИЯ ===================
+
+NEAR_DUP_SIZE = int(os.environ.get('NEAR_DUP_SIZE', 0))
+NEAR_DUP_THRESHOLD = int(os.environ.get('NEAR_DUP_THRESHOLD', 4))
+NEAR_DUP_COLOR_TOLERANCE = int(os.environ.get('NEAR_DUP_COLOR_TOLERANCE', 16))
+NEAR_DUP_TTL = float(os.environ.get('NEAR_DUP_TTL', RESULT_CACHE_TTL))
+HASH_BITS = 64
+COLOR_GRID = 4
+
+
+def image_signature(image_path):
+    """(dHash, цветовая сигнатура) изображения.
+
+    dHash — знаки разностей яркости соседних пикселей уменьшенного до 9x8
+    изображения; он строится по яркости и не различает цветовые варианты
+    одного снимка. Поэтому к нему добавляются средние RGB по сетке 4x4:
+    перекодирование и изменение размера почти не меняют их, а другой цвет
+    товара меняет.
+    """
+    from PIL import Image, ImageOps
+    import numpy as np
+
+    with Image.open(image_path) as img:
+        img.draft('RGB', (64, 64))
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        pixels = np.asarray(img.convert('L').resize((9, 8), Image.LANCZOS), dtype=np.int16)
+        colors = np.asarray(img.resize((COLOR_GRID, COLOR_GRID), Image.BOX), dtype=np.uint8).tobytes()
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big'), colors
+
+
+def perceptual_hash(image_path):
+    """64-битный dHash изображения.
+
+    Не меняется при перекодировании, изменении размера и удалении метаданных.
+    """
+    return image_signature(image_path)[0]
+
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+def color_distance(a, b):
+    # Наибольшее расхождение средних по одному каналу одной ячейки сетки
+    return max(abs(x - y) for x, y in zip(a, b))
+
+
+class NearDuplicateIndex:
+    """Результаты анализа по перцептивному хэшу изображения и промпту.
+
+    Поиск по расстоянию Хэмминга через multi-index hashing: хэш делится на
+    threshold + 1 частей, и у хэшей на расстоянии не больше threshold хотя бы
+    одна часть совпадает точно. Поэтому кандидаты берутся из словарей частей,
+    а расстояние считается только для них. Если у записи и запроса есть
+    цветовая сигнатура, результат берется только при расхождении цветов не
+    больше color_tolerance. Записи вытесняются по LRU и TTL.
+    """
+
+    def __init__(self, max_size=100000, threshold=4, ttl=3600, color_tolerance=16):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl = ttl
+        self.color_tolerance = color_tolerance
+        parts = threshold + 1
+        bounds = [HASH_BITS * i // parts for i in range(parts + 1)]
+        self._parts = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.color_mismatches = 0
+
+    def _bucket_keys(self, context, image_hash):
+        return [(context, i, (image_hash >> shift) & mask) for i, (shift, mask) in enumerate(self._parts)]
+
+    def _remove(self, entry_key):
+        context, image_hash, colors = entry_key
+        self._entries.pop(entry_key)
+        for bucket_key in self._bucket_keys(context, image_hash):
+            bucket = self._buckets[bucket_key]
+            bucket.discard((image_hash, colors))
+            if not bucket:
+                del self._buckets[bucket_key]
+
+    def add(self, context, image_hash, value, colors=None):
+        if self.max_size <= 0:
+            return
+        entry_key = (context, image_hash, colors)
+        with self._lock:
+            if entry_key in self._entries:
+                self._entries.move_to_end(entry_key)
+            else:
+                for bucket_key in self._bucket_keys(context, image_hash):
+                    self._buckets.setdefault(bucket_key, set()).add((image_hash, colors))
+            self._entries[entry_key] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def find(self, context, image_hash, colors=None):
+        """Возвращает (True, значение, расстояние) для ближайшего похожего или (False, None, None)"""
+        now = time.time()
+        with self._lock:
+            candidates = set()
+            for bucket_key in self._bucket_keys(context, image_hash):
+                candidates.update(self._buckets.get(bucket_key, ()))
+            best = None
+            mismatched = False
+            for candidate, candidate_colors in candidates:
+                distance = hamming_distance(candidate, image_hash)
+                if distance <= self.threshold and (best is None or distance < best[0]):
+                    entry_key = (context, candidate, candidate_colors)
+                    if self._entries[entry_key][1] < now:
+                        self._remove(entry_key)
+                        self.evictions += 1
+                        continue
+                    if (colors is not None and candidate_colors is not None
+                            and color_distance(colors, candidate_colors) > self.color_tolerance):
+                        mismatched = True
+                        continue
+                    best = (distance, entry_key)
+            if best is None:
+                self.misses += 1
+                self.color_mismatches += mismatched
+                return False, None, None
+            distance, entry_key = best
+            self._entries.move_to_end(entry_key)
+            self.hits += 1
+            return True, self._entries[entry_key][0], distance
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+            self.hits = self.misses = self.evictions = self.color_mismatches = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "threshold": self.threshold,
+                "color_tolerance": self.color_tolerance,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "color_mismatches": self.color_mismatches,
+            }
+
+
+near_duplicates = NearDuplicateIndex(NEAR_DUP_SIZE, NEAR_DUP_THRESHOLD, NEAR_DUP_TTL, NEAR_DUP_COLOR_TOLERANCE)
+
+
+def get_near_duplicate_key(image_paths, prompt, params):
+    """(контекст, перцептивный хэш, цветовая сигнатура) для поиска похожих или None.
+
+    Ищем только для запросов с одним изображением; файлы, которые не удалось
+    разобрать как изображение, в индекс не попадают.
+    """
+    if near_duplicates.max_size <= 0 or len(image_paths) != 1:
+        return None
+    try:
+        image_hash, colors = image_signature(image_paths[0])
+    except Exception:
+        return None
+    return make_cache_key(None, prompt, params), image_hash, colors
+
+
+def lookup_result(image_paths, prompt, params):
+    """Ищет готовый результат: сначала по точному содержимому файлов, затем по похожему изображению.
+
+    Возвращает (найден, результат, ключ кэша, ключ похожих) — ключи нужны,
+    чтобы сохранить результат нового вызова модели.
+    """
+    cache_key = get_cache_key(image_paths, prompt, params)
+    if cache_key:
+        hit, value = result_cache.get(cache_key)
+        if hit:
+            return True, value, cache_key, None
+
+    # Перцептивный хэш требует декодирования, поэтому считается только после промаха точного кэша
+    near_key = get_near_duplicate_key(image_paths, prompt, params)
+    if near_key:
+        hit, value, _ = near_duplicates.find(*near_key)
+        if hit:
+            if cache_key:
+                result_cache.set(cache_key, value)
+            return True, value, cache_key, near_key
+    return False, None, cache_key, near_key
+
+
+def remember_result(cache_key, near_key, value):
+    if value is None:
+        return
+    if cache_key:
+        result_cache.set(cache_key, value)
+    if near_key:
+        context, image_hash, colors = near_key
+        near_duplicates.add(context, image_hash, value, colors)
+
+
+# =================== ИСТОРИЯ РЕЗУЛЬТАТОВ ===================
+
+# Путь к базе истории; по умолчанию история отключена, чтобы база не появлялась в каталоге приложения
+HISTORY_DB = os.environ.get('HISTORY_DB', '')
+HISTORY_BATCH_SIZE = int(os.environ.get('HISTORY_BATCH_SIZE', 200))
+HISTORY_FLUSH_INTERVAL = float(os.environ.get('HISTORY_FLUSH_INTERVAL', 1))
+HISTORY_QUEUE_MAX = int(os.environ.get('HISTORY_QUEUE_MAX', 10000))
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', 50))
+HISTORY_PAGE_MAX = int(os.environ.get('HISTORY_PAGE_MAX', 500))
+# Сколько секунд хранить записи (по умолчанию 30 дней); 0 — хранить без ограничения
+HISTORY_RETENTION = float(os.environ.get('HISTORY_RETENTION', 30 * 24 * 3600))
+HISTORY_PRUNE_INTERVAL = float(os.environ.get('HISTORY_PRUNE_INTERVAL', 600))
+
+HISTORY_SCHEMA = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    image_hash TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    params TEXT NOT NULL,
+    output TEXT NOT NULL,
+    latency REAL,
+    tenant TEXT NOT NULL DEFAULT ''
+);
+"""
+
+# Записи упорядочены по (created_at, id); id — псевдоним rowid, который SQLite дописывает в конец
+# каждого индекса, поэтому и фильтр, и страница по курсору — один проход по индексу без сортировки.
+# /history всегда ограничен потребителем, поэтому индексы начинаются с tenant; results_created_at
+# нужен для удаления устаревших записей
+HISTORY_INDEXES = """
+DROP INDEX IF EXISTS results_image_hash;
+DROP INDEX IF EXISTS results_prompt;
+CREATE INDEX IF NOT EXISTS results_tenant_image_hash ON results (tenant, image_hash, created_at);
+CREATE INDEX IF NOT EXISTS results_tenant_prompt ON results (tenant, prompt, created_at);
+CREATE INDEX IF NOT EXISTS results_tenant_created_at ON results (tenant, created_at);
+CREATE INDEX IF NOT EXISTS results_created_at ON results (created_at);
+"""
+
+HISTORY_COLUMNS = ('id', 'created_at', 'image_hash', 'prompt', 'params', 'output', 'latency')
+
+
+class ResultHistory:
+    """Постоянная история результатов анализа в SQLite (режим WAL).
+
+    Запрос только кладет запись в очередь в памяти; фоновый поток пишет
+    записи пачками, одной транзакцией на пачку, и раз в prune_interval
+    удаляет записи старше retention. Читатели используют свои соединения
+    и в режиме WAL не ждут писателя.
+    """
+
+    def __init__(self, path, batch_size=200, flush_interval=1.0, max_pending=10000, retention=30 * 24 * 3600,
+                 prune_interval=600):
+        self.path = path or None
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self._pruned_at = None
+        self._pending = deque()
+        self._writing = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.errors = 0
+        self.pruned = 0
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def _connection(self):
+        # Соединение sqlite3 нельзя делить между потоками, поэтому у каждого потока свое
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    with contextlib.closing(sqlite3.connect(self.path, timeout=30)) as setup:
+                        setup.executescript(HISTORY_SCHEMA)
+                        if 'tenant' not in {row[1] for row in setup.execute('PRAGMA table_info(results)')}:
+                            # База прежней версии: старые записи ничьи и в /history не видны
+                            setup.execute("ALTER TABLE results ADD COLUMN tenant TEXT NOT NULL DEFAULT ''")
+                        setup.executescript(HISTORY_INDEXES)
+                    self._schema_ready = True
+            conn = sqlite3.connect(self.path, timeout=30)
+            # В режиме WAL NORMAL не теряет целостность базы, а fsync выполняется только при чекпойнте
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _ensure_writer(self):
+        # Поток записи стартует при первой записи, а не при импорте модуля
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._writer, name='history-writer', daemon=True)
+            self._thread.start()
+
+    def record(self, image_hash, prompt, params, output, latency=None, tenant=''):
+        """Ставит результат в очередь на запись; False, если история отключена или очередь переполнена"""
+        if not self.enabled:
+            return False
+        row = (time.time(), image_hash, normalize_prompt(prompt),
+               json.dumps(params, sort_keys=True, ensure_ascii=False), json.dumps(output, ensure_ascii=False),
+               latency, tenant)
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                # Диск не успевает — теряем запись истории, но не задерживаем ответ
+                self.dropped += 1
+                return False
+            self._pending.append(row)
+            self._ensure_writer()
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+        return True
+
+    def _writer(self):
+        while True:
+            with self._cond:
+                if len(self._pending) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                batch = [self._pending.popleft() for _ in range(min(len(self._pending), self.batch_size))]
+                self._writing = len(batch)
+            if batch:
+                self._write(batch)
+            if self.retention > 0 and (self._pruned_at is None
+                                       or time.monotonic() - self._pruned_at >= self.prune_interval):
+                self.prune()
+            with self._cond:
+                self._writing = 0
+                self._cond.notify_all()
+
+    def _write(self, batch):
+        try:
+            conn = self._connection()
+            with conn:
+                conn.executemany(
+                    'INSERT INTO results (created_at, image_hash, prompt, params, output, latency, tenant) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+        except (sqlite3.Error, OSError) as e:
+            with self._cond:
+                self.errors += 1
+            print(f"❌ Не удалось сохранить {len(batch)} результатов в историю: {e}")
+            return
+        with self._cond:
+            self.written += len(batch)
+            self.batches += 1
+
+    def prune(self, now=None):
+        """Удаляет записи старше retention; возвращает число удаленных.
+
+        Удаление идет порциями по batch_size, чтобы не держать блокировку
+        записи долго, и проходит по индексу results_created_at.
+        """
+        self._pruned_at = time.monotonic()
+        if not self.enabled or self.retention <= 0:
+            return 0
+        cutoff = (time.time() if now is None else now) - self.retention
+        removed = 0
+        try:
+            conn = self._connection()
+            while True:
+                with conn:
+                    deleted = conn.execute(
+                        'DELETE FROM results WHERE id IN '
+                        '(SELECT id FROM results WHERE created_at < ? ORDER BY created_at LIMIT ?)',
+                        (cutoff, self.batch_size)).rowcount
+                removed += deleted
+                if deleted < self.batch_size:
+                    break
+        except (sqlite3.Error, OSError) as e:
+            with self._cond:
+                self.errors += 1
+            print(f"❌ Не удалось удалить устаревшие записи истории: {e}")
+        with self._cond:
+            self.pruned += removed
+        return removed
+
+    def flush(self, timeout=10):
+        """Ждет, пока все записи из очереди окажутся в базе; False по таймауту"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._pending or self._writing:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    @staticmethod
+    def _item(row):
+        item = dict(zip(HISTORY_COLUMNS, row))
+        item["params"] = json.loads(item["params"])
+        item["output"] = json.loads(item["output"])
+        return item
+
+    def query(self, image_hash=None, prompt=None, prompt_prefix=None, since=None, until=None, cursor=None,
+              limit=50, tenant=None):
+        """Страница истории, новые записи первыми.
+
+        tenant — имя потребителя, чьи записи нужны; None — записи всех.
+        Пагинация по курсору (id последней записи прошлой страницы), а не по
+        смещению: любая страница — проход по индексу, сколько бы записей ни было
+        до нее. Возвращает (записи, курсор следующей страницы или None).
+        """
+        if not self.enabled:
+            return [], None
+        conn = self._connection()
+        conditions, args = [], []
+        if tenant is not None:
+            conditions.append('tenant = ?')
+            args.append(tenant)
+        if image_hash:
+            conditions.append('image_hash = ?')
+            args.append(image_hash)
+        if prompt:
+            conditions.append('prompt = ?')
+            args.append(normalize_prompt(prompt))
+        if prompt_prefix:
+            # Диапазон вместо LIKE, чтобы поиск по началу промпта шел по индексу
+            prefix = normalize_prompt(prompt_prefix)
+            conditions.append('prompt >= ? AND prompt < ?')
+            args.extend([prefix, prefix + '\U0010ffff'])
+        if since is not None:
+            conditions.append('created_at >= ?')
+            args.append(since)
+        if until is not None:
+            conditions.append('created_at < ?')
+            args.append(until)
+        if cursor is not None:
+            position = conn.execute('SELECT created_at, id FROM results WHERE id = ? AND (? IS NULL OR tenant = ?)',
+                                    (cursor, tenant, tenant)).fetchone()
+            if position is None:
+                return [], None
+            conditions.append('(created_at, id) < (?, ?)')
+            args.extend(position)
+        sql = f'SELECT {", ".join(HISTORY_COLUMNS)} FROM results'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        # Лишняя строка показывает, есть ли следующая страница
+        sql += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+        args.append(limit + 1)
+        rows = conn.execute(sql, args).fetchall()
+        items = [self._item(row) for row in rows[:limit]]
+        return items, items[-1]["id"] if len(rows) > limit else None
+
+    def get(self, record_id, tenant=None):
+        if not self.enabled:
+            return None
+        row = self._connection().execute(
+            f'SELECT {", ".join(HISTORY_COLUMNS)} FROM results WHERE id = ? AND (? IS NULL OR tenant = ?)',
+            (record_id, tenant, tenant)).fetchone()
+        return self._item(row) if row else None
+
+    def stats(self):
+        with self._cond:
+            return {
+                "enabled": self.enabled,
+                "pending": len(self._pending) + self._writing,
+                "written": self.written,
+                "batches": self.batches,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "pruned": self.pruned,
+            }
+
+
+history = ResultHistory(HISTORY_DB, HISTORY_BATCH_SIZE, HISTORY_FLUSH_INTERVAL, HISTORY_QUEUE_MAX,
+                        HISTORY_RETENTION, HISTORY_PRUNE_INTERVAL)
+
+
+def record_history(image_paths, prompt, params, result, latency):
+    """Сохраняет ответ модели в историю от имени текущего потребителя.
+
+    Для нескольких изображений хэши перечисляются через запятую.
+    """
+    if not history.enabled or result is None:
+        return
+    try:
+        image_hash = ','.join(hash_file(path) for path in image_paths)
+    except OSError:
+        return
+    history.record(image_hash, prompt, params, result, latency, current_tenant().name)
+
+
+# =================== ЗАЩИТА ОТ ПЕРЕГРУЗКИ ===================
+
+LIMITER_INITIAL = float(os.environ.get('LIMITER_INITIAL', 8))
+LIMITER_MIN = float(os.environ.get('LIMITER_MIN', 1))
+LIMITER_MAX = float(os.environ.get('LIMITER_MAX', 64))
+LIMITER_TARGET_LATENCY = float(os.environ.get('LIMITER_TARGET_LATENCY', 60))
+LIMITER_BACKOFF = float(os.environ.get('LIMITER_BACKOFF', 0.9))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+
+
+class UpstreamUnavailableError(Exception):
+    """Вызов модели отклонен без обращения к Space"""
+    status_code = 503
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class OverloadedError(UpstreamUnavailableError):
+    status_code = 429
+
+
+class CircuitOpenError(UpstreamUnavailableError):
+    status_code = 503
+
+
+class DeadlineExceededError(Exception):
+    """Срок вызова истек до обращения к Space: результат уже никто не ждет"""
+
+
+# Срок по time.monotonic(), после которого вызов модели не начинается, например таймаут элемента пакета
+call_deadline = contextvars.ContextVar('call_deadline', default=None)
+
+
+def check_deadline():
+    deadline = call_deadline.get()
+    if deadline is not None and time.monotonic() >= deadline:
+        raise DeadlineExceededError("Превышено время ожидания")
+
+
+def deadline_timeout(timeout):
+    """Таймаут ожидания, укороченный до срока вызова"""
+    deadline = call_deadline.get()
+    if deadline is None:
+        return timeout
+    return max(0.0, min(timeout, deadline - time.monotonic()))
+
+
+class AdaptiveLimiter:
+    """Адаптивный лимит одновременных вызовов модели (AIMD).
+
+    Успешный вызов быстрее целевой задержки увеличивает лимит на 1/limit,
+    ошибка или медленный ответ умножают лимит на коэффициент backoff.
+    Сам лимитер вызовы не отклоняет: лимит — это число мест справедливой
+    очереди (FairScheduler), и ожидание сверх него ограничено ее таймаутом.
+    """
+
+    def __init__(self, initial=8, min_limit=1, max_limit=64, target_latency=60, backoff=0.9):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.limit = min(max(initial, min_limit), max_limit)
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def release(self, latency, ok):
+        """ok=None — вызов прерван без результата, лимит не меняется"""
+        with self._lock:
+            self.in_flight -= 1
+            if ok is None:
+                return
+            if not ok or latency > self.target_latency:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+            elif self.in_flight + 1 >= int(self.limit) // 2:
+                # Лимит растет только когда он действительно используется
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def stats(self):
+        with self._lock:
+            return {"limit": self.limit, "in_flight": self.in_flight}
+
+
+class CircuitBreaker:
+    """Размыкатель: после серии ошибок перестает обращаться к Space на reset_timeout секунд,
+    затем пропускает один пробный вызов"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                remaining = self.opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError("Модель временно недоступна, повторите запрос позже",
+                                           retry_after=max(1, int(remaining + 0.999)))
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self.probe_in_flight:
+                    self.rejected += 1
+                    raise CircuitOpenError("Модель временно недоступна, повторите запрос позже", retry_after=1)
+                self.probe_in_flight = True
+
+    def available(self):
+        """Пропустит ли allow() запрос сейчас (без изменения состояния)"""
+        with self._lock:
+            if self.state == self.OPEN:
+                return self.opened_at + self.reset_timeout <= time.monotonic()
+            return not (self.state == self.HALF_OPEN and self.probe_in_flight)
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self.probe_in_flight = False
+
+    def record_cancelled(self):
+        with self._lock:
+            self.probe_in_flight = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "open": int(self.state == self.OPEN),
+                "failures": self.failures,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+            }
+
+
+upstream_limiter = AdaptiveLimiter(LIMITER_INITIAL, LIMITER_MIN, LIMITER_MAX, LIMITER_TARGET_LATENCY, LIMITER_BACKOFF)
+upstream_breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+
+
+@contextlib.contextmanager
+def upstream_admission():
+    """Размыкатель и учет вызова в адаптивном лимите; место уже выдано справедливой очередью"""
+    upstream_breaker.allow()
+    upstream_limiter.acquire()
+
+    started = time.monotonic()
+    try:
+        yield
+    except Exception:
+        upstream_limiter.release(time.monotonic() - started, False)
+        upstream_breaker.record_failure()
+        raise
+    except BaseException:
+        # Клиент отключился (GeneratorExit, CancelledError) — это не признак проблем у Space
+        upstream_limiter.release(time.monotonic() - started, None)
+        upstream_breaker.record_cancelled()
+        raise
+    else:
+        upstream_limiter.release(time.monotonic() - started, True)
+        upstream_breaker.record_success()
+
+
+@contextlib.contextmanager
+def upstream_guard():
+    """Пропускает вызов модели через справедливую очередь, размыкатель и адаптивный лимит"""
+    with contextlib.ExitStack() as stack:
+        with span('upstream.admission'):
+            try:
+                stack.enter_context(fair_scheduler.slot(current_tenant(), deadline_timeout(fair_scheduler.timeout)))
+            except OverloadedError:
+                check_deadline()
+                raise
+            check_deadline()
+            stack.enter_context(upstream_admission())
+        yield
+
+
+async def admit_upstream_async(stack):
+    """Допуск к модели без потока; освобождение места регистрируется в ExitStack stack.
+
+    Освобождение синхронное, поэтому допуск, полученный в цикле asyncio,
+    может завершить и генератор потока, работающий в пуле потоков.
+    """
+    with span('upstream.admission'):
+        try:
+            await fair_scheduler.acquire_async(current_tenant(), deadline_timeout(fair_scheduler.timeout))
+        except OverloadedError:
+            check_deadline()
+            raise
+        stack.callback(fair_scheduler.release)
+        check_deadline()
+        stack.enter_context(upstream_admission())
+
+
+@contextlib.asynccontextmanager
+async def upstream_guard_async():
+    """Как upstream_guard, но место в очереди ожидается без потока"""
+    with contextlib.ExitStack() as stack:
+        await admit_upstream_async(stack)
+        yield
+
+
+def unavailable_result(error):
+    return {"success": False, "error": str(error), "status_code": error.status_code, "retry_after": error.retry_after}
+
+
+# =================== КВОТЫ И СПРАВЕДЛИВАЯ ОЧЕРЕДЬ ===================
+
+# JSON-словарь API-ключей (заголовок X-API-Key), например:
+# {"ci-secret": {"name": "ci", "class": "bulk", "rate": 0.5, "burst": 10},
+#  "kiosk-secret": {"name": "kiosk", "class": "interactive", "weight": 8}}
+# Неизвестные ключи — отдельные потребители класса bulk, браузеры — сессии класса interactive,
+# клиенты без ключа и cookie — потребители класса bulk по адресу и User-Agent
+TENANTS = os.environ.get('TENANTS', '')
+TENANT_RATE = float(os.environ.get('TENANT_RATE', 2))
+TENANT_BURST = float(os.environ.get('TENANT_BURST', 20))
+TENANT_MAX = int(os.environ.get('TENANT_MAX', 10000))
+TENANT_CLASS_WEIGHTS = {
+    'interactive': float(os.environ.get('TENANT_INTERACTIVE_WEIGHT', 4)),
+    'bulk': float(os.environ.get('TENANT_BULK_WEIGHT', 1)),
+}
+FAIR_QUEUE_TIMEOUT = float(os.environ.get('FAIR_QUEUE_TIMEOUT', 10))
+
+
+class TokenBucket:
+    """Ведро токенов: пополняется на rate токенов в секунду, вмещает не больше burst.
+    rate=0 отключает ограничение"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        return min(self.burst, self.tokens + (now - self.updated) * self.rate)
+
+    def take(self, cost=1):
+        """0, если токены списаны, иначе через сколько секунд их станет достаточно"""
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = self._refill(now)
+            self.updated = now
+            # Пакет больше burst иначе не прошел бы никогда
+            cost = min(cost, self.burst)
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return 0
+            return (cost - self.tokens) / self.rate
+
+    def give(self, cost=1):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self._refill(now) + min(cost, self.burst))
+            self.updated = now
+
+    def available(self):
+        with self._lock:
+            return self._refill(time.monotonic()) if self.rate > 0 else self.burst
+
+
+class Tenant:
+    """Потребитель модели: API-ключ, сессия браузера или адрес клиента без сессии"""
+
+    def __init__(self, name, tenant_class='interactive', weight=None, rate=None, burst=None, group=None):
+        self.name = name
+        self.tenant_class = tenant_class
+        self.weight = weight or TENANT_CLASS_WEIGHTS.get(tenant_class, 1.0)
+        self.bucket = TokenBucket(TENANT_RATE if rate is None else rate, TENANT_BURST if burst is None else burst)
+        # Анонимные потребители в статистике объединяются по классу, чтобы не плодить метки
+        self.group = group or name
+        self.requests = 0
+        self.throttled = 0
+        # Счетчики очереди меняет только FairScheduler под своей блокировкой
+        self.admitted = 0
+        self.queued = 0
+        self.wait_time = 0.0
+        self._lock = threading.Lock()
+
+    def charge(self, cost=1):
+        """Списывает токены за запрос; 0 или через сколько секунд повторить"""
+        retry_after = self.bucket.take(cost)
+        with self._lock:
+            self.requests += 1
+            if retry_after:
+                self.throttled += 1
+        return retry_after
+
+    def charge_more(self, cost):
+        """Дополнительные токены за уже учтенный запрос; 0 или через сколько секунд повторить"""
+        retry_after = self.bucket.take(cost)
+        if retry_after:
+            with self._lock:
+                self.throttled += 1
+        return retry_after
+
+    def refund(self, cost=1):
+        """Возвращает токены запроса, который не был выполнен"""
+        self.bucket.give(cost)
+
+
+class TenantRegistry:
+    """Потребители по API-ключу или сессии; анонимные вытесняются по LRU"""
+
+    def __init__(self, config=None, max_size=10000):
+        self.max_size = max_size
+        config = TENANTS if config is None else config
+        self._configured = {}
+        for api_key, options in json.loads(config.strip() or '{}').items():
+            self._configured[api_key] = Tenant(options.get('name') or self.key_name(api_key), options.get('class', 'bulk'),
+                                               options.get('weight'), options.get('rate'), options.get('burst'))
+        # Вызовы вне запроса: тесты, прогрев, служебные задачи
+        self.default = Tenant('default', 'interactive', rate=0)
+        self._anonymous = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_name(api_key):
+        # Сам ключ не должен попадать в статистику и метрики
+        return f"key_{hashlib.sha256(api_key.encode()).hexdigest()[:12]}"
+
+    @staticmethod
+    def client_name(address, agent):
+        # Адрес вместе с User-Agent: разные клиенты за одним NAT или прокси не делят одно ведро
+        digest = hashlib.sha256(f"{address or 'unknown'}|{agent or ''}".encode()).hexdigest()[:12]
+        return f"client_{digest}"
+
+    def resolve(self, api_key=None, session_id=None, address=None, agent=None):
+        if api_key:
+            tenant = self._configured.get(api_key)
+            if tenant is not None:
+                return tenant
+            name, tenant_class = self.key_name(api_key), 'bulk'
+        elif session_id:
+            name, tenant_class = f"session_{session_id}", 'interactive'
+        else:
+            name, tenant_class = self.client_name(address, agent), 'bulk'
+
+        with self._lock:
+            tenant = self._anonymous.get(name)
+            if tenant is None:
+                tenant = self._anonymous[name] = Tenant(name, tenant_class, group=tenant_class)
+                while len(self._anonymous) > self.max_size:
+                    self._anonymous.popitem(last=False)
+            else:
+                self._anonymous.move_to_end(name)
+            return tenant
+
+    def stats(self):
+        """Использование и очередь по настроенным потребителям и классам анонимных"""
+        with self._lock:
+            tenants = list(self._configured.values()) + list(self._anonymous.values()) + [self.default]
+        groups = {}
+        for tenant in tenants:
+            group = groups.setdefault(tenant.group, {
+                "class": tenant.tenant_class, "weight": tenant.weight, "tenants": 0, "requests": 0,
+                "throttled": 0, "admitted": 0, "queued": 0, "wait_time_total": 0.0,
+            })
+            group["tenants"] += 1
+            group["requests"] += tenant.requests
+            group["throttled"] += tenant.throttled
+            group["admitted"] += tenant.admitted
+            group["queued"] += tenant.queued
+            group["wait_time_total"] += tenant.wait_time
+            if tenant.group == tenant.name:
+                group["tokens"] = tenant.bucket.available()
+        return groups
+
+
+class FairScheduler:
+    """Взвешенная справедливая очередь (WFQ) вызовов модели.
+
+    Пока есть свободные места, вызов проходит сразу. Когда Space насыщен,
+    вызов получает виртуальное время окончания start + 1/weight, где start —
+    большее из текущего виртуального времени и окончания предыдущего вызова
+    того же потребителя, и места раздаются по возрастанию этого времени.
+    Поэтому интерактивный класс с большим весом обгоняет пакетный, а один
+    потребитель не может занять всю очередь.
+    """
+
+    def __init__(self, capacity, timeout=10):
+        # Число или функция без аргументов, например текущий адаптивный лимит
+        self._capacity = capacity
+        self.timeout = timeout
+        self.in_flight = 0
+        self.virtual_time = 0.0
+        self.admitted = 0
+        self.queued_total = 0
+        self.timed_out = 0
+        self._finish = {}
+        self._waiting = []
+        self._sequence = 0
+        self._cond = threading.Condition()
+
+    def capacity(self):
+        capacity = self._capacity() if callable(self._capacity) else self._capacity
+        return max(1, int(capacity))
+
+    @contextlib.contextmanager
+    def slot(self, tenant, timeout=None):
+        self.acquire(tenant, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextlib.asynccontextmanager
+    async def slot_async(self, tenant, timeout=None):
+        await self.acquire_async(tenant, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _enter(self, tenant, waiter):
+        """Вызывается под блокировкой: None — вызов допущен сразу, иначе запись в очереди"""
+        start = max(self.virtual_time, self._finish.get(tenant.name, 0.0))
+        finish = start + 1 / tenant.weight
+        self._finish[tenant.name] = finish
+        if not self._waiting and self.in_flight < self.capacity():
+            self._admit(tenant, start, 0.0)
+            return None
+        waiter.update(tenant=tenant, start=start, enqueued=time.monotonic(), granted=False)
+        self._sequence += 1
+        entry = (finish, self._sequence, waiter)
+        heapq.heappush(self._waiting, entry)
+        tenant.queued += 1
+        self.queued_total += 1
+        return entry
+
+    def _give_up(self, entry, timed_out=True):
+        self._waiting.remove(entry)
+        heapq.heapify(self._waiting)
+        entry[2]["tenant"].queued -= 1
+        self.timed_out += timed_out
+        return OverloadedError("Модель перегружена, повторите запрос позже", retry_after=1)
+
+    def acquire(self, tenant, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        with self._cond:
+            waiter = {}
+            entry = self._enter(tenant, waiter)
+            if entry is None:
+                return
+            deadline = waiter["enqueued"] + timeout
+            while not waiter["granted"]:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._give_up(entry)
+                self._cond.wait(remaining)
+
+    async def acquire_async(self, tenant, timeout=None):
+        """Как acquire, но ожидание места не занимает поток"""
+        timeout = self.timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            if not granted.done():
+                granted.set_result(None)
+
+        with self._cond:
+            waiter = {"wake": lambda: loop.call_soon_threadsafe(wake)}
+            entry = self._enter(tenant, waiter)
+            if entry is None:
+                return
+        try:
+            await asyncio.wait_for(granted, timeout)
+        except BaseException as e:
+            with self._cond:
+                if not waiter["granted"]:
+                    timed_out = isinstance(e, asyncio.TimeoutError)
+                    error = self._give_up(entry, timed_out)
+                    if timed_out:
+                        raise error from None
+                    raise
+            # Место выдано одновременно с отменой или таймаутом
+            if not isinstance(e, asyncio.TimeoutError):
+                self.release()
+                raise
+
+    def _admit(self, tenant, start, waited):
+        self.in_flight += 1
+        self.admitted += 1
+        self.virtual_time = max(self.virtual_time, start)
+        tenant.admitted += 1
+        tenant.wait_time += waited
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            granted = False
+            while self._waiting and self.in_flight < self.capacity():
+                _, _, waiter = heapq.heappop(self._waiting)
+                waiter["tenant"].queued -= 1
+                self._admit(waiter["tenant"], waiter["start"], time.monotonic() - waiter["enqueued"])
+                waiter["granted"] = True
+                if "wake" in waiter:
+                    waiter["wake"]()
+                granted = True
+            if granted:
+                self._cond.notify_all()
+            if not self._waiting and (not self.in_flight or len(self._finish) > TENANT_MAX):
+                # Без очереди история потребителей больше не влияет на порядок
+                self._finish.clear()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "capacity": self.capacity(),
+                "in_flight": self.in_flight,
+                "waiting": len(self._waiting),
+                "admitted": self.admitted,
+                "queued_total": self.queued_total,
+                "timed_out": self.timed_out,
+            }
+
+
+tenants = TenantRegistry(max_size=TENANT_MAX)
+# Единственный слой допуска к модели: число мест — текущий адаптивный лимит, сверх него вызовы ждут в очереди
+fair_scheduler = FairScheduler(lambda: upstream_limiter.limit, FAIR_QUEUE_TIMEOUT)
+
+# Потребитель текущего запроса; фоновые задачи и пакеты переносят его в свои потоки
+tenant_context = contextvars.ContextVar('tenant', default=None)
+
+
+def current_tenant():
+    return tenant_context.get() or tenants.default
+
+
+def caller_tenant():
+    """Потребитель запроса, который читает свои данные, по ключу или сессии; None для анонимного клиента.
+
+    Потребитель по адресу и User-Agent не годится: за одним прокси его делят
+    разные клиенты, и они видели бы данные друг друга.
+    """
+    api_key = request.headers.get('X-API-Key', '').strip()
+    session_id = None if api_key else session.get('tenant_id')
+    if not api_key and not session_id:
+        return None
+    return tenants.resolve(api_key, session_id)
+
+
+# Эндпоинты, которые вызывают модель и расходуют квоту
+METERED_ENDPOINTS = {'index', 'analyze_stream_api', 'analyze_batch_api', 'submit_job_api'}
+
+
+def quota_exceeded(retry_after):
+    return error_response('Превышена квота запросов, повторите позже', 429,
+                          {'Retry-After': str(max(1, int(retry_after + 0.999)))})
+
+
+@app.before_request
+def admit_tenant():
+    if request.endpoint not in METERED_ENDPOINTS:
+        return None
+    api_key = request.headers.get('X-API-Key', '').strip()
+    session_id = None
+    new_session = False
+    if not api_key:
+        session_id = session.get('tenant_id')
+        if session_id is None:
+            # Браузер получает сессию с первой страницей или с этим ответом и сразу учитывается по ней
+            session_id = session['tenant_id'] = uuid.uuid4().hex
+            new_session = True
+    if request.method != 'POST':
+        return None
+
+    tenant = tenants.resolve(api_key, session_id)
+    tenant_context.set(tenant)
+    # Один токен до разбора тела: потребитель сверх квоты не заставляет принимать загрузку.
+    # Остальные изображения пакета списываются в analyze_batch_api, когда файлы уже разобраны
+    retry_after = tenant.charge()
+    if not retry_after and new_session:
+        # Клиент, не возвращающий cookie, на каждый запрос получал бы новую сессию с полным ведром,
+        # поэтому запрос без сессии списывается и с ведра клиента по адресу и User-Agent
+        retry_after = tenants.resolve(address=request.remote_addr, agent=request.user_agent.string).charge()
+        if retry_after:
+            tenant.refund()
+    if retry_after:
+        return quota_exceeded(retry_after)
+    return None
+
+
+# =================== МАРШРУТИЗАЦИЯ ПО БЭКЕНДАМ ===================
+
+# JSON-список бэкендов, например:
+# [{"name": "amd", "src": "amd/llama4-maverick-17b-128e-mi-amd"},
+#  {"name": "local", "src": "http://127.0.0.1:7860/", "params": {"param_3": 1024}, "param_names": {"param_2": "system"}}]
+# Пусто — один бэкенд GRADIO_SRC с общим пулом client_pool
+GRADIO_BACKENDS = os.environ.get('GRADIO_BACKENDS', '')
+BACKEND_EWMA_ALPHA = float(os.environ.get('BACKEND_EWMA_ALPHA', 0.3))
+BACKEND_INITIAL_LATENCY = float(os.environ.get('BACKEND_INITIAL_LATENCY', 1.0))
+
+
+class Backend:
+    """Один Space или Gradio-приложение с /chat.
+
+    Хранит свой пул клиентов, размыкатель и сглаженную (EWMA) задержку.
+    params переопределяют значения параметров генерации, param_names
+    переименовывают их под API конкретного приложения.
+    """
+
+    def __init__(self, name='default', src=None, api_name='/chat', params=None, param_names=None, weight=1.0,
+                 pool=None, breaker=None, ewma_alpha=0.3, initial_latency=1.0):
+        self.name = name
+        self.src = src
+        self.api_name = api_name
+        self.params = params or {}
+        self.param_names = param_names or {}
+        self.weight = weight
+        self._pool = pool
+        self.breaker = breaker or CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+        self.ewma_alpha = ewma_alpha
+        self.latency = None
+        self.initial_latency = initial_latency
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self._cancelled = set()
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        # Бэкенд по умолчанию работает через общий client_pool
+        return self._pool or client_pool
+
+    def chat_params(self, params):
+        merged = dict(params, **self.params)
+        # Стоп-строки профиля обрабатываются на нашей стороне, у /chat такого параметра нет
+        return {self.param_names.get(key, key): value for key, value in merged.items() if key != 'stop'}
+
+    def available(self):
+        return self.breaker.available()
+
+    def score(self):
+        """Ожидаемая задержка с учетом очереди: меньше — лучше"""
+        with self._lock:
+            latency = self.initial_latency if self.latency is None else self.latency
+            return latency * (self.in_flight + 1) / self.weight
+
+    @contextlib.contextmanager
+    def use(self, timeout=None):
+        """Клиент бэкенда на время вызова; учитывает задержку, ошибки и вызовы в работе"""
+        self.breaker.allow()
+        with contextlib.ExitStack() as stack:
+            try:
+                # Ожидание свободного клиента или создание нового при холодном старте
+                with span('client.acquire', backend=self.name):
+                    client = stack.enter_context(self.pool.acquire(timeout))
+            except BaseException:
+                # Нет свободного клиента — это не сбой бэкенда
+                self.breaker.record_cancelled()
+                raise
+            with self._lock:
+                self.in_flight += 1
+                self.requests += 1
+            started = time.monotonic()
+            ok = None
+            try:
+                yield client
+                ok = True
+            except Exception:
+                ok = False
+                raise
+            finally:
+                with self._lock:
+                    if id(client) in self._cancelled:
+                        self._cancelled.discard(id(client))
+                        ok = None
+                self._finish(time.monotonic() - started, ok)
+
+    def cancel(self, client):
+        """Отмечает вызов, идущий на client, как отмененный (проигравший хедж).
+
+        use() не засчитает его ни успехом, ни сбоем и не возьмет его неполную
+        задержку в EWMA; клиент занят вызовом целиком, поэтому метка однозначна.
+        """
+        with self._lock:
+            self._cancelled.add(id(client))
+
+    def _finish(self, elapsed, ok):
+        with self._lock:
+            self.in_flight -= 1
+            if ok is not None:
+                # Ошибка тоже обновляет задержку: медленный отказ должен отталкивать трафик
+                self.latency = elapsed if self.latency is None else (
+                    self.ewma_alpha * elapsed + (1 - self.ewma_alpha) * self.latency)
+            if ok is False:
+                self.errors += 1
+        if ok:
+            self.breaker.record_success()
+        elif ok is False:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_cancelled()
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "src": self.src or GRADIO_SRC,
+                "latency_ewma": self.latency,
+                "in_flight": self.in_flight,
+                "requests": self.requests,
+                "errors": self.errors,
+                "weight": self.weight,
+            }
+        breaker = self.breaker.stats()
+        stats.update(state=breaker["state"], open=breaker["open"], healthy=int(self.available()))
+        return stats
+
+
+class BackendRouter:
+    """Выбирает бэкенд с наименьшей ожидаемой задержкой и переключается на следующий при ошибке"""
+
+    def __init__(self, backends):
+        self.backends = list(backends)
+        self.fallbacks = 0
+
+    def ranked(self, exclude=()):
+        candidates = [backend for backend in self.backends if backend not in exclude and backend.available()]
+        return sorted(candidates, key=lambda backend: backend.score())
+
+    def choose(self, exclude=()):
+        """Лучший доступный бэкенд; если все исключены, подойдет и исключенный"""
+        ranked = self.ranked(exclude) or self.ranked()
+        if not ranked:
+            raise CircuitOpenError("Все бэкенды модели временно недоступны, повторите запрос позже",
+                                   retry_after=max(1, int(BREAKER_RESET_TIMEOUT)))
+        return ranked[0]
+
+    def call(self, fn, timeout=None):
+        """Вызывает fn(backend, client) на лучшем бэкенде, при ошибке — на следующем"""
+        errors = []
+        for backend in self.ranked():
+            try:
+                with backend.use(timeout) as client:
+                    result = fn(backend, client)
+            except CircuitOpenError:
+                continue
+            except Exception as e:
+                errors.append(e)
+                continue
+            if errors:
+                self.fallbacks += 1
+            return result
+        if errors:
+            raise errors[0]
+        raise CircuitOpenError("Все бэкенды модели временно недоступны, повторите запрос позже",
+                               retry_after=max(1, int(BREAKER_RESET_TIMEOUT)))
+
+    def warm_up(self):
+        for backend in self.backends:
+            backend.pool.warm_up()
+
+    def start_health_checks(self, interval):
+        for backend in self.backends:
+            backend.pool.start_health_checks(interval)
+
+    def stats(self):
+        return {backend.name: backend.stats() for backend in self.backends}
+
+
+def load_backends(config=None):
+    """Бэкенды из GRADIO_BACKENDS; без настройки — один бэкенд по умолчанию"""
+    config = GRADIO_BACKENDS if config is None else config
+    if not config.strip():
+        return [Backend(ewma_alpha=BACKEND_EWMA_ALPHA, initial_latency=BACKEND_INITIAL_LATENCY)]
+
+    backends = []
+    for i, item in enumerate(json.loads(config)):
+        if isinstance(item, str):
+            item = {"src": item}
+        src = item["src"]
+        backends.append(Backend(
+            name=item.get("name", f"backend{i}"),
+            src=src,
+            api_name=item.get("api_name", "/chat"),
+            params=item.get("params"),
+            param_names=item.get("param_names"),
+            weight=float(item.get("weight", 1.0)),
+            pool=ClientPool(int(item.get("pool_size", CLIENT_POOL_SIZE)), factory=lambda src=src: get_client(src),
+                            acquire_timeout=CLIENT_POOL_TIMEOUT),
+            ewma_alpha=BACKEND_EWMA_ALPHA,
+            initial_latency=BACKEND_INITIAL_LATENCY,
+        ))
+    return backends
+
+
+router = BackendRouter(load_backends())
+
+
+# =================== ПРОФИЛИ ГЕНЕРАЦИИ ===================
+
+# Бюджет генерации под тип вопроса: короткому ответу не нужны 2048 токенов.
+# system уходит в param_2, max_tokens — в param_3, temperature — в param_4.
+# stop — строки, на которых ответ обрезается: /chat их не поддерживает,
+# поэтому генерация отменяется на нашей стороне, как только стоп-строка пришла.
+BUILTIN_PROFILES = {
+    "tag": {
+        "description": "Тег — одно-три слова",
+        "system": "Answer with one to three words in the language of the question. No explanations.",
+        "max_tokens": 24,
+        "temperature": 0.0,
+        "stop": ["\n"],
+    },
+    "caption": {
+        "description": "Подпись — одно предложение",
+        "system": "Answer with one short sentence in the language of the question.",
+        "max_tokens": 96,
+        "temperature": 0.3,
+        "stop": ["\n\n"],
+    },
+    "describe": {
+        "description": "Описание — подробный ответ",
+        "system": DEFAULT_PARAMS["param_2"],
+        "max_tokens": DEFAULT_PARAMS["param_3"],
+        "temperature": DEFAULT_PARAMS["param_4"],
+        "stop": [],
+    },
+}
+# JSON-словарь, дополняющий и переопределяющий встроенные профили, например
+# {"tag": {"max_tokens": 16}, "ocr": {"description": "Текст", "system": "Transcribe the text.", "max_tokens": 512}}
+GENERATION_PROFILES = os.environ.get('GENERATION_PROFILES', '')
+DEFAULT_PROFILE = os.environ.get('DEFAULT_PROFILE', 'describe')
+
+
+class UnknownProfileError(ValueError):
+    pass
+
+
+def load_profiles(config=None):
+    """Встроенные профили с настройками из GENERATION_PROFILES; новые профили наследуют describe"""
+    config = GENERATION_PROFILES if config is None else config
+    profiles = {name: dict(profile) for name, profile in BUILTIN_PROFILES.items()}
+    if config.strip():
+        for name, item in json.loads(config).items():
+            profiles[name] = dict(profiles.get(name, BUILTIN_PROFILES["describe"]), **item)
+    for profile in profiles.values():
+        profile["max_tokens"] = int(profile["max_tokens"])
+        profile["temperature"] = float(profile["temperature"])
+        profile["stop"] = [stop for stop in profile.get("stop") or [] if stop]
+    return profiles
+
+
+generation_profiles = load_profiles()
+
+
+def resolve_profile(name=None):
+    """Имя профиля из запроса; пустое значение — профиль по умолчанию"""
+    name = (name or '').strip() or DEFAULT_PROFILE
+    if name not in generation_profiles:
+        raise UnknownProfileError(f"Неизвестный профиль генерации: {name}")
+    return name
+
+
+def profile_params(name):
+    """Параметры /chat для профиля.
+
+    Стоп-строки лежат в тех же параметрах, чтобы профили с разными стопами
+    не делили кэш, но в Space не передаются (см. Backend.chat_params).
+    """
+    profile = generation_profiles[name]
+    params = dict(DEFAULT_PARAMS, param_2=profile["system"], param_3=profile["max_tokens"],
+                  param_4=profile["temperature"])
+    if profile["stop"]:
+        params["stop"] = list(profile["stop"])
+    return params
+
+
+def cut_at_stop(text, stop):
+    """(текст до первой стоп-строки, найдена ли она); пробелы в начале ответа стопом не считаются"""
+    if not isinstance(text, str) or not stop:
+        return text, False
+    start = len(text) - len(text.lstrip())
+    positions = [position for position in (text.find(s, start) for s in stop) if position != -1]
+    if not positions:
+        return text, False
+    return text[:min(positions)], True
+
+
+class ProfileStats:
+    """Задержка модели и длина ответов по профилям — по ним подбираются бюджеты.
+
+    Учитываются только вызовы модели: ответы из кэша бюджет генерации не тратят.
+    Перцентили считаются по последним window ответам профиля.
+    """
+
+    def __init__(self, window=500):
+        self.window = window
+        self._lock = threading.Lock()
+        self._profiles = {}
+
+    def record(self, profile, latency, output):
+        text = '' if output is None else str(output)
+        with self._lock:
+            entry = self._profiles.get(profile)
+            if entry is None:
+                entry = self._profiles[profile] = {
+                    "requests": 0, "latency_total": 0.0, "output_chars_total": 0, "output_words_total": 0,
+                    "latency": LatencyWindow(self.window), "words": LatencyWindow(self.window),
+                }
+            entry["requests"] += 1
+            entry["latency_total"] += latency
+            entry["output_chars_total"] += len(text)
+            entry["output_words_total"] += len(text.split())
+        entry["latency"].add(latency)
+        entry["words"].add(len(text.split()))
+
+    def stats(self):
+        with self._lock:
+            entries = dict(self._profiles)
+        result = {}
+        for name, entry in entries.items():
+            result[name] = {
+                "requests": entry["requests"],
+                "latency_total": entry["latency_total"],
+                "output_chars_total": entry["output_chars_total"],
+                "output_words_total": entry["output_words_total"],
+                "latency_p50": entry["latency"].percentile(0.5),
+                "latency_p95": entry["latency"].percentile(0.95),
+                "output_words_p50": entry["words"].percentile(0.5),
+                "output_words_p95": entry["words"].percentile(0.95),
+            }
+        return result
+
+
+profile_stats = ProfileStats()
+
+
+# =================== ПОВТОРЫ И ХЕДЖИРОВАНИЕ ===================
+
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 3))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 0.5))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 8))
+RETRY_BUDGET_RATIO = float(os.environ.get('RETRY_BUDGET_RATIO', 0.1))
+RETRY_BUDGET_RESERVE = float(os.environ.get('RETRY_BUDGET_RESERVE', 10))
+HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', '0') == '1'
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 0.95))
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 1.0))
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', 20))
+HEDGE_BUDGET_RATIO = float(os.environ.get('HEDGE_BUDGET_RATIO', 0.05))
+HEDGE_BUDGET_RESERVE = float(os.environ.get('HEDGE_BUDGET_RESERVE', 5))
+
+
+class RetryBudget:
+    """Бюджет дополнительных попыток.
+
+    Каждый запрос пополняет бюджет на ratio токенов (не больше reserve),
+    каждая дополнительная попытка тратит один токен. Так повторы и хеджи
+    не могут добавить к нагрузке на Space больше доли ratio.
+    """
+
+    def __init__(self, ratio=0.1, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = reserve
+        self.spent = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def try_spend(self):
+        with self._lock:
+            if self.tokens < 1:
+                self.rejected += 1
+                return False
+            self.tokens -= 1
+            self.spent += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {"tokens": self.tokens, "spent": self.spent, "rejected": self.rejected}
+
+
+class LatencyWindow:
+    """Скользящее окно задержек последних вызовов для расчета перцентилей"""
+
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction, min_samples=1):
+        with self._lock:
+            if len(self._samples) < max(1, min_samples):
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_RESERVE)
+hedge_budget = RetryBudget(HEDGE_BUDGET_RATIO, HEDGE_BUDGET_RESERVE)
+upstream_latency = LatencyWindow()
+
+
+def is_transient_error(error):
+    """Повторять имеет смысл только сетевые сбои: ошибку модели повтор не исправит"""
+    return is_broken_client_error(error)
+
+
+def retry_delay(attempt, base=None, cap=None):
+    """Экспоненциальная пауза со случайным разбросом (full jitter)"""
+    base = RETRY_BASE_DELAY if base is None else base
+    cap = RETRY_MAX_DELAY if cap is None else cap
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def chat_message(prompt, files):
+    return {"text": prompt, "files": files}
+
+
+def as_paths(image_path):
+    """Путь к изображению или список путей — всегда список"""
+    return [image_path] if isinstance(image_path, str) else list(image_path)
+
+
+def predict_once(upload_files, prompt, params, hashes=None):
+    """Одна попытка вызова /chat; при ошибке бэкенда маршрутизатор пробует следующий"""
+    def send(backend, client, files):
+        message = chat_message(prompt, files)
+        stop = params.get('stop')
+        if not tracing() and not stop:
+            return client.predict(message=message, **backend.chat_params(params), api_name=backend.api_name)
+        # predict() — это submit().result(); задача нужна, чтобы разложить время по этапам Space
+        # и чтобы отменить генерацию, как только ответ дошел до стоп-строки
+        submitted = time.time()
+        job = client.submit(message=message, **backend.chat_params(params), api_name=backend.api_name)
+        try:
+            if stop:
+                for output in job:
+                    text, stopped = cut_at_stop(output, stop)
+                    if stopped:
+                        job.cancel()
+                        return text
+            return cut_at_stop(job.result(), stop)[0]
+        finally:
+            record_space_phases(job, submitted)
+
+    def predict(backend, client):
+        with span('model.attempt', backend=backend.name), metrics.upstream_in_flight.track(), \
+                metrics.predict.time():
+            files, reused = space_files(backend, client, upload_files, hashes)
+            try:
+                return send(backend, client, files)
+            except Exception:
+                if not reused:
+                    raise
+                # Ошибка могла быть из-за удаленных в Space файлов: загружаем их заново и пробуем еще раз
+                forget_space_files(reused)
+                metrics.upstream_attempts.inc('reupload')
+                return send(backend, client, space_files(backend, client, upload_files, hashes)[0])
+
+    started = time.monotonic()
+    result = router.call(predict)
+    upstream_latency.add(time.monotonic() - started)
+    return result
+
+
+def job_future(job):
+    """Job из gradio_client оборачивает Future, а wait() возвращает именно внутренний объект"""
+    return getattr(job, 'future', job)
+
+
+def first_result(jobs):
+    """Результат первой успешно завершившейся задачи и ее индекс"""
+    futures = [job_future(job) for job in jobs]
+    pending = list(futures)
+    first_error = None
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+            error = future.exception()
+            if error is None:
+                return future.result(), futures.index(future)
+            first_error = first_error or error
+    raise first_error
+
+
+def hedged_predict(upload_files, prompt, params, hashes=None):
+    """Вызов /chat с хеджированием.
+
+    Если первая попытка не ответила за перцентиль HEDGE_PERCENTILE
+    недавних задержек, отправляется вторая — по возможности на другом
+    бэкенде; берется ответ, пришедший первым, проигравшая задача отменяется
+    и не учитывается в статистике своего бэкенда. Если обе попытки
+    завершились ошибкой, маршрутизатор переходит к следующему бэкенду,
+    как и без хеджирования.
+    """
+    delay = upstream_latency.percentile(HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+
+    def predict(backend, client):
+        attempts = [(backend, client)]
+        jobs = []
+        submitted = []
+        reused = []
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(metrics.upstream_in_flight.track())
+            started = time.monotonic()
+            try:
+                files, reused_files = space_files(backend, client, upload_files, hashes)
+                reused.extend(reused_files)
+                submitted.append(time.time())
+                jobs.append(client.submit(message=chat_message(prompt, files), **backend.chat_params(params),
+                                          api_name=backend.api_name))
+                if delay is not None:
+                    done, _ = wait([job_future(jobs[0])], timeout=max(delay, HEDGE_MIN_DELAY))
+                    # Свободного клиента не ждем: хедж имеет смысл только сразу
+                    if not done and hedge_budget.try_spend():
+                        hedge_backend = router.choose(exclude=(backend,))
+                        try:
+                            hedge_client = stack.enter_context(hedge_backend.use(timeout=0))
+                        except (PoolTimeoutError, CircuitOpenError):
+                            hedge_client = None
+                        if hedge_client is not None:
+                            attempts.append((hedge_backend, hedge_client))
+                            metrics.upstream_attempts.inc('hedge')
+                            files, reused_files = space_files(hedge_backend, hedge_client, upload_files, hashes)
+                            reused.extend(reused_files)
+                            submitted.append(time.time())
+                            jobs.append(hedge_client.submit(message=chat_message(prompt, files),
+                                                            **hedge_backend.chat_params(params),
+                                                            api_name=hedge_backend.api_name))
+                            stack.enter_context(metrics.upstream_in_flight.track())
+
+                result, winner = first_result(jobs)
+                record_space_phases(jobs[winner], submitted[winner])
+            except Exception:
+                forget_space_files(reused)
+                raise
+            finally:
+                for (attempt_backend, attempt_client), job in zip(attempts, jobs):
+                    if not job.done():
+                        job.cancel()
+                        attempt_backend.cancel(attempt_client)
+
+        elapsed = time.monotonic() - started
+        metrics.predict.observe(elapsed)
+        upstream_latency.add(elapsed)
+        if winner:
+            metrics.hedge_wins.inc()
+        return result
+
+    # Хедж ждет завершения задач целиком, поэтому стоп-строки применяются к готовому ответу
+    return cut_at_stop(router.call(predict), params.get('stop'))[0]
+
+
+def predict_with_retries(upload_files, prompt, params):
+    """Вызов /chat с повторами сетевых сбоев в пределах бюджета"""
+    retry_budget.record_request()
+    hedge_budget.record_request()
+    metrics.upstream_attempts.inc('primary')
+    hashes = upload_hashes(upload_files)
+    attempt = 1
+    while True:
+        # Повтор после истечения срока вызова никому не нужен
+        check_deadline()
+        try:
+            if HEDGE_ENABLED:
+                return hedged_predict(upload_files, prompt, params, hashes)
+            return predict_once(upload_files, prompt, params, hashes)
+        except Exception as e:
+            if attempt >= RETRY_MAX_ATTEMPTS or not is_transient_error(e) or not retry_budget.try_spend():
+                raise
+        time.sleep(retry_delay(attempt))
+        attempt += 1
+        metrics.upstream_attempts.inc('retry')
+
+
+class SingleFlight:
+    """Объединение одинаковых одновременных вызовов.
+
+    Первый вызов с ключом выполняет функцию, остальные ждут и получают
+    тот же результат или то же исключение. Синхронные и асинхронные вызовы
+    с одним ключом объединяются друг с другом.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def _join(self, key):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                return call, False
+            call = self._calls[key] = Future()
+            self.executed += 1
+            return call, True
+
+    def _finish(self, key, call, result=None, error=None):
+        with self._lock:
+            del self._calls[key]
+        if error is not None:
+            call.set_exception(error)
+        else:
+            call.set_result(result)
+
+    def do(self, key, fn):
+        call, leader = self._join(key)
+        if not leader:
+            with span('coalesced.wait'):
+                return call.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, call, error=e)
+            raise
+        self._finish(key, call, result)
+        return result
+
+    async def do_async(self, key, fn):
+        """Как do, но fn возвращает корутину, а ожидание не занимает поток"""
+        call, leader = self._join(key)
+        if not leader:
+            with span('coalesced.wait'):
+                return await asyncio.wrap_future(call)
+        try:
+            result = await fn()
+        except BaseException as e:
+            self._finish(key, call, error=e)
+            raise
+        self._finish(key, call, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"executed": self.executed, "coalesced": self.coalesced, "in_flight": len(self._calls)}
+
+
+single_flight = SingleFlight()
+
+
+def predict_prepared(image_paths, prompt, params):
+    with contextlib.ExitStack() as stack:
+        with span('preprocess', images=len(image_paths)):
+            upload_files = stack.enter_context(prepared_images(image_paths))
+        with span('model.call'):
+            return predict_with_retries(upload_files, prompt, params)
+
+
+def model_success(result, image_paths, prompt, params, latency, cache_key=None, near_key=None, profile=None):
+    remember_result(cache_key, near_key, result)
+    record_history(image_paths, prompt, params, result, latency)
+    profile_stats.record(profile or DEFAULT_PROFILE, latency, result)
+    metrics.analyses.inc('success')
+    return {"success": True, "result": result}
+
+
+def model_error(error):
+    metrics.errors.inc(type(error).__name__)
+    if isinstance(error, UpstreamUnavailableError):
+        metrics.analyses.inc('shed')
+        return unavailable_result(error)
+    metrics.analyses.inc('error')
+    return {"success": False, "error": str(error)}
+
+
+def call_model(image_paths, prompt, params, cache_key=None, near_key=None, profile=None):
+    try:
+        with upstream_guard():
+            started = time.monotonic()
+            result = predict_prepared(image_paths, prompt, params)
+            latency = time.monotonic() - started
+        return model_success(result, image_paths, prompt, params, latency, cache_key, near_key, profile)
+    except Exception as e:
+        return model_error(e)
+
+
+def analyze_image(image_path, prompt, profile=None):
+    """Анализ одного изображения или нескольких (список путей) за один вызов /chat.
+
+    profile — имя профиля генерации; по умолчанию DEFAULT_PROFILE.
+    """
+    image_paths = as_paths(image_path)
+    profile = resolve_profile(profile)
+    params = profile_params(profile)
+    with span('cache.lookup') as attributes:
+        hit, cached_result, cache_key, near_key = lookup_result(image_paths, prompt, params)
+        attributes["hit"] = hit
+    if hit:
+        return {"success": True, "result": cached_result}
+
+    if not cache_key:
+        return call_model(image_paths, prompt, params, near_key=near_key, profile=profile)
+
+    # Одинаковые запросы, пришедшие одновременно, делят один вызов модели
+    return single_flight.do(cache_key, lambda: call_model(image_paths, prompt, params, cache_key, near_key, profile))
+
+
+@functools.lru_cache(maxsize=None)
+def upstream_executor():
+    # Одновременных вызовов модели не больше адаптивного лимита, поэтому потоков хватает всегда
+    return ThreadPoolExecutor(max_workers=max(1, int(LIMITER_MAX)), thread_name_prefix='upstream')
+
+
+async def call_model_async(image_paths, prompt, params, cache_key=None, near_key=None, profile=None):
+    loop = asyncio.get_running_loop()
+    try:
+        # Очередь к модели ожидается без потока, поток занят только на время самого вызова Space
+        async with upstream_guard_async():
+            started = time.monotonic()
+            # run_in_executor не переносит contextvars, а без них спаны вызова потеряют трассу
+            result = await loop.run_in_executor(upstream_executor(), contextvars.copy_context().run,
+                                                predict_prepared, image_paths, prompt, params)
+            latency = time.monotonic() - started
+        # Историю записываем от имени потребителя запроса, поэтому тоже в его контексте
+        return await loop.run_in_executor(None, contextvars.copy_context().run, model_success, result, image_paths,
+                                          prompt, params, latency, cache_key, near_key, profile)
+    except Exception as e:
+        return model_error(e)
+
+
+async def analyze_image_async(image_path, prompt, profile=None):
+    """То же, что analyze_image, но для цикла asyncio"""
+    image_paths = as_paths(image_path)
+    profile = resolve_profile(profile)
+    params = profile_params(profile)
+    loop = asyncio.get_running_loop()
+    with span('cache.lookup') as attributes:
+        hit, cached_result, cache_key, near_key = await loop.run_in_executor(None, lookup_result, image_paths,
+                                                                             prompt, params)
+        attributes["hit"] = hit
+    if hit:
+        return {"success": True, "result": cached_result}
+
+    if not cache_key:
+        return await call_model_async(image_paths, prompt, params, near_key=near_key, profile=profile)
+
+    return await single_flight.do_async(
+        cache_key, lambda: call_model_async(image_paths, prompt, params, cache_key, near_key, profile))
+
+
+def stream_analyze_image(image_path, prompt, profile=None):
+    """Потоковый анализ изображения.
+
+    image_path — путь к изображению или список путей, profile — профиль генерации.
+    Генерирует события (тип, текст): "delta" — новый фрагмент ответа,
+    "replace" — полный текст, если модель переписала начало ответа,
+    "done" — итоговый текст, "error" — сообщение об ошибке.
+    """
+    try:
+        events = open_stream(image_path, prompt, profile)
+    except UpstreamUnavailableError as e:
+        yield "error", str(e)
+        return
+    try:
+        yield from events
+    finally:
+        events.close()
+
+
+def cached_stream(result):
+    """Поток из готового результата кэша: модель не вызывается"""
+    yield "delta", str(result)
+    yield "done", str(result)
+
+
+class AdmittedStream:
+    """События потока, уже допущенного к модели.
+
+    Место в очереди к модели занято с момента open_stream; close()
+    освобождает его, даже если поток так и не начали читать.
+    """
+
+    def __init__(self, guard, events):
+        self._guard = guard
+        self._events = events
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._events)
+
+    def close(self):
+        # Начатый генератор сам закрывает guard; повторное закрытие ExitStack ничего не делает
+        self._events.close()
+        self._guard.close()
+
+
+def open_stream(image_path, prompt, profile=None):
+    """Поиск в кэше и допуск к модели до начала потока.
+
+    Возвращает итератор событий stream_analyze_image с методом close().
+    Если модель перегружена или размыкатель открыт, сразу выбрасывает
+    UpstreamUnavailableError, чтобы ответить 429/503 до заголовков потока.
+    """
+    image_paths = as_paths(image_path)
+    profile = resolve_profile(profile)
+    params = profile_params(profile)
+    with span('cache.lookup') as attributes:
+        hit, cached_result, cache_key, near_key = lookup_result(image_paths, prompt, params)
+        attributes["hit"] = hit
+    if hit:
+        return cached_stream(cached_result)
+
+    guard = contextlib.ExitStack()
+    try:
+        guard.enter_context(upstream_guard())
+    except Exception as e:
+        model_error(e)
+        raise
+    return AdmittedStream(guard, stream_events(guard, image_paths, prompt, params, profile, cache_key, near_key))
+
+
+async def open_stream_async(image_path, prompt, profile=None):
+    """То же, что open_stream, но место в очереди к модели ожидается без потока.
+
+    Сами события читаются синхронно: их нужно забирать в пуле потоков.
+    """
+    image_paths = as_paths(image_path)
+    profile = resolve_profile(profile)
+    params = profile_params(profile)
+    loop = asyncio.get_running_loop()
+    with span('cache.lookup') as attributes:
+        hit, cached_result, cache_key, near_key = await loop.run_in_executor(None, lookup_result, image_paths,
+                                                                             prompt, params)
+        attributes["hit"] = hit
+    if hit:
+        return cached_stream(cached_result)
+
+    guard = contextlib.ExitStack()
+    try:
+        await admit_upstream_async(guard)
+    except Exception as e:
+        guard.close()
+        model_error(e)
+        raise
+    except BaseException:
+        guard.close()
+        raise
+    return AdmittedStream(guard, stream_events(guard, image_paths, prompt, params, profile, cache_key, near_key))
+
+
+def stream_events(guard, image_paths, prompt, params, profile, cache_key, near_key):
+    """Вызов модели для потока, допущенного в open_stream; guard закрывается вместе с генератором"""
+    stop = params.get('stop')
+    job = None
+    reused = []
+    try:
+        with guard, prepared_images(image_paths) as upload_files:
+            hashes = upload_hashes(upload_files)
+            # Начатый поток нельзя перенести на другой бэкенд, поэтому выбираем один заранее
+            backend = router.choose()
+            with backend.use() as client, metrics.upstream_in_flight.track(), metrics.predict.time():
+                started = time.monotonic()
+                files, reused = space_files(backend, client, upload_files, hashes)
+                submitted = time.time()
+                job = client.submit(message=chat_message(prompt, files), **backend.chat_params(params),
+                                    api_name=backend.api_name)
+
+                # /chat отдает накопленный текст целиком, клиенту пересылаем только прирост
+                text = ""
+                stopped = False
+                for output in job:
+                    if not isinstance(output, str):
+                        continue
+                    output, stopped = cut_at_stop(output, stop)
+                    if output != text:
+                        if output.startswith(text):
+                            yield "delta", output[len(text):]
+                        else:
+                            yield "replace", output
+                        text = output
+                    if stopped:
+                        # Ответ дошел до стоп-строки: остаток генерации отменяется в finally
+                        break
+
+                final = text if stopped else cut_at_stop(job.result(), stop)[0]
+                latency = time.monotonic() - started
+                record_space_phases(job, submitted)
+        if isinstance(final, str) and final != text:
+            if final.startswith(text):
+                yield "delta", final[len(text):]
+            else:
+                yield "replace", final
+        model_success(final, image_paths, prompt, params, latency, cache_key, near_key, profile)
+        yield "done", "" if final is None else str(final)
+    except Exception as e:
+        forget_space_files(reused)
+        yield "error", model_error(e)["error"]
+    finally:
+        # Клиент отключился или произошла ошибка — отменяем задачу на стороне Space
+        if job is not None and not job.done():
+            job.cancel()
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# Стили и скрипт главной страницы отдаются отдельными файлами (/assets/), чтобы браузер их кэшировал
+PAGE_CSS = """\
+body { font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; background-color: #f5f5f5; }
+.container { background-color: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
+h1 { color: #333; text-align: center; margin-bottom: 30px; }
+.form-group { margin-bottom: 20px; }
+label { display: block; margin-bottom: 5px; font-weight: bold; }
+input[type="file"], input[type="text"], select { width: 100%; padding: 10px; border: 1px solid #ddd; border-radius: 5px; }
+input[type="text"] { margin-bottom: 10px; }
+button { background-color: #4CAF50; color: white; padding: 12px 30px; border: none; border-radius: 5px; cursor: pointer; font-size: 16px; }
+button:hover { background-color: #45a049; }
+.result { margin-top: 20px; padding: 15px; border-radius: 5px; }
+.success { background-color: #d4edda; border: 1px solid #c3e6cb; color: #155724; }
+.error { background-color: #f8d7da; border: 1px solid #f5c6cb; color: #721c24; }
+.loading { background-color: #cce5ff; border: 1px solid #99ccff; color: #004085; }
+.upload-area { border: 2px dashed #ccc; padding: 20px; text-align: center; border-radius: 5px; }
+.upload-area:hover { border-color: #999; }
+.test-btn { background-color: #007bff; margin-top: 10px; }
+.test-btn:hover { background-color: #0056b3; }
+.inline-label { display: inline; font-weight: normal; }
+.stream-text { white-space: pre-wrap; }
+"""
+
+PAGE_JS = r"""
+// Показать имена файлов после выбора
+document.getElementById('image').addEventListener('change', function(e) {
+    const names = Array.from(e.target.files).map(file => file.name);
+    if (names.length) {
+        const uploadArea = document.querySelector('.upload-area p');
+        uploadArea.textContent = names.length === 1 ? `Выбран файл: ${names[0]}` : `Выбраны файлы: ${names.join(', ')}`;
+    }
+});
+// Чтение потока Server-Sent Events из ответа fetch
+function readEvents(response, handleEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    function pump() {
+        return reader.read().then(({done, value}) => {
+            if (done) {
+                return;
+            }
+            buffer += decoder.decode(value, {stream: true});
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const chunk = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                let event = 'message';
+                let data = '';
+                chunk.split('\n').forEach(line => {
+                    if (line.startsWith('event: ')) event = line.slice(7);
+                    else if (line.startsWith('data: ')) data += line.slice(6);
+                });
+                handleEvent(event, JSON.parse(data));
+            }
+            return pump();
+        });
+    }
+    return pump();
+}
+// Потоковый вывод ответа модели через Server-Sent Events
+document.querySelector('form').addEventListener('submit', function(e) {
+    if (!document.getElementById('stream').checked || !window.ReadableStream || !window.TextDecoder) {
+        return;
+    }
+    e.preventDefault();
+    const form = this;
+    const button = form.querySelector('button[type="submit"]');
+    const container = document.getElementById('stream-result');
+    container.innerHTML = `<div class='result loading'><strong>Результат анализа:</strong><br><span class='stream-text'></span></div>`;
+    const box = container.firstElementChild;
+    const output = box.querySelector('.stream-text');
+    button.disabled = true;
+
+    function handleEvent(event, data) {
+        if (event === 'delta') {
+            output.textContent += data.text;
+        } else if (event === 'replace') {
+            output.textContent = data.text;
+        } else if (event === 'done') {
+            output.textContent = data.text;
+            box.className = 'result success';
+        } else if (event === 'error') {
+            box.className = 'result error';
+            box.textContent = `Ошибка анализа: ${data.text}`;
+        }
+    }
 
+    fetch('/analyze_stream', {method: 'POST', body: new FormData(form)})
+        .then(response => {
+            if (!response.ok) {
+                return response.json().then(data => handleEvent('error', {text: data.error}));
+            }
+            return readEvents(response, handleEvent);
+        })
+        .catch(() => handleEvent('error', {text: 'соединение прервано'}))
+        .finally(() => { button.disabled = false; });
+});
+// Кнопка запуска тестов: вывод pytest приходит построчно
+document.getElementById('run-tests-btn').addEventListener('click', function() {
+    const btn = this;
+    const container = document.getElementById('test-result');
+    btn.disabled = true;
+    btn.textContent = '⏳ Тесты выполняются...';
+    container.innerHTML = `<div class='result loading'><span class='stream-text'></span></div>`;
+    const box = container.firstElementChild;
+    const output = box.querySelector('.stream-text');
 
-def analyze_image(image_path, prompt):
-    try:
-        client = get_or_create_client()
-        result = client.predict(
-            message={"text": prompt, "files": [handle_file(image_path)]},
-            param_2="",
-            param_3=2048,
-            param_4=0.3,
-            param_5=0,
-            param_6=0,
-            api_name="/chat"
-        )
-
-        token_value = result
-        return {"success": True, "result": token_value}
-    except Exception as e:
-        return {"success": False, "error": str(e)}
+    function handleEvent(event, data) {
+        if (event === 'line') {
+            output.textContent += data.text;
+        } else if (event === 'done') {
+            box.className = data.success ? 'result success' : 'result error';
+            const summary = data.success ? '✅ Все тесты пройдены успешно!' : '❌ Некоторые тесты не прошли.';
+            output.textContent = `${summary}${data.cached ? ' (результат из кэша)' : ''}\n\n${output.textContent}`;
+        }
+    }
 
+    fetch('/run_tests?stream=1', {method: 'POST'})
+        .then(response => readEvents(response, handleEvent))
+        .catch(() => {
+            box.className = 'result error';
+            box.textContent = 'Ошибка запуска тестов';
+        })
+        .finally(() => {
+            btn.disabled = false;
+            btn.textContent = '🧪 Запустить тесты';
+        });
+});
+"""
 
 # HTML шаблон для главной страницы
 HTML_TEMPLATE = """
@@ -76,25 +3937,7 @@ HTML_TEMPLATE = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Распознавание изображений - Paligemma</title>
-    <style>
-        body { font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; background-color: #f5f5f5; }
-        .container { background-color: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
-        h1 { color: #333; text-align: center; margin-bottom: 30px; }
-        .form-group { margin-bottom: 20px; }
-        label { display: block; margin-bottom: 5px; font-weight: bold; }
-        input[type="file"], input[type="text"] { width: 100%; padding: 10px; border: 1px solid #ddd; border-radius: 5px; }
-        input[type="text"] { margin-bottom: 10px; }
-        button { background-color: #4CAF50; color: white; padding: 12px 30px; border: none; border-radius: 5px; cursor: pointer; font-size: 16px; }
-        button:hover { background-color: #45a049; }
-        .result { margin-top: 20px; padding: 15px; border-radius: 5px; }
-        .success { background-color: #d4edda; border: 1px solid #c3e6cb; color: #155724; }
-        .error { background-color: #f8d7da; border: 1px solid #f5c6cb; color: #721c24; }
-        .loading { background-color: #cce5ff; border: 1px solid #99ccff; color: #004085; }
-        .upload-area { border: 2px dashed #ccc; padding: 20px; text-align: center; border-radius: 5px; }
-        .upload-area:hover { border-color: #999; }
-        .test-btn { background-color: #007bff; margin-top: 10px; }
-        .test-btn:hover { background-color: #0056b3; }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('app.css') }}">
 </head>
 <body>
     <div class="container">
@@ -102,10 +3945,10 @@ HTML_TEMPLATE = """
         
         <form method="post" enctype="multipart/form-data">
             <div class="form-group">
-                <label for="image">Загрузите изображение:</label>
+                <label for="image">Загрузите изображения:</label>
                 <div class="upload-area">
-                    <input type="file" id="image" name="image" accept=".jpg,.jpeg,.png,.gif" required>
-                    <p>Поддерживаемые форматы: JPG, JPEG, PNG, GIF</p>
+                    <input type="file" id="image" name="image" accept=".jpg,.jpeg,.png,.gif,.webp" multiple required>
+                    <p>Поддерживаемые форматы: JPG, JPEG, PNG, GIF, WebP. Можно выбрать несколько изображений (до {{ max_images }}) — они будут проанализированы вместе</p>
                 </div>
             </div>
             
@@ -114,8 +3957,22 @@ HTML_TEMPLATE = """
                 <input type="text" id="prompt" name="prompt" placeholder="Например: 'Что изображено на картинке?' или 'Describe this image'" required>
             </div>
             
+            <div class="form-group">
+                <label for="profile">Профиль ответа:</label>
+                <select id="profile" name="profile">
+                    {% for name, profile in profiles.items() %}
+                        <option value="{{ name }}"{% if name == default_profile %} selected{% endif %}>{{ profile.description or name }}</option>
+                    {% endfor %}
+                </select>
+            </div>
+            
+            <div class="form-group">
+                <label class="inline-label"><input type="checkbox" id="stream" name="stream" checked> Показывать ответ по мере генерации</label>
+            </div>
+            
             <button type="submit">🔍 Распознать изображение</button>
         </form>
+        <div id="stream-result"></div>
         <button class="test-btn" id="run-tests-btn">🧪 Запустить тесты</button>
         <div id="test-result"></div>
         
@@ -135,458 +3992,1166 @@ HTML_TEMPLATE = """
         {% endif %}
     </div>
     
-    <script>
-        // Показать имя файла после выбора
-        document.getElementById('image').addEventListener('change', function(e) {
-            const fileName = e.target.files[0]?.name;
-            if (fileName) {
-                const uploadArea = document.querySelector('.upload-area p');
-                uploadArea.textContent = `Выбран файл: ${fileName}`;
-            }
-        });
-        // Кнопка запуска тестов
-        document.getElementById('run-tests-btn').addEventListener('click', function() {
-            const btn = this;
-            btn.disabled = true;
-            btn.textContent = '⏳ Тесты выполняются...';
-            document.getElementById('test-result').innerHTML = '';
-            fetch('/run_tests', {method: 'POST'})
-                .then(r => r.json())
-                .then(data => {
-                    if (data.success) {
-                        document.getElementById('test-result').innerHTML = `<div class='result success'>✅ Все тесты пройдены успешно!</div>`;
-                    } else {
-                        document.getElementById('test-result').innerHTML = `<div class='result error'>❌ Некоторые тесты не прошли.<br>\n${data.output || ''}</div>`;
-                    }
-                })
-                .catch(e => {
-                    document.getElementById('test-result').innerHTML = `<div class='result error'>Ошибка запуска тестов</div>`;
-                })
-                .finally(() => {
-                    btn.disabled = false;
-                    btn.textContent = '🧪 Запустить тесты';
-                });
-        });
-    </script>
+    <script src="{{ asset_url('app.js') }}"></script>
 </body>
 </html>
 """
 
 
+# =================== СТАТИКА И СЖАТИЕ ===================
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+COMPRESSIBLE_TYPES = {'text/html', 'text/css', 'text/plain', 'application/javascript', 'application/json'}
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+
+@functools.lru_cache(maxsize=None)
+def load_brotli():
+    """Brotli необязателен: без пакета brotli ответы сжимаются только gzip"""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def choose_encoding():
+    """Лучшее сжатие, которое принимает клиент"""
+    accepted = request.accept_encodings
+    if load_brotli() and accepted.quality('br') > 0:
+        return 'br'
+    if accepted.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding, level=None):
+    level = COMPRESS_LEVEL if level is None else level
+    if encoding == 'br':
+        return load_brotli().compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level)
+
+
+class StaticAsset:
+    """Статический файл в памяти с ETag по содержимому и заранее сжатыми вариантами"""
+
+    def __init__(self, content, mimetype):
+        self.body = content.encode('utf-8')
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(self.body).hexdigest()[:16]
+        self._encoded = {}
+
+    def encoded(self, encoding):
+        if encoding is None:
+            return self.body
+        if encoding not in self._encoded:
+            # Статика сжимается один раз и с максимальной степенью
+            self._encoded[encoding] = compress(self.body, encoding, level=11 if encoding == 'br' else 9)
+        return self._encoded[encoding]
+
+
+STATIC_ASSETS = {
+    'app.css': StaticAsset(PAGE_CSS, 'text/css'),
+    'app.js': StaticAsset(PAGE_JS, 'application/javascript'),
+}
+
+
+@app.template_global()
+def asset_url(name):
+    # Версия в адресе меняется вместе с содержимым, поэтому кэшировать можно бессрочно
+    return url_for('static_asset', name=name, v=STATIC_ASSETS[name].etag)
+
+
+@app.route('/assets/<name>')
+def static_asset(name):
+    asset = STATIC_ASSETS.get(name)
+    if asset is None:
+        return jsonify({"success": False, "error": "Файл не найден"}), 404
+
+    encoding = choose_encoding()
+    response = Response(asset.encoded(encoding), mimetype=asset.mimetype)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    # У каждого варианта сжатия свой ETag
+    response.set_etag(f'{asset.etag}-{encoding}' if encoding else asset.etag)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = STATIC_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+
+@app.after_request
+def compress_response(response):
+    """Сжимает HTML и JSON-ответы; потоковые ответы (SSE) не трогает"""
+    if (response.direct_passthrough or response.is_streamed or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    encoding = choose_encoding()
+    if encoding is None or len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+# Шаблон компилируется один раз при импорте, а не на каждый запрос
+page_template = app.jinja_env.from_string(HTML_TEMPLATE)
+
+
+def render_page(**context):
+    with span('render'), metrics.render.time():
+        return render_template(page_template, max_images=MAX_IMAGES_PER_REQUEST, profiles=generation_profiles,
+                               default_profile=DEFAULT_PROFILE, **context)
+
+
+def index_submission():
+    """Проверяет форму POST /: ((пути, промпт, профиль), None) или (None, готовый ответ)"""
+    # Первое обращение к request.files разбирает multipart-тело
+    with span('upload.parse'), metrics.upload_receive.time():
+        files = request.files
+
+    # Проверяем, что файл загружен
+    if 'image' not in files:
+        flash('Файл не был загружен', 'error')
+        return None, redirect(request.url)
+
+    images = selected_images()
+    prompt = request.form.get('prompt', '').strip()
+
+    # Проверяем, что файл выбран
+    if not images:
+        flash('Файл не был выбран', 'error')
+        return None, redirect(request.url)
+
+    # Проверяем, что промпт введен
+    if not prompt:
+        flash('Введите текстовый промпт', 'error')
+        return None, redirect(request.url)
+
+    if len(images) > MAX_IMAGES_PER_REQUEST:
+        flash(f'Слишком много изображений: не больше {MAX_IMAGES_PER_REQUEST} за запрос', 'error')
+        return None, redirect(request.url)
+
+    try:
+        profile = resolve_profile(request.form.get('profile'))
+    except UnknownProfileError as e:
+        flash(str(e), 'error')
+        return None, render_page()
+
+    # Проверяем расширения файлов
+    if not all(allowed_file(file.filename) for file in images):
+        flash('Неподдерживаемый формат файла. Используйте JPG, JPEG, PNG, GIF или WebP', 'error')
+        return None, render_page()
+
+    try:
+        # Файлы уже приняты в спул и будут удалены по завершении запроса
+        with span('upload.save', images=len(images)), metrics.file_save.time():
+            image_paths = [upload_path(file) for file in images]
+        for image_path in image_paths:
+            metrics.upload_size.observe(os.path.getsize(image_path))
+    except Exception as e:
+        flash(f'Ошибка обработки файла: {str(e)}', 'error')
+        return None, render_page()
+    return (image_paths, prompt, profile), None
+
+
+def index_result(result):
+    """Страница с результатом анализа или с ошибкой"""
+    if result["success"]:
+        return render_page(result=result["result"])
+    flash(f'Ошибка анализа: {result["error"]}', 'error')
+    if result.get("status_code"):
+        # Запрос отклонен защитой от перегрузки — сообщаем, когда повторить
+        return render_page(), result["status_code"], {'Retry-After': str(result["retry_after"])}
+    return render_page()
+
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
-        # Проверяем, что файл загружен
-        if 'image' not in request.files:
-            flash('Файл не был загружен', 'error')
-            return redirect(request.url)
-
-        file = request.files['image']
-        prompt = request.form.get('prompt', '').strip()
-
-        # Проверяем, что файл выбран
-        if file.filename == '':
-            flash('Файл не был выбран', 'error')
-            return redirect(request.url)
-
-        # Проверяем, что промпт введен
-        if not prompt:
-            flash('Введите текстовый промпт', 'error')
-            return redirect(request.url)
-
-        # Проверяем расширение файла
-        if file and allowed_file(file.filename):
-            try:
-                # Сохраняем файл
-                filename = secure_filename(file.filename)
-                temp_file_path = f"temp_{filename}"
-                file.save(temp_file_path)
+        form, response = index_submission()
+        if response is not None:
+            return response
+        try:
+            # Все изображения уходят в модель одним вызовом вместе с промптом
+            return index_result(analyze_image(*form))
+        except Exception as e:
+            flash(f'Ошибка обработки файла: {str(e)}', 'error')
 
-                # Анализируем изображение
-                result = analyze_image(temp_file_path, prompt)
+    return render_page()
 
-                # Удаляем временный файл
-                try:
-                    os.remove(temp_file_path)
-                except:
-                    pass
 
-                if result["success"]:
-                    return render_template_string(HTML_TEMPLATE, result=result["result"])
-                else:
-                    flash(f'Ошибка анализа: {result["error"]}', 'error')
+# =================== ЗАПУСК ТЕСТОВ ===================
 
-            except Exception as e:
-                flash(f'Ошибка обработки файла: {str(e)}', 'error')
-        else:
-            flash('Неподдерживаемый формат файла. Используйте JPG, JPEG, PNG или GIF', 'error')
+TESTS_WORKERS = os.environ.get('TESTS_WORKERS', '0')
+TESTS_TIMEOUT = float(os.environ.get('TESTS_TIMEOUT', 600))
+TESTS_CACHE_SIZE = int(os.environ.get('TESTS_CACHE_SIZE', 8))
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def tests_source_hash(root=APP_DIR):
+    """Хэш исходников, от которых зависит результат тестов"""
+    digest = hashlib.sha256()
+    for directory in (root, os.path.join(root, 'benchmarks')):
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.py') or name == 'requirements.txt':
+                path = os.path.join(directory, name)
+                digest.update(os.path.relpath(path, root).encode('utf-8'))
+                with open(path, 'rb') as f:
+                    digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def tests_command():
+    """Тесты запускаются тем же интерпретатором в отдельном процессе: python main.py test"""
+    return [sys.executable, os.path.abspath(__file__), 'test']
+
+
+class PytestRun:
+    """Один прогон тестов: статус, построчный вывод и код выхода"""
+
+    def __init__(self, source_hash):
+        self.id = uuid.uuid4().hex
+        self.source_hash = source_hash
+        self.status = 'queued'
+        self.lines = []
+        self.returncode = None
+        self._cond = threading.Condition()
+
+    def append(self, line):
+        with self._cond:
+            self.lines.append(line)
+            self._cond.notify_all()
+
+    def finish(self, returncode):
+        with self._cond:
+            self.returncode = returncode
+            self.status = 'done'
+            self._cond.notify_all()
+
+    def follow(self):
+        """Строки вывода по мере появления, пока прогон не завершится"""
+        position = 0
+        while True:
+            with self._cond:
+                while position == len(self.lines) and self.status != 'done':
+                    self._cond.wait()
+                lines = self.lines[position:]
+                position = len(self.lines)
+                finished = self.status == 'done'
+            yield from lines
+            if finished:
+                return
+
+    def wait(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.status == 'done', timeout)
+
+    @property
+    def success(self):
+        return self.returncode == 0
+
+    @property
+    def output(self):
+        with self._cond:
+            return ''.join(self.lines)
 
-    return render_template_string(HTML_TEMPLATE)
+
+class PytestRunner:
+    """Очередь прогонов тестов в отдельном процессе.
+
+    Одновременно выполняется только один прогон. Повторный запуск при тех же
+    исходниках возвращает сохраненный результат или присоединяется к уже
+    идущему прогону.
+    """
+
+    def __init__(self, command=None, source_hash=None, timeout=600, cache_size=8):
+        self.command = command or tests_command
+        self.source_hash = source_hash or tests_source_hash
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self._results = OrderedDict()
+        self._runs = {}
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self.executed = 0
+        self.cache_hits = 0
+
+    def submit(self):
+        """Возвращает (прогон, взят_ли_результат_из_кэша)"""
+        source_hash = self.source_hash()
+        with self._cond:
+            cached = self._results.get(source_hash)
+            if cached is not None:
+                self._results.move_to_end(source_hash)
+                self.cache_hits += 1
+                return cached, True
+            run = self._runs.get(source_hash)
+            if run is None:
+                run = self._runs[source_hash] = PytestRun(source_hash)
+                self._pending.append(run)
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._worker, name='pytest-runner', daemon=True)
+                    self._thread.start()
+                self._cond.notify()
+            return run, False
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                run = self._pending.popleft()
+            run.status = 'running'
+            returncode = self._execute(run)
+            with self._cond:
+                self.executed += 1
+                del self._runs[run.source_hash]
+                # Кэшируем только настоящий результат pytest: 0 — все прошло, 1 — есть падения
+                if returncode in (0, 1):
+                    self._results[run.source_hash] = run
+                    while len(self._results) > self.cache_size:
+                        self._results.popitem(last=False)
+            run.finish(returncode)
+
+    def _execute(self, run):
+        env = dict(os.environ, PYTHONUNBUFFERED='1')
+        try:
+            process = subprocess.Popen(self.command(), cwd=APP_DIR, env=env, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT, text=True, encoding='utf-8', errors='replace')
+        except OSError as e:
+            run.append(f"Не удалось запустить тесты: {e}\n")
+            return None
+
+        timer = threading.Timer(self.timeout, process.kill)
+        timer.start()
+        try:
+            for line in process.stdout:
+                run.append(line)
+            returncode = process.wait()
+        finally:
+            timer.cancel()
+            process.stdout.close()
+        if returncode < 0:
+            run.append(f"\n❌ Прогон тестов прерван (превышено {self.timeout:g} с или процесс завершен сигналом)\n")
+            return None
+        return returncode
+
+    def stats(self):
+        with self._cond:
+            return {
+                "executed": self.executed,
+                "cache_hits": self.cache_hits,
+                "queued": len(self._pending),
+                "cached_results": len(self._results),
+            }
+
+
+test_runner = PytestRunner(timeout=TESTS_TIMEOUT, cache_size=TESTS_CACHE_SIZE)
 
 
 @app.route('/run_tests', methods=['POST'])
 def run_tests_api():
-    """Endpoint для запуска тестов через фронт"""
-    import io
-    import contextlib
-    buf = io.StringIO()
+    """Endpoint для запуска тестов через фронт.
+
+    С параметром stream=1 вывод pytest приходит построчно (Server-Sent Events),
+    иначе ответ JSON отдается после завершения прогона.
+    """
+    run, cached = test_runner.submit()
+
+    if request.args.get('stream') == '1':
+        def generate():
+            for line in run.follow():
+                yield format_sse("line", {"text": line})
+            yield format_sse("done", {"success": run.success, "cached": cached})
+
+        return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    run.wait()
+    return jsonify({"success": run.success, "cached": cached, "output": run.output})
+
+
+@app.route('/pool_stats', methods=['GET'])
+def pool_stats_api():
+    """Статистика пула клиентов Gradio"""
+    return jsonify(client_pool.stats())
+
+
+@app.route('/backends', methods=['GET'])
+def backends_api():
+    """Состояние бэкендов модели: задержка, вызовы в работе, ошибки, размыкатель"""
+    return jsonify({"backends": router.stats(), "fallbacks": router.fallbacks})
+
+
+@app.route('/tenants', methods=['GET'])
+def tenants_api():
+    """Использование квот и справедливой очереди по потребителям"""
+    return jsonify({"tenants": tenants.stats(), "scheduler": fair_scheduler.stats()})
+
+
+@app.route('/preprocess_stats', methods=['GET'])
+def preprocess_stats_api():
+    """Статистика предобработки изображений"""
+    return jsonify(preprocess_stats.stats())
+
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats_api():
+    """Статистика кэша результатов"""
+    return jsonify(dict(result_cache.stats(), coalescing=single_flight.stats(), near_duplicates=near_duplicates.stats(),
+                        remote_files=remote_files.stats()))
+
+
+@app.route('/profiles', methods=['GET'])
+def profiles_api():
+    """Профили генерации с задержкой и длиной ответов по каждому"""
+    stats = profile_stats.stats()
+    return jsonify({
+        "default": DEFAULT_PROFILE,
+        "profiles": {name: dict(profile, stats=stats.get(name)) for name, profile in generation_profiles.items()},
+    })
+
+
+def form_profile():
+    """(текст ошибки, None) или (None, профиль) из поля profile формы API"""
     try:
-        with contextlib.redirect_stdout(buf):
-            result = run_tests()
-        output = buf.getvalue()
-        return jsonify({
-            "success": result == 0,
-            "output": output
-        })
+        return None, resolve_profile(request.form.get('profile'))
+    except UnknownProfileError as e:
+        return str(e), None
+
+
+def query_number(name, cast):
+    value = request.args.get(name, '').strip()
+    return cast(value) if value else None
+
+
+@app.route('/history', methods=['GET'])
+def history_api():
+    """История результатов вызывающего потребителя, новые первыми.
+
+    Фильтры: image_hash (SHA-256 файла), prompt (точное совпадение), prompt_prefix,
+    since/until (Unix-время). Следующая страница — ?cursor=<next_cursor>.
+    """
+    if not history.enabled:
+        return jsonify({"success": False, "error": "История результатов отключена"}), 404
+    try:
+        limit = query_number('limit', int) or HISTORY_PAGE_SIZE
+        cursor = query_number('cursor', int)
+        since = query_number('since', float)
+        until = query_number('until', float)
+    except ValueError:
+        return jsonify({"success": False, "error": "Некорректный параметр запроса"}), 400
+    if limit < 1:
+        return jsonify({"success": False, "error": "Некорректный параметр запроса"}), 400
+    tenant = caller_tenant()
+    if tenant is None:
+        return jsonify({"success": True, "items": [], "next_cursor": None})
+    items, next_cursor = history.query(
+        image_hash=request.args.get('image_hash', '').strip().lower() or None,
+        prompt=request.args.get('prompt') or None,
+        prompt_prefix=request.args.get('prompt_prefix') or None,
+        since=since, until=until, cursor=cursor, limit=min(limit, HISTORY_PAGE_MAX), tenant=tenant.name,
+    )
+    return jsonify({"success": True, "items": items, "next_cursor": next_cursor})
+
+
+@app.route('/history/<int:record_id>', methods=['GET'])
+def history_item_api(record_id):
+    """Одна запись истории вызывающего потребителя"""
+    tenant = caller_tenant()
+    item = history.get(record_id, tenant.name) if history.enabled and tenant is not None else None
+    if item is None:
+        return jsonify({"success": False, "error": "Запись не найдена"}), 404
+    return jsonify(dict(item, success=True))
+
+
+@app.route('/analyze_stream', methods=['POST'])
+def analyze_stream_api():
+    """Потоковый анализ изображений: ответ модели передается через Server-Sent Events"""
+    form, response = stream_submission()
+    if response is not None:
+        return response
+    paths = form[0]
+    try:
+        # Допуск к модели проверяется до заголовков 200: отказ получает свой статус и Retry-After, как у формы
+        events = open_stream(*form)
     except Exception as e:
-        return jsonify({"success": False, "output": str(e)})
-
-
-# =================== ТЕСТЫ ===================
-
-class TestGetClient:
-    """Тесты для функции get_client"""
-
-    @patch.dict(os.environ, {'TOKEN_HUGGI': 'test_token'})
-    @patch('main.Client')
-    def test_get_client_with_token_success(self, mock_client_class):
-        """Тест успешного создания клиента с токеном"""
-        mock_client_instance = Mock()
-        mock_client_class.return_value = mock_client_instance
-
-        result = get_client()
-
-        mock_client_class.assert_called_once_with("amd/llama4-maverick-17b-128e-mi-amd")
-        assert result == mock_client_instance
-
-    @patch.dict(os.environ, {'TOKEN_HUGGI': 'test_token'})
-    @patch('main.Client')
-    def test_get_or_create_client_caching(self, mock_client_class):
-        """Тест кэширования клиента"""
-        global client
-        client = None  # Сбрасываем глобальный клиент
-
-        mock_client_instance = Mock()
-        mock_client_class.return_value = mock_client_instance
-
-        # Первый вызов
-        result1 = get_or_create_client()
-        # Второй вызов
-        result2 = get_or_create_client()
-
-        mock_client_class.assert_called_once_with("amd/llama4-maverick-17b-128e-mi-amd")
-        assert result1 == result2 == mock_client_instance
-
-
-class TestAnalyzeImage:
-    """Тесты для функции analyze_image"""
-
-    @patch('main.get_or_create_client')
-    @patch('main.handle_file')
-    def test_analyze_image_success(self, mock_handle_file, mock_get_client):
-        """Тест успешного анализа изображения"""
-        mock_client = Mock()
-        mock_get_client.return_value = mock_client
-        mock_handle_file.return_value = "mocked_file"
-        mock_client.predict.return_value = "test_result"
-
-        result = analyze_image("test_image.jpg", "test prompt")
-
-        mock_handle_file.assert_called_once_with("test_image.jpg")
-        mock_client.predict.assert_called_once_with(
-            message={"text": "test prompt", "files": ["mocked_file"]},
-            param_2="",
-            param_3=2048,
-            param_4=0.3,
-            param_5=0,
-            param_6=0,
-            api_name="/chat"
-        )
-        assert result == {"success": True, "result": "test_result"}
-
-    @patch('main.get_or_create_client')
-    @patch('main.handle_file')
-    def test_analyze_image_client_error(self, mock_handle_file, mock_get_client):
-        """Тест обработки ошибки клиента"""
-        mock_client = Mock()
-        mock_get_client.return_value = mock_client
-        mock_handle_file.return_value = "mocked_file"
-        mock_client.predict.side_effect = Exception("API Error")
-
-        result = analyze_image("test_image.jpg", "test prompt")
-
-        assert result == {"success": False, "error": "API Error"}
-
-    @patch('main.get_or_create_client')
-    @patch('main.handle_file')
-    def test_analyze_image_invalid_response_format(self, mock_handle_file, mock_get_client):
-        """Тест обработки неверного формата ответа (неактуально, т.к. теперь возвращается строка)"""
-        mock_client = Mock()
-        mock_get_client.return_value = mock_client
-        mock_handle_file.return_value = "mocked_file"
-        mock_client.predict.return_value = None
-
-        result = analyze_image("test_image.jpg", "test prompt")
-
-        assert result["success"] is True
-        assert result["result"] is None
-
-    @patch('main.get_or_create_client')
-    @patch('main.handle_file')
-    def test_analyze_image_empty_prompt(self, mock_handle_file, mock_get_client):
-        """Тест с пустым промптом"""
-        mock_client = Mock()
-        mock_get_client.return_value = mock_client
-        mock_handle_file.return_value = "mocked_file"
-        mock_client.predict.return_value = "empty_result"
-
-        result = analyze_image("test_image.jpg", "")
-
-        mock_client.predict.assert_called_once_with(
-            message={"text": "", "files": ["mocked_file"]},
-            param_2="",
-            param_3=2048,
-            param_4=0.3,
-            param_5=0,
-            param_6=0,
-            api_name="/chat"
-        )
-        assert result == {"success": True, "result": "empty_result"}
-
-
-class TestFlaskApp:
-    """Тесты для Flask приложения"""
-
-    @pytest.fixture
-    def test_client(self):
-        """Создает тестовый клиент Flask"""
-        app.config['TESTING'] = True
-        with app.test_client() as client:
-            yield client
+        return stream_rejected(paths, e)
+    return stream_response(paths, events)
 
-    def test_get_homepage(self, test_client):
-        """Тест загрузки главной страницы"""
-        response = test_client.get('/')
-        assert response.status_code == 200
-        assert "Распознавание изображений - Paligemma" in response.data.decode()
-
-    def test_post_without_file(self, test_client):
-        """Тест POST запроса без файла"""
-        response = test_client.post('/', data={'prompt': 'test prompt'}, follow_redirects=True)
-        assert "Файл не был загружен" in response.data.decode()
-
-    def test_post_without_prompt(self, test_client):
-        """Тест POST запроса без промпта"""
-        # Создаем временный файл изображения
-        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
-            tmp.write(b"fake_image_data")
-            tmp_path = tmp.name
-
-        try:
-            with open(tmp_path, 'rb') as f:
-                data = {
-                    'image': (f, 'test.jpg'),
-                    'prompt': ''
-                }
-                response = test_client.post('/', data=data, follow_redirects=True)
-                assert "Введите текстовый промпт" in response.data.decode()
+
+def stream_submission():
+    """Проверяет форму /analyze_stream: ((пути, промпт, профиль), None) или (None, готовый ответ)"""
+    images = selected_images()
+    prompt = request.form.get('prompt', '').strip()
+    error = check_images(images)
+    if error is None and not prompt:
+        error = "Введите текстовый промпт"
+    if error is None:
+        error, profile = form_profile()
+    if error:
+        return None, (jsonify({"success": False, "error": error}), 400)
+
+    # Файлы запроса закрываются раньше, чем закончится поток, поэтому берем свои ссылки
+    paths = [detach_upload(file) for file in images]
+    return (paths, prompt, profile), None
+
+
+def stream_rejected(paths, error):
+    """Отказ в допуске к модели — 429/503 с Retry-After; остальные ошибки пробрасываются"""
+    remove_files(paths)
+    if isinstance(error, UpstreamUnavailableError):
+        return (jsonify({"success": False, "error": str(error)}), error.status_code,
+                {'Retry-After': str(error.retry_after)})
+    raise error
+
+
+def stream_response(paths, events):
+    """SSE-ответ с событиями events; файлы paths удаляются, когда поток закрыт"""
+    def generate():
+        try:
+            for event, text in events:
+                yield format_sse(event, {"text": text})
         finally:
+            events.close()
+            remove_files(paths)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+# =================== ПАКЕТНЫЙ АНАЛИЗ ===================
+
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', 4))
+BATCH_ITEM_TIMEOUT = float(os.environ.get('BATCH_ITEM_TIMEOUT', 120))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 100))
+
+
+@functools.lru_cache(maxsize=None)
+def batch_executor():
+    # Один пул на все пакеты: одновременно выполняется не больше BATCH_MAX_WORKERS элементов на процесс
+    return ThreadPoolExecutor(max_workers=max(1, BATCH_MAX_WORKERS), thread_name_prefix='batch')
+
+
+def run_batch(items, item_timeout=None, profile=None):
+    """Анализирует список (путь, промпт) в общем ограниченном пуле потоков.
+
+    profile — профиль генерации, общий для всего пакета.
+
+    Результаты возвращаются в порядке входных элементов. Таймаут элемента
+    отсчитывается с момента начала его выполнения; элемент, у которого
+    он истек, не начинает вызов модели.
+    """
+    item_timeout = item_timeout or BATCH_ITEM_TIMEOUT
+    started = [threading.Event() for _ in items]
+    started_at = [None] * len(items)
+
+    # Общий предел ожидания, если зависшие элементы заняли весь пул
+    waves = -(-len(items) // max(1, BATCH_MAX_WORKERS))
+    batch_deadline = time.monotonic() + item_timeout * waves
+
+    def worker(index, image_path, prompt):
+        started_at[index] = time.monotonic()
+        started[index].set()
+        # Элемент, начатый после общего предела, уже записан как просроченный
+        expired = started_at[index] >= batch_deadline
+        call_deadline.set(started_at[index] if expired else started_at[index] + item_timeout)
+        check_deadline()
+        return analyze_image(image_path, prompt, profile)
+
+    # Каждый элемент выполняется от имени потребителя, приславшего пакет
+    futures = [batch_executor().submit(contextvars.copy_context().run, worker, i, path, prompt)
+               for i, (path, prompt) in enumerate(items)]
+    results = []
+    try:
+        for index, future in enumerate(futures):
+            started[index].wait(max(0.0, batch_deadline - time.monotonic()))
+            if started[index].is_set():
+                remaining = started_at[index] + item_timeout - time.monotonic()
+            else:
+                remaining = 0.0
             try:
-                os.remove(tmp_path)
-            except:
-                pass
+                results.append(future.result(timeout=max(0.0, remaining)))
+            except FutureTimeoutError:
+                results.append({"success": False, "error": f"Превышено время ожидания ({item_timeout:g} с)"})
+            except Exception as e:
+                results.append({"success": False, "error": str(e)})
+    finally:
+        # Не начатые элементы снимаются с очереди, начатые остановятся по своему сроку
+        for future in futures:
+            future.cancel()
+    return results
+
+
+@app.route('/analyze_batch', methods=['POST'])
+def analyze_batch_api():
+    """Пакетный анализ: несколько изображений с общим или индивидуальными промптами"""
+    files = request.files.getlist('images')
+    if not files:
+        return jsonify({"success": False, "error": "Файлы не были загружены"}), 400
+    if len(files) > BATCH_MAX_ITEMS:
+        return jsonify({"success": False, "error": f"Слишком много изображений (максимум {BATCH_MAX_ITEMS})"}), 400
+
+    shared_prompt = request.form.get('prompt', '').strip()
+    prompts = [p.strip() for p in request.form.getlist('prompts')]
+    if prompts and len(prompts) != len(files):
+        return jsonify({"success": False, "error": "Количество промптов не совпадает с количеством изображений"}), 400
+    error, profile = form_profile()
+    if error:
+        return jsonify({"success": False, "error": error}), 400
+
+    results = [None] * len(files)
+    pending = []
+    for index, file in enumerate(files):
+        prompt = (prompts[index] if prompts else '') or shared_prompt
+        rejected = getattr(file.stream, 'rejected', None)
+        if rejected:
+            results[index] = {"success": False, "error": rejected.description, "status_code": rejected.code}
+        elif not prompt:
+            results[index] = {"success": False, "error": "Введите текстовый промпт"}
+        elif not allowed_file(file.filename):
+            results[index] = {"success": False, "error": "Неподдерживаемый формат файла"}
+        else:
+            pending.append((index, upload_path(file), prompt))
+
+    # Токен за запрос списан до разбора тела; остальные — по числу изображений, которые дойдут до модели
+    tenant = current_tenant()
+    if not pending:
+        tenant.refund()
+    elif len(pending) > 1:
+        retry_after = tenant.charge_more(len(pending) - 1)
+        if retry_after:
+            tenant.refund()
+            return quota_exceeded(retry_after)
+
+    batch_results = run_batch([(path, prompt) for _, path, prompt in pending], profile=profile)
+    for (index, _, _), result in zip(pending, batch_results):
+        results[index] = result
+
+    items = [
+        dict(result, index=index, filename=file.filename)
+        for index, (file, result) in enumerate(zip(files, results))
+    ]
+    succeeded = sum(1 for item in items if item["success"])
+    return jsonify({
+        "success": succeeded == len(items),
+        "succeeded": succeeded,
+        "failed": len(items) - succeeded,
+        "results": items,
+    })
+
 
-    def test_post_invalid_file_type(self, test_client):
-        """Тест POST запроса с неподдерживаемым типом файла"""
-        # Создаем временный файл с неподдерживаемым расширением
-        with tempfile.NamedTemporaryFile(suffix='.txt', delete=False) as tmp:
-            tmp.write(b"fake_text_data")
-            tmp_path = tmp.name
+# =================== ОЧЕРЕДЬ ЗАДАЧ ===================
 
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_RETENTION = float(os.environ.get('JOB_RETENTION', 3600))
+JOB_QUEUE_MAX = int(os.environ.get('JOB_QUEUE_MAX', 1000))
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobQueue:
+    """Очередь задач анализа с пулом фоновых обработчиков"""
+
+    def __init__(self, workers=2, retention=3600, max_queued=1000):
+        self.workers = workers
+        self.retention = retention
+        self.max_queued = max_queued
+        self._jobs = {}
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def _ensure_workers(self):
+        # Обработчики стартуют при первой задаче, а не при импорте модуля
+        alive = [t for t in self._threads if t.is_alive()]
+        for i in range(len(alive), self.workers):
+            thread = threading.Thread(target=self._worker, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            alive.append(thread)
+        self._threads = alive
+
+    def _purge_expired(self, now):
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["finished_at"] is not None and job["finished_at"] + self.retention < now
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def submit(self, image_path, prompt, profile=None):
+        now = time.time()
+        with self._cond:
+            self._purge_expired(now)
+            if len(self._pending) >= self.max_queued:
+                raise QueueFullError("Очередь задач переполнена")
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "id": job_id,
+                "status": "queued",
+                "image_paths": as_paths(image_path),
+                "prompt": prompt,
+                "profile": profile,
+                "tenant": current_tenant(),
+                "created_at": now,
+                "started_at": None,
+                "finished_at": None,
+                "result": None,
+                "error": None,
+            }
+            self._pending.append(job_id)
+            self._ensure_workers()
+            self._cond.notify()
+        return job_id
+
+    def get(self, job_id):
+        """Снимок состояния задачи или None, если задача не найдена"""
+        now = time.time()
+        with self._cond:
+            self._purge_expired(now)
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            snapshot = {key: job[key] for key in ("id", "status", "profile", "created_at", "started_at", "finished_at")}
+            if job["status"] == "queued":
+                snapshot["queue_position"] = self._pending.index(job_id) + 1
+            if job["started_at"] is not None:
+                snapshot["wait_time"] = job["started_at"] - job["created_at"]
+            if job["finished_at"] is not None:
+                snapshot["run_time"] = job["finished_at"] - job["started_at"]
+            if job["status"] == "done":
+                snapshot["result"] = job["result"]
+            elif job["status"] == "failed":
+                snapshot["error"] = job["error"]
+            return snapshot
+
+    def stats(self):
+        with self._cond:
+            counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+            for job in self._jobs.values():
+                counts[job["status"]] += 1
+            return dict(counts, workers=self.workers)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                job = self._jobs[self._pending.popleft()]
+                job["status"] = "running"
+                job["started_at"] = time.time()
+            self._run(job)
+
+    def _run(self, job):
+        tenant_context.set(job["tenant"])
         try:
-            with open(tmp_path, 'rb') as f:
-                data = {
-                    'image': (f, 'test.txt'),
-                    'prompt': 'test prompt'
-                }
-                response = test_client.post('/', data=data, follow_redirects=True)
-                # Проверяем, что показывается сообщение об ошибке
-                assert "Неподдерживаемый формат файла" in response.data.decode()
+            result = analyze_image(job["image_paths"], job["prompt"], job["profile"])
+        except Exception as e:
+            result = {"success": False, "error": str(e)}
         finally:
-            try:
-                os.remove(tmp_path)
-            except:
-                pass
+            remove_files(job["image_paths"])
+        with self._cond:
+            job["finished_at"] = time.time()
+            if result["success"]:
+                job["status"] = "done"
+                job["result"] = result["result"]
+            else:
+                job["status"] = "failed"
+                job["error"] = result["error"]
+
+
+job_queue = JobQueue(JOB_WORKERS, JOB_RETENTION, JOB_QUEUE_MAX)
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job_api():
+    """Ставит анализ изображений в очередь и сразу возвращает id задачи"""
+    images = selected_images()
+    prompt = request.form.get('prompt', '').strip()
+    error = check_images(images)
+    if error is None and not prompt:
+        error = "Введите текстовый промпт"
+    if error is None:
+        error, profile = form_profile()
+    if error:
+        return jsonify({"success": False, "error": error}), 400
+
+    paths = [detach_upload(file) for file in images]
+    try:
+        job_id = job_queue.submit(paths, prompt, profile)
+    except QueueFullError as e:
+        remove_files(paths)
+        return jsonify({"success": False, "error": str(e)}), 503
+    return jsonify({"success": True, "job_id": job_id, "status_url": url_for('job_status_api', job_id=job_id)}), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status_api(job_id):
+    """Статус и результат задачи"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Задача не найдена"}), 404
+    return jsonify(dict(job, success=True))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_api():
+    """Метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    lines.extend(render_stats('paligemma_client_pool', client_pool.stats(),
+                              counters={'acquisitions', 'wait_time_total', 'replaced', 'health_failures'}))
+    lines.extend(render_stats('paligemma_jobs', job_queue.stats()))
+    lines.extend(render_stats('paligemma_cache', result_cache.stats(),
+                              counters={'hits', 'disk_hits', 'misses', 'evictions', 'disk_evictions'}))
+    lines.extend(render_stats('paligemma_tracing', tracer.stats(),
+                              counters={'started', 'sampled', 'slow', 'emitted', 'export_exported', 'export_dropped',
+                                        'export_errors'}))
+    lines.extend(render_stats('paligemma_history', history.stats(),
+                              counters={'written', 'batches', 'dropped', 'errors', 'pruned'}))
+    lines.extend(render_stats('paligemma_coalescing', single_flight.stats(), counters={'executed', 'coalesced'}))
+    lines.extend(render_labeled_stats('paligemma_profile', 'profile', profile_stats.stats(),
+                                      counters={'requests', 'latency_total', 'output_chars_total',
+                                                'output_words_total'}))
+    lines.extend(render_stats('paligemma_remote_files', remote_files.stats(),
+                              counters={'hits', 'misses', 'evictions'}))
+    lines.extend(render_stats('paligemma_near_duplicates', near_duplicates.stats(),
+                              counters={'hits', 'misses', 'evictions', 'color_mismatches'}))
+    lines.extend(render_stats('paligemma_retry_budget', retry_budget.stats(), counters={'spent', 'rejected'}))
+    lines.extend(render_stats('paligemma_hedge_budget', hedge_budget.stats(), counters={'spent', 'rejected'}))
+    lines.extend(render_labeled_stats('paligemma_backend', 'backend', router.stats(),
+                                      counters={'requests', 'errors'}))
+    lines.extend(render_stats('paligemma_router', {'fallbacks': router.fallbacks}, counters={'fallbacks'}))
+    lines.extend(render_stats('paligemma_limiter', upstream_limiter.stats()))
+    lines.extend(render_stats('paligemma_fair_queue', fair_scheduler.stats(),
+                              counters={'admitted', 'queued_total', 'timed_out'}))
+    lines.extend(render_labeled_stats('paligemma_tenant', 'tenant', tenants.stats(),
+                                      counters={'requests', 'throttled', 'admitted', 'wait_time_total'}))
+    lines.extend(render_stats('paligemma_breaker', upstream_breaker.stats(), counters={'times_opened', 'rejected'}))
+    lines.extend(render_stats('paligemma_upload_budget', upload_budget.stats(), counters={'rejected'}))
+    lines.extend(render_stats('paligemma_preprocess', preprocess_stats.stats(),
+                              counters={'processed', 'skipped', 'errors', 'bytes_before', 'bytes_after', 'bytes_saved'}))
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+# =================== ASGI ===================
+
+# Потоки для разбора форм, рендеринга и маршрутов без асинхронной версии
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+
+
+class AsgiInput:
+    """wsgi.input поверх ASGI receive: разбор формы в потоке получает тело
+    по частям, поэтому проверка загрузок по-прежнему срабатывает до приема
+    всего тела"""
 
-    @patch('main.analyze_image')
-    @patch('os.remove')
-    def test_post_successful_analysis(self, mock_remove, mock_analyze, test_client):
-        """Тест успешного анализа изображения"""
-        mock_analyze.return_value = {"success": True, "result": "test_result"}
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._more = True
 
-        # Создаем временный файл изображения
-        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
-            tmp.write(b"fake_image_data")
-            tmp_path = tmp.name
+    def _fill(self):
+        while self._more and not self._buffer:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected()
+            self._buffer += message.get('body', b'')
+            self._more = message.get('more_body', False)
 
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                self._fill()
+                if not self._buffer:
+                    return b''.join(chunks)
+                chunks.append(self._buffer)
+                self._buffer = b''
+        self._fill()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def asgi_environ(scope, body):
+    """WSGI-окружение для запроса ASGI"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client')
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0] if client else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # Тело заканчивается вместе с сообщениями ASGI, Content-Length не нужен для чтения
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def start_form_request(environ, submission=index_submission):
+    """Первая половина POST-запроса с формой: контекст запроса, хуки before_request и проверка формы.
+
+    submission — проверка формы маршрута (index_submission для POST /).
+    Возвращает (контекст, форма, None) для анализа или (контекст, None, ответ),
+    если ответ готов сразу. Ошибки обрабатываются так же, как в Flask.wsgi_app.
+    """
+    ctx = app.request_context(environ)
+    ctx.push()
+    try:
         try:
-            with open(tmp_path, 'rb') as f:
-                data = {
-                    'image': (f, 'test.jpg'),
-                    'prompt': 'test prompt'
-                }
-                response = test_client.post('/', data=data)
+            response = app.preprocess_request()
+            if response is None:
+                form, response = submission()
+                if response is None:
+                    return ctx, form, None
+        except Exception as e:
+            response = app.handle_user_exception(e)
+        return ctx, None, app.finalize_request(response)
+    except Exception as e:
+        return ctx, None, app.handle_exception(e)
 
-                assert response.status_code == 200
-                assert "test_result" in response.data.decode()
-                mock_analyze.assert_called_once()
-        finally:
-            try:
-                os.remove(tmp_path)
-            except:
-                pass
 
-    @patch('main.analyze_image')
-    @patch('os.remove')
-    def test_post_failed_analysis(self, mock_remove, mock_analyze, test_client):
-        """Тест неудачного анализа изображения"""
-        mock_analyze.return_value = {"success": False, "error": "API Error"}
+def finish_form_request(result=None, error=None):
+    """Вторая половина POST /: страница с результатом анализа и хуки after_request"""
+    try:
+        try:
+            if error is not None:
+                flash(f'Ошибка обработки файла: {str(error)}', 'error')
+                response = render_page()
+            else:
+                response = index_result(result)
+        except Exception as e:
+            response = app.handle_user_exception(e)
+        return app.finalize_request(response)
+    except Exception as e:
+        return app.handle_exception(e)
 
-        # Создаем временный файл изображения
-        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
-            tmp.write(b"fake_image_data")
-            tmp_path = tmp.name
 
+def finish_stream_request(paths, events=None, error=None):
+    """Вторая половина POST /analyze_stream: SSE-ответ или отказ в допуске и хуки after_request"""
+    try:
         try:
-            with open(tmp_path, 'rb') as f:
-                data = {
-                    'image': (f, 'test.jpg'),
-                    'prompt': 'test prompt'
-                }
-                response = test_client.post('/', data=data, follow_redirects=True)
+            response = stream_rejected(paths, error) if error is not None else stream_response(paths, events)
+        except Exception as e:
+            response = app.handle_user_exception(e)
+        return app.finalize_request(response)
+    except Exception as e:
+        return app.handle_exception(e)
 
-                # Проверяем, что показывается сообщение об ошибке
-                assert "Ошибка анализа: API Error" in response.data.decode()
-                mock_analyze.assert_called_once()
-        finally:
-            try:
-                os.remove(tmp_path)
-            except:
-                pass
 
+class AsgiApp:
+    """ASGI-приложение поверх Flask-приложения.
 
-class TestUtilityFunctions:
-    """Тесты для вспомогательных функций"""
+    POST / обслуживается асинхронно: разбор формы и рендеринг идут в потоках,
+    а ожидание очереди к модели и ответа Space — в цикле asyncio, так что
+    ожидающий запрос не занимает поток. POST /analyze_stream ждет очереди так
+    же, а фрагменты допущенного потока читает в пуле вызовов модели: потоков
+    там столько, сколько вызовов пропускает лимит, и открытые потоки не
+    занимают пул, обслуживающий остальные маршруты. Остальные маршруты
+    выполняются как WSGI в пуле потоков с теми же хуками, ошибками и сессиями.
+    """
 
-    def test_allowed_file_valid_extensions(self):
-        """Тест проверки разрешенных расширений файлов"""
-        assert allowed_file('test.jpg') == True
-        assert allowed_file('test.jpeg') == True
-        assert allowed_file('test.png') == True
-        assert allowed_file('test.gif') == True
-        assert allowed_file('TEST.JPG') == True  # case insensitive
+    def __init__(self, wsgi_app, threads=None):
+        self.app = wsgi_app
+        self.threads = threads or ASGI_THREADS
+        self._executor = None
 
-    def test_allowed_file_invalid_extensions(self):
-        """Тест проверки неразрешенных расширений файлов"""
-        assert allowed_file('test.txt') == False
-        assert allowed_file('test.pdf') == False
-        assert allowed_file('test.exe') == False
-        assert allowed_file('test') == False  # no extension
-        assert allowed_file('') == False  # empty filename
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='asgi')
+        return self._executor
 
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if scope['method'] == 'POST' and scope['path'] == '/':
+                await self.form(scope, receive, send)
+            elif scope['method'] == 'POST' and scope['path'] == '/analyze_stream':
+                await self.stream(scope, receive, send)
+            else:
+                await self.wsgi(scope, receive, send)
 
-class TestIntegration:
-    """Интеграционные тесты"""
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
 
-    @patch.dict(os.environ, {'TOKEN_HUGGI': 'test_token'})
-    @patch('main.Client')
-    def test_full_workflow_mock(self, mock_client_class):
-        """Интеграционный тест полного workflow с моками"""
-        global client
-        client = None  # Сбрасываем глобальный клиент
+    async def run(self, context, fn, *args, executor=None):
+        """fn в пуле потоков внутри контекста context: в нем живет контекст запроса Flask"""
+        return await asyncio.get_running_loop().run_in_executor(executor or self.executor, context.run, fn, *args)
 
-        mock_client = Mock()
-        mock_client_class.return_value = mock_client
-        mock_client.predict.return_value = "mocked_result"
+    async def send_wsgi_response(self, context, environ, send, call, body_executor=None):
+        """Вызывает call(environ, start_response) в потоке и передает ответ, не накапливая его.
 
-        # Создаем временный файл
-        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_file:
-            temp_file.write(b"fake_image_data")
-            temp_file_path = temp_file.name
+        body_executor — пул, в котором читается тело ответа (по умолчанию общий).
+        """
+        started = {}
 
-        try:
-            # Тестируем полный workflow
-            client_instance = get_or_create_client()
-            result = analyze_image(temp_file_path, "test prompt")
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
 
-            assert result == {"success": True, "result": "mocked_result"}
-            mock_client.predict.assert_called_once()
+        iterable = await self.run(context, call, environ, start_response)
+        try:
+            iterator = iter(iterable)
+            # Потоковые ответы (SSE) отдают фрагменты по мере готовности
+            chunk = await self.run(context, next, iterator, None, executor=body_executor)
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await self.run(context, next, iterator, None, executor=body_executor)
+            await send({'type': 'http.response.body', 'body': b''})
         finally:
-            # Очистка
-            os.unlink(temp_file_path)
-
-    @pytest.fixture
-    def test_client(self):
-        """Создает тестовый клиент Flask для интеграционных тестов"""
-        app.config['TESTING'] = True
-        with app.test_client() as client:
-            yield client
-
-    @patch('main.analyze_image')
-    def test_full_flask_workflow(self, mock_analyze, test_client):
-        """Интеграционный тест полного Flask workflow"""
-        mock_analyze.return_value = {"success": True, "result": "integration_test_result"}
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                # Закрытие потока отменяет задачу в Space — это тоже вызов модели
+                await self.run(context, close, executor=body_executor)
 
-        # Создаем временный файл изображения
-        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
-            tmp.write(b"fake_image_data")
-            tmp_path = tmp.name
+    async def wsgi(self, scope, receive, send):
+        environ = asgi_environ(scope, AsgiInput(receive, asyncio.get_running_loop()))
+        await self.send_wsgi_response(contextvars.copy_context(), environ, send, self.app.wsgi_app)
 
+    async def form(self, scope, receive, send):
+        environ = asgi_environ(scope, AsgiInput(receive, asyncio.get_running_loop()))
+        context = contextvars.copy_context()
+        ctx, form, response = await self.run(context, start_form_request, environ)
         try:
-            with open(tmp_path, 'rb') as f:
-                data = {
-                    'image': (f, 'integration_test.jpg'),
-                    'prompt': 'integration test prompt'
-                }
-                response = test_client.post('/', data=data)
+            if response is None:
+                # Потребитель и трасса определены хуками admit_tenant и start_trace в контексте запроса
+                tenant_context.set(context.get(tenant_context))
+                current_span.set(context.get(current_span))
+                result = error = None
+                try:
+                    result = await analyze_image_async(*form)
+                except Exception as e:
+                    error = e
+                response = await self.run(context, finish_form_request, result, error)
+            await self.send_wsgi_response(context, environ, send, response)
+        finally:
+            await self.run(context, ctx.pop)
 
-                assert response.status_code == 200
-                assert "integration_test_result" in response.data.decode()
-                mock_analyze.assert_called_once()
+    async def stream(self, scope, receive, send):
+        environ = asgi_environ(scope, AsgiInput(receive, asyncio.get_running_loop()))
+        context = contextvars.copy_context()
+        ctx, form, response = await self.run(context, start_form_request, environ, stream_submission)
+        try:
+            if response is None:
+                tenant_context.set(context.get(tenant_context))
+                current_span.set(context.get(current_span))
+                events = error = None
+                try:
+                    events = await open_stream_async(*form)
+                except Exception as e:
+                    error = e
+                response = await self.run(context, finish_stream_request, form[0], events, error)
+            # Фрагмент потока ждет ответа Space, поэтому тело читается в пуле вызовов модели
+            await self.send_wsgi_response(context, environ, send, response, upstream_executor())
         finally:
-            try:
-                os.remove(tmp_path)
-            except:
-                pass
+            await self.run(context, ctx.pop)
 
 
-def run_flask_app():
-    """Запуск Flask приложения"""
-    print("🌐 Запуск Flask приложения...")
-    print("Откройте браузер и перейдите по адресу: http://localhost:5000")
-    print("Для остановки приложения нажмите Ctrl+C")
+asgi_app = AsgiApp(app)
+
 
-    # Проверяем наличие токена
+def prepare_serving():
+    """Проверка токена и прогрев клиентов перед запуском сервера"""
     try:
-        get_client()
+        get_token()
         print("✅ Токен Hugging Face найден")
     except ValueError as e:
         print(f"❌ {e}")
         print("Установите переменную окружения TOKEN_HUGGI")
+        return False
+
+    # Клиенты создаются в фоне, чтобы холодный старт не попадал на запросы пользователей
+    router.warm_up()
+    router.start_health_checks(CLIENT_HEALTH_INTERVAL)
+    return True
+
+
+def run_flask_app():
+    """Запуск Flask приложения"""
+    print("🌐 Запуск Flask приложения...")
+    print("Откройте браузер и перейдите по адресу: http://localhost:5000")
+    print("Для остановки приложения нажмите Ctrl+C")
+
+    if not prepare_serving():
         return
 
     # Запускаем Flask приложение
     app.run(host='0.0.0.0', port=5000, debug=False)
 
 
+def run_asgi_app():
+    """Запуск в режиме ASGI: ожидающие ответа модели запросы не занимают потоки"""
+    try:
+        import uvicorn
+    except ImportError:
+        print("❌ Для режима ASGI нужен uvicorn: pip install uvicorn")
+        return
+
+    print("🌐 Запуск приложения в режиме ASGI...")
+    print("Откройте браузер и перейдите по адресу: http://localhost:5000")
+    print("Для остановки приложения нажмите Ctrl+C")
+
+    if not prepare_serving():
+        return
+
+    uvicorn.run(asgi_app, host='0.0.0.0', port=5000, log_level='warning')
+
+
+TESTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main_test.py')
+
+
 def run_tests():
     """Запуск всех тестов с подробным выводом"""
     print("🧪 Запуск тестов...")
     print("=" * 50)
 
+    # Тесты и pytest загружаются только здесь, а не при обслуживании запросов
+    import pytest
+
     # Настройка pytest
     pytest_args = [
-        __file__,  # Текущий файл
+        TESTS_FILE,  # Файл с тестами
         "-v",  # Подробный вывод
         "-s",  # Показать print
         "--tb=short",  # Короткий traceback
@@ -594,6 +5159,12 @@ def run_tests():
         "-q",  # Тихий режим для менее загроможденного вывода
     ]
 
+    # Параллельный запуск через pytest-xdist, если он установлен
+    if TESTS_WORKERS not in ('', '0'):
+        import importlib.util
+        if importlib.util.find_spec('xdist'):
+            pytest_args += ["-n", TESTS_WORKERS]
+
     # Запуск тестов
     result = pytest.main(pytest_args)
 
@@ -606,5 +5177,10 @@ def run_tests():
 
 
 if __name__ == "__main__":
-    # Запуск Flask приложения сразу, без меню
-    run_flask_app()
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        sys.exit(run_tests())
+    elif len(sys.argv) > 1 and sys.argv[1] == "asgi":
+        run_asgi_app()
+    else:
+        # Запуск Flask приложения сразу, без меню
+        run_flask_app()
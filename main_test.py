@@ -0,0 +1,2878 @@
+"""Тесты веб-приложения распознавания изображений (main.py)"""
+import asyncio
+import gzip
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from unittest.mock import Mock, patch
+
+import pytest
+
+import main
+from benchmarks import fake_gradio
+from main import (
+    DEFAULT_PARAMS,
+    MAX_IMAGES_PER_REQUEST,
+    UPLOAD_SPOOL_DIR,
+    AdaptiveLimiter,
+    AsgiApp,
+    Backend,
+    BackendRouter,
+    CircuitBreaker,
+    CircuitOpenError,
+    ClientPool,
+    Counter,
+    FairScheduler,
+    Histogram,
+    JobQueue,
+    LatencyWindow,
+    NearDuplicateIndex,
+    OtlpExporter,
+    OverloadedError,
+    PoolTimeoutError,
+    ProfileStats,
+    PytestRunner,
+    QueueFullError,
+    ResultCache,
+    ResultHistory,
+    RetryBudget,
+    STATIC_ASSETS,
+    SingleFlight,
+    Tenant,
+    TenantRegistry,
+    TokenBucket,
+    Tracer,
+    UploadBudget,
+    UploadRejected,
+    ValidatingUpload,
+    allowed_file,
+    analyze_image,
+    app,
+    asgi_app,
+    client_pool,
+    extract_keyframes,
+    get_client,
+    job_queue,
+    cut_at_stop,
+    load_backends,
+    load_profiles,
+    profile_params,
+    make_cache_key,
+    parse_traceparent,
+    metrics,
+    prepared_image,
+    preprocess_image,
+    perceptual_hash,
+    preprocess_stats,
+    result_cache,
+    run_batch,
+    select_keyframes,
+    single_flight,
+    sniff_image,
+    stream_analyze_image,
+)
+
+
+@pytest.fixture(autouse=True)
+def fresh_upstream_guard(monkeypatch):
+    """Ошибки одного теста не должны размыкать цепь и расходовать бюджет повторов следующих"""
+    monkeypatch.setattr('main.upstream_limiter', AdaptiveLimiter())
+    monkeypatch.setattr('main.upstream_breaker', CircuitBreaker())
+    monkeypatch.setattr('main.retry_budget', RetryBudget())
+    monkeypatch.setattr('main.hedge_budget', RetryBudget())
+    monkeypatch.setattr('main.upstream_latency', LatencyWindow())
+    monkeypatch.setattr('main.near_duplicates', NearDuplicateIndex())
+    monkeypatch.setattr('main.router', BackendRouter(load_backends('')))
+    monkeypatch.setattr('main.tenants', TenantRegistry(''))
+    monkeypatch.setattr('main.fair_scheduler', FairScheduler(8))
+    monkeypatch.setattr('main.history', ResultHistory(''))
+    monkeypatch.setattr('main.tracer', Tracer(0))
+    monkeypatch.setattr('main.remote_files', ResultCache(0))
+    monkeypatch.setattr('main.profile_stats', ProfileStats())
+    monkeypatch.setattr('main.RETRY_BASE_DELAY', 0)
+
+
+@pytest.fixture
+def test_client():
+    """Создает тестовый клиент Flask"""
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        yield client
+
+
+@pytest.fixture
+def start_fake_space(monkeypatch):
+    """Запускает фейковый Space с заданными настройками и направляет на него приложение"""
+    servers = []
+
+    def start(**options):
+        monkeypatch.setenv('TOKEN_HUGGI', 'test_token')
+        monkeypatch.setenv('HF_HUB_DISABLE_TELEMETRY', '1')
+        server, url = fake_gradio.start_in_thread(**options)
+        servers.append(server)
+        monkeypatch.setattr('main.GRADIO_SRC', url)
+        monkeypatch.setattr('main.client_pool', ClientPool(size=1))
+        return server.RequestHandlerClass.state
+
+    result_cache.clear()
+    yield start
+    for server in servers:
+        server.shutdown()
+    result_cache.clear()
+
+
+@pytest.fixture
+def fake_space(start_fake_space):
+    """Состояние фейкового Space с быстрым потоковым ответом из трех фрагментов"""
+    return start_fake_space(latency=0.01, chunks=3, chunk_delay=0.01)
+
+
+def image_bytes(tail=b"", image_format='PNG', size=(8, 8)):
+    """Маленькое валидное изображение; байты после конца файла делают содержимое уникальным"""
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 100, 50)).save(buffer, format=image_format)
+    return buffer.getvalue() + tail
+
+
+class TestGetClient:
+    """Тесты для функции get_client"""
+
+    @patch.dict(os.environ, {'TOKEN_HUGGI': 'test_token'})
+    @patch('gradio_client.Client')
+    def test_get_client_with_token_success(self, mock_client_class):
+        """Тест успешного создания клиента с токеном"""
+        mock_client_instance = Mock()
+        mock_client_class.return_value = mock_client_instance
+
+        result = get_client()
+
+        mock_client_class.assert_called_once_with("amd/llama4-maverick-17b-128e-mi-amd")
+        assert result == mock_client_instance
+
+    @patch.dict(os.environ, {'TOKEN_HUGGI': 'test_token'})
+    @patch('gradio_client.Client')
+    def test_client_pool_reuses_client(self, mock_client_class):
+        """Тест повторного использования клиента из пула"""
+        pool = ClientPool(size=2)
+
+        mock_client_instance = Mock()
+        mock_client_class.return_value = mock_client_instance
+
+        # Первый запрос
+        with pool.acquire() as result1:
+            pass
+        # Второй запрос
+        with pool.acquire() as result2:
+            pass
+
+        mock_client_class.assert_called_once_with("amd/llama4-maverick-17b-128e-mi-amd")
+        assert result1 == result2 == mock_client_instance
+
+    @patch.dict(os.environ, {}, clear=True)
+    def test_get_client_without_token(self):
+        """Тест отсутствия токена"""
+        with pytest.raises(ValueError):
+            get_client()
+
+
+class TestClientPool:
+    """Тесты для пула клиентов"""
+
+    def test_concurrent_first_requests_create_bounded_clients(self):
+        """Тест одновременных первых запросов: клиентов не больше размера пула"""
+        created = []
+
+        def factory():
+            time.sleep(0.02)
+            created.append(object())
+            return created[-1]
+
+        pool = ClientPool(size=2, factory=factory)
+
+        def use():
+            with pool.acquire():
+                time.sleep(0.01)
+
+        threads = [threading.Thread(target=use) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(created) == 2
+        stats = pool.stats()
+        assert stats["acquisitions"] == 8
+        assert stats["idle"] == 2
+        assert stats["wait_time_max"] > 0
+
+    def test_acquire_timeout(self):
+        """Тест таймаута ожидания свободного клиента"""
+        pool = ClientPool(size=1, factory=object, acquire_timeout=0.05)
+        with pool.acquire():
+            with pytest.raises(PoolTimeoutError):
+                with pool.acquire():
+                    pass
+
+    def test_broken_client_is_replaced(self):
+        """Тест замены клиента после сетевой ошибки"""
+        pool = ClientPool(size=1, factory=object)
+        with pytest.raises(ConnectionError):
+            with pool.acquire() as first:
+                raise ConnectionError("reset")
+        with pool.acquire() as second:
+            pass
+
+        assert first is not second
+        assert pool.stats()["replaced"] == 1
+
+    def test_application_error_keeps_client(self):
+        """Тест: ошибка модели не приводит к замене клиента"""
+        pool = ClientPool(size=1, factory=object)
+        with pytest.raises(ValueError):
+            with pool.acquire() as first:
+                raise ValueError("bad input")
+        with pool.acquire() as second:
+            pass
+
+        assert first is second
+
+    def test_health_check_and_warm_up(self):
+        """Тест прогрева и удаления нездоровых клиентов"""
+        pool = ClientPool(size=2, factory=object, health_check=lambda client: False)
+        pool.warm_up().join()
+        assert pool.stats()["idle"] == 2
+
+        pool.check_health()
+
+        stats = pool.stats()
+        assert stats["idle"] == 0
+        assert stats["health_failures"] == 2
+
+    def test_health_check_does_not_block_acquire(self):
+        """Тест: пока идет медленная проверка, клиенты выдаются без ожидания"""
+        checking = threading.Event()
+        verdicts = {}
+
+        def slow_check(client):
+            checking.set()
+            time.sleep(0.5)
+            return verdicts.get(client, True)
+
+        pool = ClientPool(size=1, factory=object, health_check=slow_check)
+        with pool.acquire() as client:
+            pass
+        verdicts[client] = False
+        checker = threading.Thread(target=pool.check_health)
+        checker.start()
+        checking.wait(1)
+
+        started = time.monotonic()
+        with pool.acquire(timeout=1) as busy:
+            waited = time.monotonic() - started
+            checker.join()
+        with pool.acquire(timeout=1) as replacement:
+            pass
+
+        assert waited < 0.2
+        assert busy is client
+        # Клиент не прошел проверку, пока был занят, и заменен при возврате
+        assert replacement is not client
+        assert pool.stats()["replaced"] == 1
+
+
+class TestAnalyzeImage:
+    """Тесты для функции analyze_image"""
+
+    @patch('main.client_pool')
+    @patch('main.handle_file')
+    def test_analyze_image_success(self, mock_handle_file, mock_pool):
+        """Тест успешного анализа изображения"""
+        mock_client = Mock()
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+        mock_handle_file.return_value = "mocked_file"
+        mock_client.predict.return_value = "test_result"
+
+        result = analyze_image("test_image.jpg", "test prompt")
+
+        mock_handle_file.assert_called_once_with("test_image.jpg")
+        mock_client.predict.assert_called_once_with(
+            message={"text": "test prompt", "files": ["mocked_file"]},
+            param_2="",
+            param_3=2048,
+            param_4=0.3,
+            param_5=0,
+            param_6=0,
+            api_name="/chat"
+        )
+        assert result == {"success": True, "result": "test_result"}
+
+    @patch('main.client_pool')
+    @patch('main.handle_file')
+    def test_analyze_image_client_error(self, mock_handle_file, mock_pool):
+        """Тест обработки ошибки клиента"""
+        mock_client = Mock()
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+        mock_handle_file.return_value = "mocked_file"
+        mock_client.predict.side_effect = Exception("API Error")
+
+        result = analyze_image("test_image.jpg", "test prompt")
+
+        assert result == {"success": False, "error": "API Error"}
+
+    @patch('main.client_pool')
+    @patch('main.handle_file')
+    def test_analyze_image_invalid_response_format(self, mock_handle_file, mock_pool):
+        """Тест обработки неверного формата ответа (неактуально, т.к. теперь возвращается строка)"""
+        mock_client = Mock()
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+        mock_handle_file.return_value = "mocked_file"
+        mock_client.predict.return_value = None
+
+        result = analyze_image("test_image.jpg", "test prompt")
+
+        assert result["success"] is True
+        assert result["result"] is None
+
+    @patch('main.client_pool')
+    @patch('main.handle_file')
+    def test_analyze_image_empty_prompt(self, mock_handle_file, mock_pool):
+        """Тест с пустым промптом"""
+        mock_client = Mock()
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+        mock_handle_file.return_value = "mocked_file"
+        mock_client.predict.return_value = "empty_result"
+
+        result = analyze_image("test_image.jpg", "")
+
+        mock_client.predict.assert_called_once_with(
+            message={"text": "", "files": ["mocked_file"]},
+            param_2="",
+            param_3=2048,
+            param_4=0.3,
+            param_5=0,
+            param_6=0,
+            api_name="/chat"
+        )
+        assert result == {"success": True, "result": "empty_result"}
+
+
+class TestFlaskApp:
+    """Тесты для Flask приложения"""
+
+    def test_get_homepage(self, test_client):
+        """Тест загрузки главной страницы"""
+        response = test_client.get('/')
+        assert response.status_code == 200
+        assert "Распознавание изображений - Paligemma" in response.data.decode()
+
+    def test_post_without_file(self, test_client):
+        """Тест POST запроса без файла"""
+        response = test_client.post('/', data={'prompt': 'test prompt'}, follow_redirects=True)
+        assert "Файл не был загружен" in response.data.decode()
+
+    def test_post_without_prompt(self, test_client):
+        """Тест POST запроса без промпта"""
+        # Создаем временный файл изображения
+        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
+            tmp.write(image_bytes())
+            tmp_path = tmp.name
+
+        try:
+            with open(tmp_path, 'rb') as f:
+                data = {
+                    'image': (f, 'test.jpg'),
+                    'prompt': ''
+                }
+                response = test_client.post('/', data=data, follow_redirects=True)
+                assert "Введите текстовый промпт" in response.data.decode()
+        finally:
+            try:
+                os.remove(tmp_path)
+            except:
+                pass
+
+    def test_post_invalid_file_type(self, test_client):
+        """Тест POST запроса с неподдерживаемым типом файла"""
+        # Создаем временный файл с неподдерживаемым расширением
+        with tempfile.NamedTemporaryFile(suffix='.txt', delete=False) as tmp:
+            tmp.write(b"fake_text_data")
+            tmp_path = tmp.name
+
+        try:
+            with open(tmp_path, 'rb') as f:
+                data = {
+                    'image': (f, 'test.txt'),
+                    'prompt': 'test prompt'
+                }
+                response = test_client.post('/', data=data, follow_redirects=True)
+                # Проверяем, что показывается сообщение об ошибке
+                assert "Неподдерживаемый формат файла" in response.data.decode()
+        finally:
+            try:
+                os.remove(tmp_path)
+            except:
+                pass
+
+    @patch('main.analyze_image')
+    @patch('os.remove')
+    def test_post_successful_analysis(self, mock_remove, mock_analyze, test_client):
+        """Тест успешного анализа изображения"""
+        mock_analyze.return_value = {"success": True, "result": "test_result"}
+
+        # Создаем временный файл изображения
+        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
+            tmp.write(image_bytes())
+            tmp_path = tmp.name
+
+        try:
+            with open(tmp_path, 'rb') as f:
+                data = {
+                    'image': (f, 'test.jpg'),
+                    'prompt': 'test prompt'
+                }
+                response = test_client.post('/', data=data)
+
+                assert response.status_code == 200
+                assert "test_result" in response.data.decode()
+                mock_analyze.assert_called_once()
+        finally:
+            try:
+                os.remove(tmp_path)
+            except:
+                pass
+
+    @patch('main.analyze_image')
+    @patch('os.remove')
+    def test_post_failed_analysis(self, mock_remove, mock_analyze, test_client):
+        """Тест неудачного анализа изображения"""
+        mock_analyze.return_value = {"success": False, "error": "API Error"}
+
+        # Создаем временный файл изображения
+        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
+            tmp.write(image_bytes())
+            tmp_path = tmp.name
+
+        try:
+            with open(tmp_path, 'rb') as f:
+                data = {
+                    'image': (f, 'test.jpg'),
+                    'prompt': 'test prompt'
+                }
+                response = test_client.post('/', data=data, follow_redirects=True)
+
+                # Проверяем, что показывается сообщение об ошибке
+                assert "Ошибка анализа: API Error" in response.data.decode()
+                mock_analyze.assert_called_once()
+        finally:
+            try:
+                os.remove(tmp_path)
+            except:
+                pass
+
+
+class TestUtilityFunctions:
+    """Тесты для вспомогательных функций"""
+
+    def test_allowed_file_valid_extensions(self):
+        """Тест проверки разрешенных расширений файлов"""
+        assert allowed_file('test.jpg') == True
+        assert allowed_file('test.jpeg') == True
+        assert allowed_file('test.png') == True
+        assert allowed_file('test.gif') == True
+        assert allowed_file('TEST.JPG') == True  # case insensitive
+
+    def test_allowed_file_invalid_extensions(self):
+        """Тест проверки неразрешенных расширений файлов"""
+        assert allowed_file('test.txt') == False
+        assert allowed_file('test.pdf') == False
+        assert allowed_file('test.exe') == False
+        assert allowed_file('test') == False  # no extension
+        assert allowed_file('') == False  # empty filename
+
+
+class TestUploadSpool:
+    """Тесты для приема загрузок без записи в рабочий каталог"""
+
+    @patch('main.analyze_image')
+    def test_upload_spooled_and_removed(self, mock_analyze, test_client):
+        """Тест: файл принимается в спул, содержимое доступно, после запроса удаляется"""
+        seen = {}
+
+        def fake_analyze(paths, prompt, profile=None):
+            for path in paths:
+                with open(path, 'rb') as f:
+                    seen[path] = f.read()
+            return {"success": True, "result": "ok"}
+        mock_analyze.side_effect = fake_analyze
+
+        for _ in range(2):
+            data = {'image': (io.BytesIO(image_bytes(b"same_name_image")), 'photo.jpg'), 'prompt': 'p'}
+            response = test_client.post('/', data=data, content_type='multipart/form-data')
+            assert response.status_code == 200
+
+        assert len(seen) == 2  # одинаковые имена не конфликтуют
+        for path, content in seen.items():
+            assert os.path.dirname(path) == UPLOAD_SPOOL_DIR
+            assert path.endswith('.jpg')
+            assert content == image_bytes(b"same_name_image")
+            assert not os.path.exists(path)
+        assert not os.path.exists('temp_photo.jpg')
+
+    def test_upload_budget_limits_in_flight_bytes(self):
+        """Тест ограничения суммарного объема загрузок"""
+        budget = UploadBudget(limit=100)
+        assert budget.acquire(80, timeout=0) == 80
+        assert budget.acquire(30, timeout=0.01) == 0
+        budget.release(80)
+        assert budget.acquire(500, timeout=0) == 100  # большой запрос занимает весь бюджет
+        assert budget.stats()["rejected"] == 1
+
+    def test_upload_rejected_when_budget_exhausted(self, test_client):
+        """Тест ответа 503 при исчерпании бюджета"""
+        budget = UploadBudget(limit=10)
+        budget.acquire(10, timeout=0)
+        with patch('main.upload_budget', budget), patch('main.UPLOAD_BUDGET_TIMEOUT', 0):
+            response = test_client.post('/', data={'image': (io.BytesIO(image_bytes(b"img")), 'a.jpg'), 'prompt': 'p'},
+                                        content_type='multipart/form-data')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+
+    @patch('main.analyze_image')
+    def test_queued_job_keeps_its_upload_in_budget(self, mock_analyze, test_client, monkeypatch):
+        """Тест: файл задачи в очереди занимает бюджет загрузок до удаления"""
+        budget = UploadBudget(limit=10 * 1024 * 1024)
+        monkeypatch.setattr('main.upload_budget', budget)
+        monkeypatch.setattr('main.job_queue', JobQueue(workers=1))
+        release = threading.Event()
+
+        def slow_analyze(paths, prompt, profile=None):
+            release.wait(2)
+            return {"success": True, "result": "ok"}
+        mock_analyze.side_effect = slow_analyze
+        content = image_bytes(b"queued")
+
+        response = test_client.post('/jobs', data={'image': (io.BytesIO(content), 'a.png'), 'prompt': 'p'},
+                                    content_type='multipart/form-data')
+        held = budget.stats()["in_use"]
+        release.set()
+        job_id = response.get_json()["job_id"]
+        deadline = time.monotonic() + 2
+        while main.job_queue.get(job_id)["status"] != "done" and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert held == len(content)
+        assert budget.stats()["in_use"] == 0
+
+
+class TestPreprocessing:
+    """Тесты для предобработки изображений"""
+
+    @staticmethod
+    def make_image(path, size, image_format, mode='RGB', **save_kwargs):
+        from PIL import Image
+        Image.new(mode, size, (200, 100, 50) if mode == 'RGB' else 0).save(path, format=image_format, **save_kwargs)
+        return str(path)
+
+    def test_downscale_and_strip_metadata(self, tmp_path):
+        """Тест уменьшения размера и удаления EXIF"""
+        from PIL import Image
+        exif = Image.Exif()
+        exif[0x010F] = "Camera"
+        source = self.make_image(tmp_path / "big.png", (3000, 1500), 'PNG', exif=exif)
+
+        output = preprocess_image(source, max_side=1000, image_format='JPEG', quality=80)
+        try:
+            with Image.open(output) as img:
+                assert img.format == 'JPEG'
+                assert img.size == (1000, 500)
+                assert not img.getexif()
+            assert os.path.getsize(output) < os.path.getsize(source)
+        finally:
+            os.remove(output)
+
+    def test_gif_first_frame(self, tmp_path):
+        """Тест извлечения первого кадра GIF"""
+        from PIL import Image
+        frames = [Image.new('RGB', (2000, 2000), color) for color in ((255, 0, 0), (0, 0, 255))]
+        source = str(tmp_path / "anim.gif")
+        frames[0].save(source, save_all=True, append_images=frames[1:], duration=100)
+
+        output = preprocess_image(source, max_side=500, image_format='WEBP')
+        try:
+            with Image.open(output) as img:
+                assert img.format == 'WEBP'
+                assert getattr(img, 'n_frames', 1) == 1
+                red, green, blue = img.convert('RGB').getpixel((10, 10))
+                assert red > 200 and blue < 50
+        finally:
+            os.remove(output)
+
+    def test_small_image_kept_as_is(self, tmp_path):
+        """Тест: маленькое изображение не перекодируется, если выигрыша нет"""
+        from PIL import Image
+        source = str(tmp_path / "small.jpg")
+        Image.frombytes('RGB', (64, 64), os.urandom(64 * 64 * 3)).save(source, format='JPEG', quality=30)
+        assert preprocess_image(source, max_side=1000, quality=95) is None
+
+    def test_prepared_image_falls_back_and_cleans_up(self, tmp_path):
+        """Тест: не изображение отправляется как есть, временный файл удаляется"""
+        preprocess_stats.reset()
+        fake = tmp_path / "fake.jpg"
+        fake.write_bytes(b"not an image")
+        with prepared_image(str(fake)) as path:
+            assert path == str(fake)
+
+        source = self.make_image(tmp_path / "big.png", (2000, 2000), 'PNG')
+        with prepared_image(source) as path:
+            assert path != source
+            assert os.path.exists(path)
+        assert not os.path.exists(path)
+
+        stats = preprocess_stats.stats()
+        assert stats["errors"] == 1
+        assert stats["processed"] == 1
+        assert stats["bytes_after"] < stats["bytes_before"]
+
+
+class TestResultCache:
+    """Тесты для кэша результатов"""
+
+    def test_lru_eviction_and_counters(self):
+        """Тест вытеснения самой старой записи"""
+        cache = ResultCache(max_size=2, ttl=60)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        assert cache.get("a") == (True, "1")
+        cache.set("c", "3")
+
+        assert cache.get("b") == (False, None)
+        assert cache.get("a") == (True, "1")
+        stats = cache.stats()
+        assert stats["hits"] == 2
+        assert stats["misses"] == 1
+        assert stats["evictions"] == 1
+
+    def test_ttl_expiration(self):
+        """Тест истечения срока жизни записи"""
+        cache = ResultCache(max_size=2, ttl=-1)
+        cache.set("a", "1")
+        assert cache.get("a") == (False, None)
+
+    def test_disk_tier_survives_restart(self, tmp_path):
+        """Тест дискового уровня кэша"""
+        ResultCache(max_size=2, ttl=60, disk_dir=str(tmp_path)).set("a", "1")
+
+        cache = ResultCache(max_size=2, ttl=60, disk_dir=str(tmp_path))
+        assert cache.get("a") == (True, "1")
+        assert cache.stats()["disk_hits"] == 1
+
+    def test_disk_tier_is_bounded(self, tmp_path):
+        """Тест: дисковый уровень вытесняет давно не читанные записи и удаляет истекшие"""
+        cache = ResultCache(max_size=1, ttl=60, disk_dir=str(tmp_path), disk_max_entries=2)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        assert cache.get("a") == (True, "1")  # с диска: в памяти только b
+        cache.set("c", "3")
+
+        assert sorted(os.listdir(tmp_path)) == ["a.json", "c.json"]
+        assert cache.stats()["disk_evictions"] == 1
+
+        by_bytes = ResultCache(max_size=1, ttl=60, disk_dir=str(tmp_path / "bytes"), disk_max_bytes=100)
+        for key in "xyz":
+            by_bytes.set(key, key * 40)
+        assert by_bytes.stats()["disk_bytes"] <= 100
+        assert len(os.listdir(tmp_path / "bytes")) == by_bytes.stats()["disk_size"] == 1
+
+        expired = ResultCache(max_size=1, ttl=-1, disk_dir=str(tmp_path / "expired"), disk_sweep_interval=0)
+        expired.set("old", "1")
+        expired.set("new", "2")
+        assert os.listdir(tmp_path / "expired") == []
+
+    def test_disk_tier_limits_apply_after_restart_and_clear(self, tmp_path):
+        """Тест: записи прошлого запуска учитываются в пределах, clear() очищает и диск"""
+        first = ResultCache(max_size=1, ttl=60, disk_dir=str(tmp_path))
+        for key in "abc":
+            first.set(key, key)
+            time.sleep(0.01)
+
+        cache = ResultCache(max_size=1, ttl=60, disk_dir=str(tmp_path), disk_max_entries=2)
+        assert sorted(os.listdir(tmp_path)) == ["b.json", "c.json"]
+
+        cache.clear()
+        assert os.listdir(tmp_path) == []
+        assert cache.stats()["disk_size"] == 0
+
+    def test_cache_key_normalizes_prompt(self):
+        """Тест нормализации промпта в ключе кэша"""
+        key1 = make_cache_key("hash", "  What   is this? ", DEFAULT_PARAMS)
+        key2 = make_cache_key("hash", "What is this?", DEFAULT_PARAMS)
+        key3 = make_cache_key("hash", "What is this?", dict(DEFAULT_PARAMS, param_3=100))
+        assert key1 == key2
+        assert key1 != key3
+
+    @patch('main.client_pool')
+    @patch('main.handle_file')
+    def test_analyze_image_uses_cache(self, mock_handle_file, mock_pool, tmp_path):
+        """Тест повторного запроса того же изображения с тем же промптом"""
+        result_cache.clear()
+        mock_client = Mock()
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+        mock_handle_file.return_value = "mocked_file"
+        mock_client.predict.return_value = "cached_result"
+        image_path = tmp_path / "image.jpg"
+        image_path.write_bytes(b"cache_test_image")
+
+        try:
+            first = analyze_image(str(image_path), "test prompt")
+            second = analyze_image(str(image_path), "test  prompt ")
+        finally:
+            result_cache.clear()
+
+        assert first == second == {"success": True, "result": "cached_result"}
+        mock_client.predict.assert_called_once()
+
+
+class TestStreaming:
+    """Тесты для потокового вывода"""
+
+    @staticmethod
+    def make_job(outputs, final):
+        job = Mock()
+        job.__iter__ = Mock(return_value=iter(outputs))
+        job.result.return_value = final
+        job.done.return_value = True
+        return job
+
+    @patch('main.client_pool')
+    @patch('main.handle_file')
+    def test_stream_yields_increments(self, mock_handle_file, mock_pool):
+        """Тест передачи только прироста текста"""
+        mock_client = Mock()
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+        mock_handle_file.return_value = "mocked_file"
+        mock_client.submit.return_value = self.make_job(["Это", "Это кот", "Это кот."], "Это кот.")
+
+        events = list(stream_analyze_image("test_image.jpg", "test prompt"))
+
+        assert events == [("delta", "Это"), ("delta", " кот"), ("delta", "."), ("done", "Это кот.")]
+        mock_client.submit.assert_called_once_with(
+            message={"text": "test prompt", "files": ["mocked_file"]},
+            **DEFAULT_PARAMS,
+            api_name="/chat"
+        )
+
+    @patch('main.client_pool')
+    @patch('main.handle_file')
+    def test_stream_replace_and_error(self, mock_handle_file, mock_pool):
+        """Тест замены текста и ошибки модели"""
+        mock_client = Mock()
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+        mock_handle_file.return_value = "mocked_file"
+        job = self.make_job(["Собака", "Кот"], None)
+        job.result.side_effect = Exception("API Error")
+        mock_client.submit.return_value = job
+
+        events = list(stream_analyze_image("test_image.jpg", "test prompt"))
+
+        assert events == [("delta", "Собака"), ("replace", "Кот"), ("error", "API Error")]
+
+    @patch('main.open_stream')
+    def test_stream_endpoint_sse(self, mock_stream, test_client):
+        """Тест формата Server-Sent Events"""
+        mock_stream.return_value = (event for event in [("delta", "Кот"), ("done", "Кот")])
+
+        response = test_client.post('/analyze_stream',
+                                    data={'image': (io.BytesIO(image_bytes(b"img")), 'a.jpg'), 'prompt': 'p'},
+                                    content_type='multipart/form-data')
+
+        assert response.mimetype == 'text/event-stream'
+        body = response.get_data(as_text=True)
+        assert 'event: delta\ndata: {"text": "Кот"}\n\n' in body
+        assert 'event: done' in body
+
+    @patch('main.client_pool')
+    def test_stream_rejected_before_response(self, mock_pool, test_client, monkeypatch):
+        """Тест: при разомкнутой цепи поток отклоняется кодом 503 с Retry-After, а не событием в 200"""
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        breaker.allow()
+        breaker.record_failure()
+        monkeypatch.setattr('main.upstream_breaker', breaker)
+        budget = UploadBudget(10 * 1024 * 1024)
+        monkeypatch.setattr('main.upload_budget', budget)
+
+        response = test_client.post('/analyze_stream',
+                                    data={'image': (io.BytesIO(image_bytes(b"img")), 'a.jpg'), 'prompt': 'p'},
+                                    content_type='multipart/form-data')
+
+        assert response.status_code == 503
+        assert int(response.headers['Retry-After']) >= 1
+        assert response.get_json()["success"] is False
+        assert not mock_pool.acquire.called
+        assert budget.stats()["in_use"] == 0
+        assert main.detached_uploads == {}
+
+
+class TestBatchAnalysis:
+    """Тесты для пакетного анализа"""
+
+    @patch('main.analyze_image')
+    def test_run_batch_keeps_input_order(self, mock_analyze):
+        """Тест порядка результатов при разном времени выполнения"""
+        def fake_analyze(path, prompt, profile=None):
+            time.sleep(0.05 if path == "slow.jpg" else 0)
+            return {"success": True, "result": path}
+        mock_analyze.side_effect = fake_analyze
+
+        results = run_batch([("slow.jpg", "p"), ("fast.jpg", "p")])
+
+        assert [r["result"] for r in results] == ["slow.jpg", "fast.jpg"]
+
+    @patch('main.analyze_image')
+    def test_run_batch_item_timeout(self, mock_analyze):
+        """Тест таймаута отдельного элемента"""
+        def fake_analyze(path, prompt, profile=None):
+            if path == "stuck.jpg":
+                time.sleep(0.5)
+            return {"success": True, "result": path}
+        mock_analyze.side_effect = fake_analyze
+
+        results = run_batch([("stuck.jpg", "p"), ("ok.jpg", "p")], item_timeout=0.1)
+
+        assert results[0]["success"] is False
+        assert "время ожидания" in results[0]["error"]
+        assert results[1] == {"success": True, "result": "ok.jpg"}
+
+    @patch('main.analyze_image')
+    def test_batches_share_one_worker_limit(self, mock_analyze, monkeypatch):
+        """Тест: одновременные пакеты делят общий предел потоков"""
+        executor = ThreadPoolExecutor(max_workers=2)
+        monkeypatch.setattr('main.batch_executor', lambda: executor)
+        lock = threading.Lock()
+        active = [0]
+        peak = [0]
+
+        def fake_analyze(path, prompt, profile=None):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return {"success": True, "result": path}
+        mock_analyze.side_effect = fake_analyze
+
+        results = []
+        batches = [threading.Thread(target=lambda: results.append(run_batch([("a", "p"), ("b", "p"), ("c", "p")])))
+                   for _ in range(3)]
+        for thread in batches:
+            thread.start()
+        for thread in batches:
+            thread.join()
+        executor.shutdown()
+
+        assert peak[0] == 2
+        assert all(item["success"] for batch in results for item in batch)
+
+    @patch('main.predict_prepared')
+    def test_timed_out_item_does_not_reach_upstream(self, mock_predict, monkeypatch):
+        """Тест: элемент, простоявший в очереди к модели дольше таймаута, не вызывает модель"""
+        monkeypatch.setattr('main.fair_scheduler', FairScheduler(1))
+        mock_predict.return_value = "late"
+        main.fair_scheduler.acquire(main.current_tenant())
+        try:
+            results = run_batch([("missing.jpg", "p")], item_timeout=0.2)
+        finally:
+            main.fair_scheduler.release()
+        time.sleep(0.3)
+
+        assert "время ожидания" in results[0]["error"]
+        mock_predict.assert_not_called()
+        assert main.fair_scheduler.in_flight == 0
+        assert main.upstream_limiter.stats()["in_flight"] == 0
+
+    @patch('main.analyze_image')
+    def test_batch_endpoint_per_item_prompts_and_errors(self, mock_analyze, test_client):
+        """Тест эндпоинта с индивидуальными промптами и ошибками элементов"""
+        mock_analyze.side_effect = lambda path, prompt, profile=None: {"success": True, "result": prompt}
+
+        data = {
+            'images': [(io.BytesIO(image_bytes(b"img1")), 'a.jpg'), (io.BytesIO(b"txt"), 'b.txt'),
+                       (io.BytesIO(image_bytes(b"img3")), 'c.png')],
+            'prompts': ['first', 'second', 'third'],
+        }
+        response = test_client.post('/analyze_batch', data=data, content_type='multipart/form-data')
+
+        body = response.get_json()
+        assert response.status_code == 200
+        assert body["succeeded"] == 2
+        assert [item["filename"] for item in body["results"]] == ['a.jpg', 'b.txt', 'c.png']
+        assert body["results"][0]["result"] == "first"
+        assert body["results"][1]["success"] is False
+        assert body["results"][2]["result"] == "third"
+
+    @patch('main.analyze_image')
+    def test_batch_rejects_bad_uploads_per_item(self, mock_analyze, test_client, monkeypatch):
+        """Тест: не изображение и слишком большой файл отклоняются только для своего элемента"""
+        mock_analyze.side_effect = lambda path, prompt, profile=None: {"success": True, "result": prompt}
+        monkeypatch.setattr('main.UPLOAD_MAX_FILE_SIZE', 4096)
+        before = metrics.upload_rejections.value('signature')
+
+        data = {
+            'images': [(io.BytesIO(b"#!/bin/sh\necho hi\n"), 'a.jpg'),
+                       (io.BytesIO(image_bytes(b"img2")), 'b.png'),
+                       (io.BytesIO(image_bytes(b"\x00" * 8192)), 'c.png'),
+                       (io.BytesIO(image_bytes(b"img4")), 'd.png')],
+            'prompts': ['first', 'second', 'third', 'fourth'],
+        }
+        response = test_client.post('/analyze_batch', data=data, content_type='multipart/form-data')
+
+        body = response.get_json()
+        assert response.status_code == 200
+        assert [item["filename"] for item in body["results"]] == ['a.jpg', 'b.png', 'c.png', 'd.png']
+        assert [item["success"] for item in body["results"]] == [False, True, False, True]
+        assert 'не является изображением' in body["results"][0]["error"]
+        assert body["results"][0]["status_code"] == 415
+        assert body["results"][2]["status_code"] == 413
+        assert sorted(call.args[1] for call in mock_analyze.call_args_list) == ['fourth', 'second']
+        assert metrics.upload_rejections.value('signature') == before + 1
+
+    def test_file_size_limit_defaults_to_request_limit(self):
+        """Тест: по умолчанию один файл может занять весь допустимый размер запроса"""
+        assert main.UPLOAD_MAX_FILE_SIZE == app.config['MAX_CONTENT_LENGTH']
+
+    def test_batch_endpoint_without_files(self, test_client):
+        """Тест эндпоинта без файлов"""
+        response = test_client.post('/analyze_batch', data={'prompt': 'p'})
+        assert response.status_code == 400
+
+
+class TestJobQueue:
+    """Тесты для очереди задач"""
+
+    @staticmethod
+    def wait_for(queue, job_id, status, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job = queue.get(job_id)
+            if job["status"] == status:
+                return job
+            time.sleep(0.01)
+        raise AssertionError(f"Задача не перешла в статус {status}")
+
+    @patch('main.analyze_image')
+    def test_job_lifecycle_and_queue_position(self, mock_analyze):
+        """Тест очереди: позиция, выполнение и результат"""
+        release = threading.Event()
+
+        def fake_analyze(path, prompt, profile=None):
+            release.wait(2)
+            return {"success": True, "result": prompt}
+        mock_analyze.side_effect = fake_analyze
+
+        queue = JobQueue(workers=1, retention=60)
+        first = queue.submit("missing1.jpg", "first")
+        self.wait_for(queue, first, "running")
+        second = queue.submit("missing2.jpg", "second")
+
+        assert queue.get(second)["queue_position"] == 1
+        release.set()
+        done = self.wait_for(queue, second, "done")
+        assert done["result"] == "second"
+        assert done["wait_time"] >= 0
+        assert done["run_time"] >= 0
+
+    @patch('main.analyze_image')
+    def test_failed_job_and_retention(self, mock_analyze):
+        """Тест неудачной задачи и удаления по истечении хранения"""
+        mock_analyze.return_value = {"success": False, "error": "API Error"}
+
+        queue = JobQueue(workers=1, retention=0.2)
+        job_id = queue.submit("missing.jpg", "prompt")
+        job = self.wait_for(queue, job_id, "failed")
+        assert job["error"] == "API Error"
+
+        time.sleep(0.25)
+        assert queue.get(job_id) is None
+
+    def test_queue_full(self):
+        """Тест переполнения очереди"""
+        queue = JobQueue(workers=0, retention=60, max_queued=1)
+        queue.submit("a.jpg", "p")
+        with pytest.raises(QueueFullError):
+            queue.submit("b.jpg", "p")
+
+    @patch('main.analyze_image')
+    def test_submit_and_poll_endpoints(self, mock_analyze, test_client):
+        """Тест эндпоинтов постановки и опроса задачи"""
+        mock_analyze.return_value = {"success": True, "result": "job_result"}
+
+        response = test_client.post('/jobs', data={'image': (io.BytesIO(image_bytes(b"img")), 'a.jpg'), 'prompt': 'p'},
+                                    content_type='multipart/form-data')
+        assert response.status_code == 202
+        job_id = response.get_json()["job_id"]
+
+        self.wait_for(job_queue, job_id, "done")
+        body = test_client.get(f'/jobs/{job_id}').get_json()
+        assert body["result"] == "job_result"
+        assert test_client.get('/jobs/unknown').status_code == 404
+
+
+class TestSingleFlight:
+    """Тесты для объединения одинаковых запросов"""
+
+    def test_concurrent_duplicates_share_one_call(self):
+        """Тест: одновременные дубликаты ждут один вызов"""
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            release.wait(2)
+            return "shared"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do("key", slow))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 2
+        while flight.stats()["coalesced"] < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert calls == [1]
+        assert results == ["shared"] * 5
+        assert flight.stats() == {"executed": 1, "coalesced": 4, "in_flight": 0}
+
+    def test_error_is_shared_and_key_released(self):
+        """Тест: ошибка передается ожидающим, следующий вызов выполняется заново"""
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def failing():
+            started.set()
+            release.wait(2)
+            raise RuntimeError("API Error")
+
+        errors = []
+
+        def call():
+            try:
+                flight.do("key", failing)
+            except RuntimeError as e:
+                errors.append(str(e))
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(2)
+        follower = threading.Thread(target=call)
+        follower.start()
+        while flight.stats()["coalesced"] < 1:
+            time.sleep(0.01)
+        release.set()
+        leader.join()
+        follower.join()
+
+        assert errors == ["API Error", "API Error"]
+        assert flight.do("key", lambda: "fresh") == "fresh"
+
+    @patch('main.call_model')
+    def test_analyze_image_coalesces_by_cache_key(self, mock_call_model, tmp_path):
+        """Тест: analyze_image объединяет запросы с одинаковым ключом"""
+        result_cache.clear()
+        release = threading.Event()
+
+        def slow_call(*args, **kwargs):
+            release.wait(2)
+            return {"success": True, "result": "shared"}
+        mock_call_model.side_effect = slow_call
+        image_path = tmp_path / "image.jpg"
+        image_path.write_bytes(b"coalesce_test_image")
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(analyze_image(str(image_path), "p")))
+                   for _ in range(3)]
+        before = single_flight.stats()["coalesced"]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 2
+        while single_flight.stats()["coalesced"] - before < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert mock_call_model.call_count == 1
+        assert results == [{"success": True, "result": "shared"}] * 3
+
+
+class TestOverloadProtection:
+    """Тесты адаптивного лимита и размыкателя вокруг вызовов модели"""
+
+    def test_limit_sizes_fair_queue(self, monkeypatch):
+        """Тест: адаптивный лимит задает число мест очереди, вызовы сверх него ждут, а не отклоняются лимитером"""
+        limiter = AdaptiveLimiter(initial=2)
+        monkeypatch.setattr('main.upstream_limiter', limiter)
+        scheduler = FairScheduler(lambda: main.upstream_limiter.limit, timeout=0.02)
+        monkeypatch.setattr('main.fair_scheduler', scheduler)
+
+        with main.upstream_guard(), main.upstream_guard():
+            assert limiter.stats()["in_flight"] == 2
+            with pytest.raises(OverloadedError):
+                with main.upstream_guard():
+                    pass
+            assert scheduler.stats()["timed_out"] == 1
+        assert limiter.stats() == {"limit": limiter.limit, "in_flight": 0}
+
+    def test_limiter_adapts_to_latency_and_errors(self):
+        """Тест: медленные ответы и ошибки уменьшают лимит, быстрые — увеличивают"""
+        limiter = AdaptiveLimiter(initial=4, min_limit=1, target_latency=1.0, backoff=0.5)
+        limiter.acquire()
+        limiter.release(5.0, True)
+        assert limiter.limit == 2
+        limiter.acquire()
+        limiter.release(0.1, False)
+        assert limiter.limit == 1
+        limiter.acquire()
+        limiter.release(0.1, True)
+        assert limiter.limit == 2
+        limiter.acquire()
+        limiter.release(0.1, None)
+        assert limiter.limit == 2
+
+    def test_breaker_opens_and_recovers_after_probe(self):
+        """Тест: серия ошибок размыкает цепь, успешная проба замыкает ее"""
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+        for _ in range(2):
+            breaker.allow()
+            breaker.record_failure()
+
+        with pytest.raises(CircuitOpenError) as error:
+            breaker.allow()
+        assert error.value.retry_after >= 1
+
+        time.sleep(0.15)
+        breaker.allow()
+        # Пока идет проба, остальные запросы отклоняются
+        with pytest.raises(CircuitOpenError):
+            breaker.allow()
+        breaker.record_success()
+        breaker.allow()
+        assert breaker.stats()["state"] == "closed"
+
+    def test_failed_probe_reopens_circuit(self):
+        """Тест: неудачная проба снова размыкает цепь"""
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.allow()
+        breaker.record_failure()
+        time.sleep(0.1)
+        breaker.allow()
+        breaker.record_failure()
+        assert breaker.stats()["state"] == "open"
+        assert breaker.stats()["times_opened"] == 2
+
+    @patch('main.handle_file')
+    @patch('main.client_pool')
+    def test_open_circuit_skips_upstream(self, mock_pool, mock_handle_file, monkeypatch, tmp_path):
+        """Тест: при разомкнутой цепи Space не вызывается, ответ содержит Retry-After"""
+        monkeypatch.setattr('main.upstream_breaker', CircuitBreaker(failure_threshold=1, reset_timeout=30))
+        mock_client = Mock()
+        mock_client.predict.side_effect = Exception("API Error")
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+        image_path = tmp_path / "image.jpg"
+
+        image_path.write_bytes(b"first")
+        assert analyze_image(str(image_path), "test")["error"] == "API Error"
+        image_path.write_bytes(b"second")
+        result = analyze_image(str(image_path), "test")
+
+        assert mock_client.predict.call_count == 1
+        assert result["status_code"] == 503
+        assert result["retry_after"] > 0
+
+    @patch('main.analyze_image')
+    def test_index_returns_retry_after(self, mock_analyze):
+        """Тест: отклоненный запрос возвращает 503 с заголовком Retry-After"""
+        mock_analyze.return_value = {"success": False, "error": "Модель временно недоступна",
+                                     "status_code": 503, "retry_after": 7}
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            response = client.post('/', data={'image': (io.BytesIO(image_bytes(b"data")), 'test.jpg'), 'prompt': 'test'})
+
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '7'
+        assert "Модель временно недоступна" in response.data.decode()
+
+
+class TestRetriesAndHedging:
+    """Тесты повторов и хеджирования вызовов модели"""
+
+    @pytest.fixture
+    def image_path(self, tmp_path):
+        path = tmp_path / "image.jpg"
+        path.write_bytes(os.urandom(32))
+        return str(path)
+
+    @patch('main.handle_file')
+    @patch('main.client_pool')
+    def test_transient_error_is_retried(self, mock_pool, mock_handle_file, image_path):
+        """Тест: сетевой сбой повторяется, пользователь получает ответ"""
+        mock_client = Mock()
+        mock_client.predict.side_effect = [ConnectionError("reset"), "ok"]
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+
+        result = analyze_image(image_path, "test")
+
+        assert result == {"success": True, "result": "ok"}
+        assert mock_client.predict.call_count == 2
+
+    @patch('main.handle_file')
+    @patch('main.client_pool')
+    def test_model_error_is_not_retried(self, mock_pool, mock_handle_file, image_path):
+        """Тест: ошибка модели не повторяется"""
+        mock_client = Mock()
+        mock_client.predict.side_effect = ValueError("bad input")
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+
+        result = analyze_image(image_path, "test")
+
+        assert result["success"] is False
+        assert mock_client.predict.call_count == 1
+
+    @patch('main.handle_file')
+    @patch('main.client_pool')
+    def test_retries_stop_when_budget_is_spent(self, mock_pool, mock_handle_file, image_path, monkeypatch):
+        """Тест: без бюджета повторов ошибка возвращается сразу"""
+        monkeypatch.setattr('main.retry_budget', RetryBudget(ratio=0, reserve=0))
+        mock_client = Mock()
+        mock_client.predict.side_effect = ConnectionError("reset")
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+
+        result = analyze_image(image_path, "test")
+
+        assert result["success"] is False
+        assert mock_client.predict.call_count == 1
+
+    def test_budget_limits_extra_attempts(self):
+        """Тест: бюджет пополняется долей от числа запросов"""
+        budget = RetryBudget(ratio=0.5, reserve=1)
+        assert budget.try_spend()
+        assert not budget.try_spend()
+        budget.record_request()
+        budget.record_request()
+        assert budget.try_spend()
+        assert budget.stats() == {"tokens": 0, "spent": 2, "rejected": 1}
+
+    @pytest.fixture
+    def hedging(self, monkeypatch):
+        """Пул из двух клиентов: первый зависает, второй отвечает сразу"""
+        monkeypatch.setattr('main.HEDGE_ENABLED', True)
+        monkeypatch.setattr('main.HEDGE_MIN_DELAY', 0.05)
+        monkeypatch.setattr('main.HEDGE_MIN_SAMPLES', 1)
+        latency = LatencyWindow()
+        latency.add(0.01)
+        monkeypatch.setattr('main.upstream_latency', latency)
+        monkeypatch.setattr('main.handle_file', Mock(return_value="mocked_file"))
+
+        stuck, fast = Future(), Future()
+        fast.set_result("hedged answer")
+        clients = [Mock(**{"submit.return_value": stuck}), Mock(**{"submit.return_value": fast})]
+        monkeypatch.setattr('main.client_pool', ClientPool(size=2, factory=lambda: clients.pop(0)))
+        return stuck
+
+    def test_slow_attempt_is_hedged(self, hedging, image_path):
+        """Тест: зависшая попытка дублируется, побеждает быстрый ответ, проигравший отменяется"""
+        hedge_wins = metrics.hedge_wins.value()
+
+        result = analyze_image(image_path, "test")
+
+        assert result == {"success": True, "result": "hedged answer"}
+        assert hedging.cancelled()
+        assert metrics.hedge_wins.value() == hedge_wins + 1
+
+    @pytest.fixture
+    def two_backends(self, monkeypatch):
+        """Два бэкенда по одному клиенту; задачи первого задаются в тесте"""
+        monkeypatch.setattr('main.HEDGE_ENABLED', True)
+        monkeypatch.setattr('main.HEDGE_MIN_DELAY', 0.05)
+        monkeypatch.setattr('main.HEDGE_MIN_SAMPLES', 1)
+        monkeypatch.setattr('main.handle_file', Mock(return_value="mocked_file"))
+        primary_job, fast = Future(), Future()
+        fast.set_result("second answer")
+        primary = Backend('primary', pool=ClientPool(size=1, factory=lambda: Mock(**{"submit.return_value": primary_job})))
+        second = Backend('second', pool=ClientPool(size=1, factory=lambda: Mock(**{"submit.return_value": fast})))
+        monkeypatch.setattr('main.router', BackendRouter([primary, second]))
+        return primary, second, primary_job
+
+    def test_losing_hedge_is_not_recorded(self, two_backends, image_path, monkeypatch):
+        """Тест: отмененная проигравшая попытка не считается успехом и не сдвигает задержку бэкенда"""
+        primary, second, primary_job = two_backends
+        latency = LatencyWindow()
+        latency.add(0.01)
+        monkeypatch.setattr('main.upstream_latency', latency)
+
+        with patch.object(primary.breaker, 'record_success') as primary_success:
+            result = analyze_image(image_path, "test")
+
+        assert result == {"success": True, "result": "second answer"}
+        assert primary_job.cancelled()
+        assert primary.latency is None
+        assert primary.stats()["in_flight"] == 0
+        primary_success.assert_not_called()
+        assert second.latency is not None
+
+    def test_failed_attempt_falls_back_to_next_backend(self, two_backends, image_path):
+        """Тест: при хеджировании ошибка бэкенда тоже переводит вызов на следующий"""
+        primary, second, primary_job = two_backends
+        primary_job.set_exception(ValueError("backend failed"))
+
+        result = analyze_image(image_path, "test")
+
+        assert result == {"success": True, "result": "second answer"}
+        assert primary.errors == 1
+        assert main.router.fallbacks == 1
+
+    def test_hedge_requires_budget(self, hedging, image_path, monkeypatch):
+        """Тест: без бюджета хедж не отправляется, ждем первую попытку"""
+        monkeypatch.setattr('main.hedge_budget', RetryBudget(ratio=0, reserve=0))
+        threading.Timer(0.2, hedging.set_result, ["primary answer"]).start()
+
+        result = analyze_image(image_path, "test")
+
+        assert result == {"success": True, "result": "primary answer"}
+
+
+class TestStaticAssets:
+    """Тесты статики и сжатия ответов"""
+
+    def test_page_links_versioned_assets(self, test_client):
+        """Тест: стили и скрипт подключаются файлами с версией в адресе"""
+        page = test_client.get('/').get_data(as_text=True)
+
+        assert '<style>' not in page
+        assert f'/assets/app.css?v={STATIC_ASSETS["app.css"].etag}' in page
+        assert f'/assets/app.js?v={STATIC_ASSETS["app.js"].etag}' in page
+
+    def test_template_is_not_recompiled(self, test_client):
+        """Тест: шаблон страницы не компилируется заново на каждый запрос"""
+        with patch.object(app.jinja_env, 'from_string') as mock_from_string:
+            test_client.get('/')
+            test_client.get('/')
+        mock_from_string.assert_not_called()
+
+    def test_asset_is_cacheable(self, test_client):
+        """Тест: статика отдается с ETag и долгим кэшированием, повторный запрос получает 304"""
+        response = test_client.get('/assets/app.js')
+
+        assert response.status_code == 200
+        assert response.mimetype == 'application/javascript'
+        assert 'immutable' in response.headers['Cache-Control']
+        assert 'max-age=31536000' in response.headers['Cache-Control']
+
+        revalidated = test_client.get('/assets/app.js', headers={'If-None-Match': response.headers['ETag']})
+        assert revalidated.status_code == 304
+
+    def test_unknown_asset(self, test_client):
+        """Тест: неизвестный файл — 404"""
+        assert test_client.get('/assets/missing.js').status_code == 404
+
+    def test_gzip_asset_and_page(self, test_client):
+        """Тест: клиент, принимающий gzip, получает сжатые статику и страницу"""
+        asset = test_client.get('/assets/app.css', headers={'Accept-Encoding': 'gzip'})
+        page = test_client.get('/', headers={'Accept-Encoding': 'gzip'})
+
+        assert asset.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(asset.data) == STATIC_ASSETS['app.css'].body
+        assert page.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in page.headers['Vary']
+        assert "Распознавание изображений" in gzip.decompress(page.data).decode()
+
+    def test_stream_is_not_compressed(self, test_client):
+        """Тест: потоковый ответ не буферизуется ради сжатия"""
+        with patch('main.open_stream', return_value=(event for event in [("done", "ok")])):
+            response = test_client.post('/analyze_stream', headers={'Accept-Encoding': 'gzip'},
+                                        data={'image': (io.BytesIO(image_bytes(b"data")), 'test.jpg'), 'prompt': 'test'})
+
+        assert 'Content-Encoding' not in response.headers
+        assert b"event: done" in response.data
+
+
+class TestPytestRunner:
+    """Тесты запуска тестов в отдельном процессе"""
+
+    @staticmethod
+    def runner(code, source_hash="hash", **kwargs):
+        return PytestRunner(command=lambda: [sys.executable, '-c', code], source_hash=lambda: source_hash, **kwargs)
+
+    def test_output_is_collected_and_cached(self):
+        """Тест: вывод процесса собирается, повторный запуск берется из кэша"""
+        runner = self.runner("print('first'); print('second')")
+
+        run, cached = runner.submit()
+        assert run.wait(10)
+        assert not cached
+        assert run.success
+        assert run.output.splitlines() == ['first', 'second']
+
+        again, cached = runner.submit()
+        assert again is run
+        assert cached
+        assert runner.stats()["executed"] == 1
+
+    def test_changed_sources_run_again(self):
+        """Тест: при изменении исходников тесты запускаются заново"""
+        hashes = iter(["old", "new"])
+        runner = PytestRunner(command=lambda: [sys.executable, '-c', 'pass'], source_hash=lambda: next(hashes))
+
+        first, _ = runner.submit()
+        first.wait(10)
+        second, cached = runner.submit()
+        second.wait(10)
+
+        assert second is not first
+        assert not cached
+        assert runner.stats()["executed"] == 2
+
+    def test_concurrent_clicks_share_one_run(self):
+        """Тест: пока прогон идет, повторные запуски присоединяются к нему"""
+        runner = self.runner("import time; time.sleep(0.3); print('done')")
+
+        first, _ = runner.submit()
+        second, cached = runner.submit()
+        first.wait(10)
+
+        assert second is first
+        assert not cached
+        assert list(second.follow()) == ['done\n']
+        assert runner.stats()["executed"] == 1
+
+    def test_crashed_run_is_not_cached(self):
+        """Тест: прогон, прерванный по таймауту, не кэшируется"""
+        runner = self.runner("import time; time.sleep(5)", timeout=0.2)
+
+        run, _ = runner.submit()
+        assert run.wait(10)
+
+        assert run.returncode is None
+        assert not run.success
+        assert "прерван" in run.output
+        assert runner.stats()["cached_results"] == 0
+
+    def test_endpoint_streams_output(self, monkeypatch):
+        """Тест: /run_tests?stream=1 отдает вывод построчно, без параметра — JSON"""
+        monkeypatch.setattr('main.test_runner', self.runner("print('1 passed')"))
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            streamed = client.post('/run_tests?stream=1')
+            body = streamed.get_data(as_text=True)
+            result = client.post('/run_tests').get_json()
+
+        assert streamed.mimetype == 'text/event-stream'
+        assert 'event: line\ndata: {"text": "1 passed\\n"}' in body
+        assert 'event: done\ndata: {"success": true, "cached": false}' in body
+        assert result == {"success": True, "cached": True, "output": "1 passed\n"}
+
+
+class TestMultiImage:
+    """Тесты анализа нескольких изображений за один вызов и ключевых кадров GIF"""
+
+    @staticmethod
+    def make_gif(path, colors, size=(64, 64)):
+        from PIL import Image
+        frames = [Image.new('RGB', size, color) for color in colors]
+        frames[0].save(path, format='GIF', save_all=True, append_images=frames[1:], duration=50)
+        return str(path)
+
+    def test_select_distinct_keyframes(self):
+        """Тест: выбираются первый кадр и кадры, заметно отличающиеся от уже выбранных"""
+        import numpy as np
+        thumbs = np.array([np.full((4, 4), value) for value in (0, 0, 1, 255, 255, 254, 128)])
+
+        assert select_keyframes(thumbs, max_frames=4, min_diff=8) == [0, 3, 6]
+        assert select_keyframes(thumbs, max_frames=2, min_diff=8) == [0, 3]
+        assert select_keyframes(np.zeros((5, 4, 4)), max_frames=4, min_diff=8) == [0]
+
+    def test_extract_keyframes_from_gif(self, tmp_path):
+        """Тест: из анимации сохраняются только различающиеся кадры"""
+        from PIL import Image
+        source = self.make_gif(tmp_path / "anim.gif", [(255, 0, 0)] * 5 + [(0, 0, 255)] * 5)
+
+        paths = extract_keyframes(source, max_frames=4, min_diff=8)
+        try:
+            assert len(paths) == 2
+            with Image.open(paths[1]) as img:
+                assert img.format == 'JPEG'
+                red, green, blue = img.getpixel((0, 0))
+                assert blue > 200 and red < 50
+        finally:
+            for path in paths:
+                os.remove(path)
+
+    def test_static_image_has_no_keyframes(self, tmp_path):
+        """Тест: неанимированное изображение не раскрывается в кадры"""
+        assert extract_keyframes(self.make_gif(tmp_path / "still.gif", [(255, 0, 0)])) is None
+
+    @patch('main.handle_file', side_effect=lambda path: path)
+    @patch('main.client_pool')
+    def test_several_images_in_one_call(self, mock_pool, mock_handle_file, tmp_path):
+        """Тест: несколько изображений уходят одним вызовом, кэш различает их набор"""
+        result_cache.clear()
+        mock_client = Mock()
+        mock_client.predict.side_effect = ["both", "single"]
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+        first, second = tmp_path / "a.jpg", tmp_path / "b.jpg"
+        first.write_bytes(b"first_image")
+        second.write_bytes(b"second_image")
+
+        assert analyze_image([str(first), str(second)], "сравни")["result"] == "both"
+        assert analyze_image(str(first), "сравни")["result"] == "single"
+
+        message = mock_client.predict.call_args_list[0].kwargs["message"]
+        assert len(message["files"]) == 2
+        result_cache.clear()
+
+    @patch('main.analyze_image')
+    def test_form_accepts_several_images(self, mock_analyze):
+        """Тест: форма передает все выбранные изображения, лишние отклоняются"""
+        mock_analyze.return_value = {"success": True, "result": "ok"}
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            response = client.post('/', data={
+                'image': [(io.BytesIO(image_bytes(b"one")), 'one.jpg'), (io.BytesIO(image_bytes(b"two")), 'two.png')],
+                'prompt': 'сравни',
+            })
+            too_many = client.post('/', follow_redirects=True, data={
+                'image': [(io.BytesIO(image_bytes(b"x")), f'{i}.jpg') for i in range(MAX_IMAGES_PER_REQUEST + 1)],
+                'prompt': 'сравни',
+            })
+
+        assert response.status_code == 200
+        paths, prompt, profile = mock_analyze.call_args.args
+        assert len(paths) == 2
+        assert "Слишком много изображений" in too_many.get_data(as_text=True)
+        assert profile == "describe"
+        assert mock_analyze.call_count == 1
+
+
+class TestNearDuplicates:
+    """Тесты повторного использования результатов для похожих изображений"""
+
+    @staticmethod
+    def make_photo(path, size=(400, 300), image_format='PNG', **save_kwargs):
+        from PIL import Image
+        import numpy as np
+        y, x = np.mgrid[0:300, 0:400]
+        pixels = np.stack([x * 255 // 400, y * 255 // 300, (x + y) * 255 // 700], axis=-1).astype(np.uint8)
+        image = Image.fromarray(pixels)
+        if image.size != size:
+            image = image.resize(size)
+        image.save(path, format=image_format, **save_kwargs)
+        return str(path)
+
+    def test_hash_survives_reencoding_and_resize(self, tmp_path):
+        """Тест: перекодирование и уменьшение почти не меняют перцептивный хэш"""
+        original = perceptual_hash(self.make_photo(tmp_path / "a.png"))
+        copy = perceptual_hash(self.make_photo(tmp_path / "b.jpg", (200, 150), 'JPEG', quality=40))
+        flipped = perceptual_hash(self.make_photo(tmp_path / "c.png")) ^ ((1 << 64) - 1)
+
+        assert (original ^ copy).bit_count() <= 4
+        assert (original ^ flipped).bit_count() == 64
+
+    def test_index_finds_within_threshold(self):
+        """Тест: находится ближайший хэш в пределах порога и только для того же промпта"""
+        index = NearDuplicateIndex(max_size=10, threshold=3)
+        index.add("prompt", 0b1111 << 60, "far")
+        index.add("prompt", 0, "near")
+
+        assert index.find("prompt", 0b101) == (True, "near", 2)
+        assert index.find("prompt", 0b1111) == (False, None, None)
+        assert index.find("other", 0) == (False, None, None)
+
+    def test_index_evicts_lru_and_expired(self):
+        """Тест: при переполнении вытесняется давно не использованная запись, устаревшие не возвращаются"""
+        index = NearDuplicateIndex(max_size=2, threshold=1)
+        index.add("p", 1 << 10, "a")
+        index.add("p", 1 << 30, "b")
+        index.find("p", 1 << 10)
+        index.add("p", 1 << 50, "c")
+
+        assert index.find("p", 1 << 30)[0] is False
+        assert index.find("p", 1 << 10)[1] == "a"
+        assert index.stats()["evictions"] == 1
+
+        expired = NearDuplicateIndex(max_size=2, threshold=2, ttl=-1)
+        expired.add("p", 7, "old")
+        assert expired.find("p", 7)[0] is False
+        assert expired.stats()["size"] == 0
+
+    def test_many_entries_lookup(self):
+        """Тест: поиск среди большого числа записей проверяет только кандидатов"""
+        import random as random_module
+        rng = random_module.Random(1)
+        index = NearDuplicateIndex(max_size=20000, threshold=4)
+        hashes = [rng.getrandbits(64) for _ in range(20000)]
+        for i, value in enumerate(hashes):
+            index.add("p", value, i)
+
+        target = hashes[12345] ^ 0b1001
+        started = time.perf_counter()
+        hit, value, distance = index.find("p", target)
+        elapsed = time.perf_counter() - started
+
+        assert (hit, value, distance) == (True, 12345, 2)
+        assert elapsed < 0.05
+
+    @patch('main.handle_file')
+    @patch('main.client_pool')
+    def test_reencoded_copy_reuses_result(self, mock_pool, mock_handle_file, tmp_path):
+        """Тест: перекодированная копия фото не вызывает модель повторно"""
+        result_cache.clear()
+        mock_client = Mock()
+        mock_client.predict.return_value = "Товар на белом фоне"
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+
+        first = analyze_image(self.make_photo(tmp_path / "a.png"), "Что это?")
+        copy = analyze_image(self.make_photo(tmp_path / "b.jpg", (320, 240), 'JPEG', quality=60), "Что это?")
+        other_prompt = analyze_image(self.make_photo(tmp_path / "c.jpg", (320, 240), 'JPEG'), "Какой цвет?")
+
+        assert first == copy == {"success": True, "result": "Товар на белом фоне"}
+        assert other_prompt["success"]
+        assert mock_client.predict.call_count == 2
+        result_cache.clear()
+
+    @patch('main.handle_file')
+    @patch('main.client_pool')
+    def test_color_variant_is_not_reused(self, mock_pool, mock_handle_file, tmp_path):
+        """Тест: тот же товар другого цвета совпадает по dHash, но отправляется в модель"""
+        from PIL import Image, ImageDraw
+
+        def make_product(path, color, size=(400, 300), image_format='PNG', **save_kwargs):
+            image = Image.new('RGB', (400, 300), 'white')
+            ImageDraw.Draw(image).rectangle((120, 60, 280, 240), fill=color)
+            image.resize(size).save(path, format=image_format, **save_kwargs)
+            return str(path)
+
+        result_cache.clear()
+        mock_client = Mock()
+        mock_client.predict.side_effect = ["Красная кружка", "Синяя кружка"]
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+        red = make_product(tmp_path / "red.png", (200, 30, 30))
+        blue = make_product(tmp_path / "blue.png", (30, 30, 200))
+        red_copy = make_product(tmp_path / "red.jpg", (200, 30, 30), (250, 180), 'JPEG', quality=50)
+
+        assert perceptual_hash(red) == perceptual_hash(blue)
+        assert analyze_image(red, "Что это?")["result"] == "Красная кружка"
+        assert analyze_image(blue, "Что это?")["result"] == "Синяя кружка"
+        assert analyze_image(red_copy, "Что это?")["result"] == "Красная кружка"
+        assert mock_client.predict.call_count == 2
+        assert main.near_duplicates.stats()["color_mismatches"] == 1
+        result_cache.clear()
+
+    def test_index_is_opt_in(self):
+        """Тест: по умолчанию индекс похожих выключен и ключ не считается"""
+        assert main.NEAR_DUP_SIZE == 0
+        with patch('main.near_duplicates', NearDuplicateIndex(max_size=0)):
+            assert main.get_near_duplicate_key(["a.png"], "p", DEFAULT_PARAMS) is None
+
+
+class TestBackendRouter:
+    """Тесты маршрутизации по нескольким бэкендам"""
+
+    @staticmethod
+    def backend(name, client, **kwargs):
+        return Backend(name=name, src=f"http://{name}/", pool=ClientPool(size=2, factory=lambda: client), **kwargs)
+
+    def test_load_backends_from_config(self):
+        """Тест: список бэкендов и сопоставление параметров читаются из JSON"""
+        backends = load_backends('[{"name": "local", "src": "http://127.0.0.1:7860/", "weight": 2, '
+                                 '"params": {"param_3": 512}, "param_names": {"param_2": "system"}}, '
+                                 '"user/space"]')
+
+        assert [backend.name for backend in backends] == ["local", "backend1"]
+        assert backends[1].src == "user/space"
+        assert backends[0].weight == 2
+        assert backends[0].chat_params(DEFAULT_PARAMS) == {
+            "system": "", "param_3": 512, "param_4": 0.3, "param_5": 0, "param_6": 0}
+        assert load_backends('')[0].pool is client_pool
+
+    def test_prefers_fast_and_idle_backend(self):
+        """Тест: выбирается бэкенд с меньшей задержкой с учетом вызовов в работе"""
+        fast, slow = self.backend("fast", Mock()), self.backend("slow", Mock())
+        fast.latency, slow.latency = 1.0, 3.0
+        router = BackendRouter([slow, fast])
+
+        assert router.choose() is fast
+        fast.in_flight = 3
+        assert router.choose() is slow
+        assert router.choose(exclude=(slow,)) is fast
+
+    def test_falls_back_on_error(self):
+        """Тест: при ошибке бэкенда запрос уходит на следующий"""
+        broken, healthy = Mock(), Mock()
+        broken.predict.side_effect = ConnectionError("down")
+        healthy.predict.return_value = "ok"
+        first, second = self.backend("first", broken), self.backend("second", healthy)
+        first.latency, second.latency = 0.1, 1.0
+        router = BackendRouter([first, second])
+
+        result = router.call(lambda backend, client: client.predict())
+
+        assert result == "ok"
+        assert router.fallbacks == 1
+        assert first.stats()["errors"] == 1
+        assert second.stats()["requests"] == 1
+
+    def test_unhealthy_backend_is_skipped(self):
+        """Тест: бэкенд с разомкнутой цепью не выбирается, без доступных — 503"""
+        down, up = self.backend("down", Mock()), self.backend("up", Mock())
+        down.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        down.breaker.record_failure()
+        router = BackendRouter([down, up])
+
+        assert router.choose() is up
+        assert router.stats()["down"]["healthy"] == 0
+
+        with pytest.raises(CircuitOpenError):
+            BackendRouter([down]).choose()
+
+    def test_end_to_end_fallback_and_stats(self, monkeypatch, tmp_path):
+        """Тест: два фейковых Space, один всегда с ошибкой — ответ приходит со второго"""
+        monkeypatch.setenv('TOKEN_HUGGI', 'test_token')
+        monkeypatch.setenv('HF_HUB_DISABLE_TELEMETRY', '1')
+        failing_server, failing_url = fake_gradio.start_in_thread(latency=0.01, error_rate=1.0)
+        working_server, working_url = fake_gradio.start_in_thread(latency=0.01)
+        try:
+            backends = load_backends(f'[{{"name": "failing", "src": "{failing_url}", "weight": 10}}, '
+                                     f'{{"name": "working", "src": "{working_url}"}}]')
+            monkeypatch.setattr('main.router', BackendRouter(backends))
+            image_path = tmp_path / "image.jpg"
+            image_path.write_bytes(b"router_image")
+
+            result = analyze_image(str(image_path), "Что на картинке?")
+
+            assert result["success"]
+            app.config['TESTING'] = True
+            with app.test_client() as client:
+                stats = client.get('/backends').get_json()
+                body = client.get('/metrics').get_data(as_text=True)
+            assert stats["fallbacks"] == 1
+            assert stats["backends"]["failing"]["errors"] == 1
+            assert stats["backends"]["working"]["requests"] == 1
+            assert 'paligemma_backend_errors{backend="failing"} 1' in body
+        finally:
+            failing_server.shutdown()
+            working_server.shutdown()
+
+
+class TestUploadValidation:
+    """Тесты проверки загрузок по сигнатуре и размерам во время приема"""
+
+    @pytest.mark.parametrize("image_format,options", [
+        ('PNG', {}), ('JPEG', {}), ('GIF', {}),
+        ('WEBP', {}), ('WEBP', {'lossless': True}), ('WEBP', {'exif': b'Exif\x00\x00MM'}),
+    ])
+    def test_sniff_formats_and_dimensions(self, image_format, options):
+        """Тест: формат и размеры читаются из заголовка каждого поддерживаемого формата"""
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.new('RGB', (300, 200), (10, 20, 30)).save(buffer, format=image_format, **options)
+
+        assert sniff_image(buffer.getvalue()) == (image_format.lower(), (300, 200))
+
+    def test_sniff_needs_more_bytes_or_rejects(self):
+        """Тест: неполный заголовок требует еще байтов, а мусор отклоняется сразу"""
+        header = image_bytes(image_format='JPEG')
+
+        assert sniff_image(b"") is None
+        assert sniff_image(header[:3]) is None
+        assert sniff_image(b"RIFF") is None
+        with pytest.raises(UploadRejected) as excinfo:
+            sniff_image(b"%PDF-1.7")
+        assert excinfo.value.reason == 'signature'
+        assert excinfo.value.code == 415
+
+    def test_junk_rejected_on_first_write(self, tmp_path):
+        """Тест: не изображение отклоняется на первой записи, спул-файл удаляется"""
+        spooled = tempfile.NamedTemporaryFile(dir=tmp_path)
+        upload = ValidatingUpload(spooled)
+
+        with pytest.raises(UploadRejected):
+            upload.write(b"MZ" + b"\x00" * 100)
+        assert spooled.closed
+        assert os.listdir(tmp_path) == []
+
+    def test_size_limit_enforced_while_streaming(self, tmp_path):
+        """Тест: размер ограничивается на каждой записи, а не после приема всего тела"""
+        upload = ValidatingUpload(tempfile.NamedTemporaryFile(dir=tmp_path), max_size=1000)
+        upload.write(image_bytes()[:100])
+
+        with pytest.raises(UploadRejected) as excinfo:
+            upload.write(b"\x00" * 1000)
+        assert excinfo.value.reason == 'size'
+        assert excinfo.value.code == 413
+
+    def test_truncated_header_rejected_when_part_ends(self, tmp_path):
+        """Тест: файл, оборвавшийся до размеров изображения, отклоняется в конце части"""
+        upload = ValidatingUpload(tempfile.NamedTemporaryFile(dir=tmp_path))
+        upload.write(b"\x89PNG\r\n\x1a\n")
+
+        with pytest.raises(UploadRejected) as excinfo:
+            upload.seek(0)
+        assert excinfo.value.reason == 'truncated'
+
+    @patch('main.analyze_image')
+    def test_renamed_non_image_rejected(self, mock_analyze, test_client):
+        """Тест: файл с расширением изображения, но чужим содержимым, не доходит до модели"""
+        before = metrics.upload_rejections.value('signature')
+
+        response = test_client.post('/', data={'image': (io.BytesIO(b"#!/bin/sh\necho hi\n"), 'photo.jpg'),
+                                               'prompt': 'p'}, content_type='multipart/form-data')
+
+        assert response.status_code == 415
+        assert 'не является изображением' in response.get_data(as_text=True)
+        assert metrics.upload_rejections.value('signature') == before + 1
+        mock_analyze.assert_not_called()
+
+    @patch('main.analyze_image')
+    def test_declared_dimensions_limit(self, mock_analyze, test_client):
+        """Тест: изображение с огромными заявленными размерами отклоняется по заголовку"""
+        data = bytearray(image_bytes())
+        data[16:24] = (100000).to_bytes(4, 'big') * 2
+
+        response = test_client.post('/analyze_stream', data={'image': (io.BytesIO(bytes(data)), 'bomb.png'),
+                                                             'prompt': 'p'}, content_type='multipart/form-data')
+
+        assert response.status_code == 415
+        assert response.get_json() == {"success": False,
+                                       "error": "Недопустимые размеры изображения: 100000x100000"}
+        mock_analyze.assert_not_called()
+
+    @patch('main.analyze_image')
+    def test_oversize_file_rejected(self, mock_analyze, test_client, monkeypatch):
+        """Тест: файл больше UPLOAD_MAX_FILE_SIZE получает 413 и учитывается в метрике"""
+        monkeypatch.setattr('main.UPLOAD_MAX_FILE_SIZE', 1024)
+        before = metrics.upload_rejections.value('size')
+
+        response = test_client.post('/jobs', data={'image': (io.BytesIO(image_bytes(b"\x00" * 4096)), 'a.png'),
+                                                   'prompt': 'p'}, content_type='multipart/form-data')
+
+        assert response.status_code == 413
+        assert response.get_json()["success"] is False
+        assert metrics.upload_rejections.value('size') == before + 1
+        mock_analyze.assert_not_called()
+
+    @patch('main.analyze_image')
+    def test_valid_webp_accepted(self, mock_analyze, test_client):
+        """Тест: WebP принимается наравне с остальными форматами"""
+        mock_analyze.return_value = {"success": True, "result": "webp_ok"}
+
+        response = test_client.post('/', data={'image': (io.BytesIO(image_bytes(image_format='WEBP')), 'a.webp'),
+                                               'prompt': 'p'}, content_type='multipart/form-data')
+
+        assert response.status_code == 200
+        assert 'webp_ok' in response.get_data(as_text=True)
+
+
+class TestFairScheduling:
+    """Тесты квот потребителей и взвешенной справедливой очереди"""
+
+    @staticmethod
+    def wait_for(condition, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            assert time.monotonic() < deadline
+            time.sleep(0.005)
+
+    def test_token_bucket_burst_and_refill(self):
+        """Тест: запас burst расходуется сразу, дальше ведро сообщает, когда повторить"""
+        bucket = TokenBucket(rate=10, burst=2)
+        assert bucket.take() == 0
+        assert bucket.take() == 0
+        retry_after = bucket.take()
+        assert 0 < retry_after <= 0.1
+
+        time.sleep(0.12)
+        assert bucket.take() == 0
+        assert TokenBucket(rate=0, burst=1).take(100) == 0
+
+    def test_interactive_overtakes_queued_bulk(self):
+        """Тест: при насыщении интерактивный вызов обгоняет уже ожидающие пакетные"""
+        scheduler = FairScheduler(capacity=1)
+        bulk = Tenant('bulk', 'bulk', weight=1)
+        interactive = Tenant('user', 'interactive', weight=4)
+        order = []
+
+        def call(tenant, name):
+            with scheduler.slot(tenant, timeout=5):
+                order.append(name)
+
+        scheduler.acquire(Tenant('holder'))
+        threads = []
+        for index, (tenant, name) in enumerate([(bulk, 'b1'), (bulk, 'b2'), (bulk, 'b3'), (interactive, 'i')]):
+            thread = threading.Thread(target=call, args=(tenant, name))
+            thread.start()
+            threads.append(thread)
+            self.wait_for(lambda: scheduler.stats()["waiting"] == index + 1)
+
+        assert bulk.queued == 3
+        scheduler.release()
+        for thread in threads:
+            thread.join(timeout=5)
+
+        assert order == ['i', 'b1', 'b2', 'b3']
+        assert bulk.admitted == 3 and bulk.queued == 0
+        assert scheduler.stats()["in_flight"] == 0
+
+    def test_queue_timeout_sheds(self):
+        """Тест: вызов, не дождавшийся места, отклоняется с 429 и не остается в очереди"""
+        scheduler = FairScheduler(capacity=1)
+        scheduler.acquire(Tenant('holder'))
+
+        with pytest.raises(OverloadedError) as error:
+            scheduler.acquire(Tenant('late'), timeout=0.02)
+
+        assert error.value.status_code == 429
+        assert scheduler.stats()["timed_out"] == 1
+        assert scheduler.stats()["waiting"] == 0
+
+    def test_registry_identifies_tenants(self):
+        """Тест: настроенные ключи, неизвестные ключи, сессии и клиенты без cookie различаются"""
+        registry = TenantRegistry('{"secret": {"name": "ci", "class": "bulk", "rate": 1, "burst": 3}}', max_size=2)
+
+        assert registry.resolve('secret').name == 'ci'
+        unknown = registry.resolve('other-key')
+        assert unknown.tenant_class == 'bulk' and 'other-key' not in unknown.name
+        assert registry.resolve(session_id='abc').tenant_class == 'interactive'
+        assert registry.resolve(session_id='abc') is registry.resolve(session_id='abc')
+        assert registry.resolve(address='10.0.0.1').tenant_class == 'bulk'
+
+        # Анонимные потребители вытесняются по LRU, настроенные остаются
+        assert registry.stats()["ci"]["tokens"] == 3
+        assert sum(group["tenants"] for group in registry.stats().values()) == 4
+
+    @patch('main.open_stream')
+    def test_quota_exceeded_returns_429(self, mock_stream, test_client, monkeypatch):
+        """Тест: запрос сверх квоты ключа отклоняется до разбора и вызова модели"""
+        monkeypatch.setattr('main.tenants', TenantRegistry('{"secret": {"name": "ci", "rate": 0.01, "burst": 1}}'))
+        mock_stream.return_value = (event for event in [("done", "ok")])
+
+        def post():
+            return test_client.post('/analyze_stream', headers={'X-API-Key': 'secret'},
+                                    data={'image': (io.BytesIO(image_bytes()), 'a.png'), 'prompt': 'p'},
+                                    content_type='multipart/form-data')
+
+        assert post().status_code == 200
+        response = post()
+
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) >= 1
+        assert response.get_json()["success"] is False
+        assert mock_stream.call_count == 1
+        stats = test_client.get('/tenants').get_json()["tenants"]["ci"]
+        assert stats["requests"] == 2 and stats["throttled"] == 1
+
+    @patch('main.analyze_image')
+    def test_batch_quota_checked_before_parsing(self, mock_analyze, test_client, monkeypatch):
+        """Тест: пакет расходует токен на изображение, а потребитель без токенов получает 429 до разбора тела"""
+        monkeypatch.setattr('main.tenants', TenantRegistry('{"secret": {"name": "ci", "rate": 0.01, "burst": 4}}'))
+        mock_analyze.return_value = {"success": True, "result": "ok"}
+
+        def post_batch(count, filename='a.png'):
+            return test_client.post('/analyze_batch', headers={'X-API-Key': 'secret'},
+                                    data={'images': [(io.BytesIO(image_bytes(bytes([i]))), filename)
+                                                     for i in range(count)], 'prompt': 'p'},
+                                    content_type='multipart/form-data')
+
+        # Файлы, не дошедшие до модели, квоту не расходуют
+        assert post_batch(2, 'a.txt').status_code == 200
+        assert post_batch(3).status_code == 200
+        too_big = post_batch(2)
+        assert too_big.status_code == 429
+        assert int(too_big.headers['Retry-After']) >= 1
+        assert mock_analyze.call_count == 3
+
+        # Остался один токен: отказ во втором пакете его вернул
+        assert post_batch(1).status_code == 200
+        with patch.object(main.SpoolRequest, '_get_file_stream', side_effect=AssertionError("тело разобрано")):
+            assert post_batch(1).status_code == 429
+
+    @patch('main.analyze_image')
+    def test_browser_session_is_interactive(self, mock_analyze, test_client):
+        """Тест: браузер получает сессию со страницей и дальше учитывается как интерактивный"""
+        mock_analyze.return_value = {"success": True, "result": "ok"}
+
+        test_client.get('/')
+        test_client.post('/', data={'image': (io.BytesIO(image_bytes()), 'a.png'), 'prompt': 'p'},
+                         content_type='multipart/form-data')
+
+        stats = test_client.get('/tenants').get_json()["tenants"]
+        assert stats["interactive"]["requests"] == 1
+        assert "bulk" not in stats
+
+    @patch('main.analyze_image')
+    def test_clients_behind_one_proxy(self, mock_analyze, monkeypatch):
+        """Тест: за одним адресом первый POST браузера идет в его сессию, клиенты без cookie различаются по User-Agent,
+        а клиент, отбрасывающий cookie, не обходит квоту новой сессией"""
+        monkeypatch.setattr('main.TENANT_BURST', 2)
+        monkeypatch.setattr('main.tenants', TenantRegistry(''))
+        mock_analyze.return_value = {"success": True, "result": "ok"}
+        app.config['TESTING'] = True
+
+        def post(client, agent):
+            return client.post('/', headers={'User-Agent': agent},
+                               data={'image': (io.BytesIO(image_bytes()), 'a.png'), 'prompt': 'p'},
+                               content_type='multipart/form-data')
+
+        with app.test_client() as browser:
+            assert post(browser, 'browser').status_code == 200
+            assert post(browser, 'browser').status_code == 200
+            assert post(browser, 'browser').status_code == 429
+        stats = main.tenants.stats()
+        assert stats["interactive"]["tenants"] == 1
+        assert stats["bulk"]["requests"] == 1
+
+        with app.test_client(use_cookies=False) as script, app.test_client(use_cookies=False) as other:
+            assert [post(script, 'script').status_code for _ in range(3)] == [200, 200, 429]
+            assert post(other, 'other-script').status_code == 200
+
+    @patch('main.handle_file', side_effect=lambda path: path)
+    @patch('main.client_pool')
+    def test_jobs_run_as_submitting_tenant(self, mock_pool, mock_handle_file, test_client, tmp_path):
+        """Тест: фоновая задача занимает место в очереди от имени потребителя, поставившего ее"""
+        mock_client = Mock()
+        mock_client.predict.return_value = "job result"
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+
+        response = test_client.post('/jobs', headers={'X-API-Key': 'script'},
+                                    data={'image': (io.BytesIO(image_bytes(b"tenant_job")), 'a.png'), 'prompt': 'p'},
+                                    content_type='multipart/form-data')
+        status_url = response.get_json()["status_url"]
+        self.wait_for(lambda: test_client.get(status_url).get_json()["status"] == "done", timeout=5)
+
+        stats = test_client.get('/tenants').get_json()["tenants"]
+        assert stats["bulk"]["admitted"] == 1
+        assert stats["default"]["admitted"] == 0
+
+
+class TestAsgi:
+    """Тесты режима ASGI: те же маршруты, ожидание модели без потока на запрос"""
+
+    @staticmethod
+    async def request(method, path, body=b"", headers=(), chunk_size=1024, application=None):
+        """Запрос к asgi_app без сервера; тело приходит частями, как от настоящего клиента"""
+        messages = [{"type": "http.request", "body": body[i:i + chunk_size], "more_body": i + chunk_size < len(body)}
+                    for i in range(0, max(len(body), 1), chunk_size)]
+        sent = []
+
+        async def receive():
+            return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "query_string": b"", "http_version": "1.1",
+                 "headers": [(name.encode(), value.encode()) for name, value in headers],
+                 "client": ("127.0.0.1", 50000), "server": ("testserver", 80)}
+        await (application or asgi_app)(scope, receive, send)
+        body_parts = [message.get("body", b"") for message in sent[1:]]
+        return sent[0]["status"], dict(sent[0]["headers"]), b"".join(body_parts), len(body_parts)
+
+    @staticmethod
+    def form(prompt="p", image=None, filename="a.png"):
+        from werkzeug.datastructures import FileStorage
+        from werkzeug.test import encode_multipart
+        boundary, body = encode_multipart({"prompt": prompt,
+                                           "image": FileStorage(io.BytesIO(image or image_bytes()), filename)})
+        return body, [("content-type", f"multipart/form-data; boundary={boundary}"),
+                      ("content-length", str(len(body)))]
+
+    @pytest.fixture
+    def upstream(self, monkeypatch):
+        """Space, который отвечает только после release.set()"""
+        release = threading.Event()
+        mock_client = Mock()
+        mock_client.predict.side_effect = lambda **kwargs: release.wait(5) and "asgi result"
+        mock_pool = Mock()
+        mock_pool.acquire.return_value.__enter__ = Mock(return_value=mock_client)
+        mock_pool.acquire.return_value.__exit__ = Mock(return_value=False)
+        monkeypatch.setattr('main.client_pool', mock_pool)
+        monkeypatch.setattr('main.handle_file', lambda path: path)
+        return release, mock_client
+
+    def test_wsgi_routes_served(self):
+        """Тест: маршруты без асинхронной версии работают через пул потоков"""
+        status, headers, body, _ = asyncio.run(self.request("GET", "/"))
+        assert status == 200
+        assert "Распознавание изображений" in body.decode()
+
+        status, _, body, _ = asyncio.run(self.request("GET", "/jobs/missing"))
+        assert status == 404
+        assert b'"success":false' in body.replace(b" ", b"")
+
+    @patch('main.open_stream_async')
+    def test_streamed_response_not_buffered(self, mock_stream):
+        """Тест: SSE отдается фрагментами, а не одним телом"""
+        mock_stream.return_value = (event for event in [("delta", "Кот"), ("delta", " спит"), ("done", "Кот спит")])
+        body, headers = self.form()
+
+        status, response_headers, data, parts = asyncio.run(self.request("POST", "/analyze_stream", body, headers))
+
+        assert status == 200
+        assert response_headers[b"content-type"].startswith(b"text/event-stream")
+        assert data.decode().count("event: ") == 3
+        assert parts >= 3
+
+    def test_streams_do_not_occupy_asgi_threads(self, monkeypatch):
+        """Тест: потоков SSE больше, чем потоков пула ASGI, а GET / все равно отвечает сразу"""
+        release = threading.Event()
+
+        def slow_job(**kwargs):
+            def outputs():
+                yield "Кот"
+                release.wait(5)
+                yield "Кот спит"
+            job = Mock()
+            job.__iter__ = Mock(return_value=outputs())
+            job.result.return_value = "Кот спит"
+            job.done.return_value = True
+            return job
+
+        mock_client = Mock()
+        mock_client.submit.side_effect = slow_job
+        mock_pool = Mock()
+        mock_pool.acquire.return_value.__enter__ = Mock(return_value=mock_client)
+        mock_pool.acquire.return_value.__exit__ = Mock(return_value=False)
+        monkeypatch.setattr('main.client_pool', mock_pool)
+        monkeypatch.setattr('main.handle_file', lambda path: path)
+        application = AsgiApp(app, threads=2)
+
+        async def scenario():
+            streams = [asyncio.create_task(self.request("POST", "/analyze_stream",
+                                                        *self.form(image=image_bytes(bytes([i]))),
+                                                        application=application))
+                       for i in range(3)]
+            for _ in range(300):
+                if mock_client.submit.call_count == 3:
+                    break
+                await asyncio.sleep(0.01)
+            page = await asyncio.wait_for(self.request("GET", "/", application=application), 2)
+            waiting = not any(stream.done() for stream in streams)
+            release.set()
+            return page, waiting, await asyncio.gather(*streams)
+
+        try:
+            page, waiting, streams = asyncio.run(scenario())
+        finally:
+            release.set()
+            application.executor.shutdown(wait=False)
+
+        assert page[0] == 200
+        assert waiting
+        assert mock_client.submit.call_count == 3
+        for status, _, data, _ in streams:
+            assert status == 200
+            assert 'event: done\ndata: {"text": "Кот спит"}' in data.decode()
+
+    def test_form_analysis(self, upstream):
+        """Тест: POST / возвращает ту же страницу с результатом, что и WSGI-версия"""
+        release, mock_client = upstream
+        release.set()
+        body, headers = self.form()
+
+        status, _, data, _ = asyncio.run(self.request("POST", "/", body, headers))
+
+        assert status == 200
+        assert "asgi result" in data.decode()
+        assert mock_client.predict.call_count == 1
+
+    def test_form_errors_keep_behavior(self, upstream):
+        """Тест: ошибки формы и загрузки обрабатываются так же, как во Flask"""
+        body, headers = self.form(prompt="")
+        status, response_headers, _, _ = asyncio.run(self.request("POST", "/", body, headers))
+        assert status == 302
+        assert b"set-cookie" in response_headers
+
+        body, headers = self.form(image=b"not an image at all", filename="a.jpg")
+        status, _, data, _ = asyncio.run(self.request("POST", "/", body, headers))
+        assert status == 415
+        assert "не является изображением" in data.decode()
+        upstream[1].predict.assert_not_called()
+
+    def test_many_waiters_do_not_hold_threads(self, upstream, monkeypatch):
+        """Тест: сотни запросов ждут модель, а число потоков остается ограниченным"""
+        monkeypatch.setattr('main.TENANT_RATE', 0)
+        release, mock_client = upstream
+        waiters = 300
+
+        async def scenario():
+            forms = [self.form(image=image_bytes(str(i).encode())) for i in range(waiters)]
+            tasks = [asyncio.create_task(self.request("POST", "/", body, headers)) for body, headers in forms]
+            deadline = time.monotonic() + 10
+            while main.fair_scheduler.stats()["waiting"] < waiters - main.fair_scheduler.capacity():
+                assert time.monotonic() < deadline
+                await asyncio.sleep(0.01)
+            threads = threading.active_count()
+            release.set()
+            return threads, await asyncio.gather(*tasks)
+
+        threads, responses = asyncio.run(scenario())
+
+        assert threads < 100
+        assert [status for status, _, _, _ in responses] == [200] * waiters
+        assert all("asgi result" in body.decode() for _, _, body, _ in responses)
+        assert mock_client.predict.call_count == waiters
+
+
+class TestResultHistory:
+    """Тесты для постоянной истории результатов"""
+
+    @pytest.fixture
+    def store(self, tmp_path):
+        return ResultHistory(str(tmp_path / "history.db"), batch_size=3, flush_interval=0.05)
+
+    @pytest.fixture
+    def test_client(self, test_client, store, monkeypatch):
+        monkeypatch.setattr('main.history', store)
+        return test_client
+
+    def test_records_are_written_in_batches(self, store):
+        """Тест пакетной записи в фоновом потоке"""
+        for i in range(7):
+            assert store.record(f"hash{i}", f"prompt {i}", DEFAULT_PARAMS, f"result {i}", 0.5)
+        assert store.flush()
+
+        stats = store.stats()
+        assert stats["written"] == 7
+        assert stats["pending"] == 0
+        assert stats["batches"] >= 3
+        with sqlite3.connect(store.path) as conn:
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    def test_cursor_pagination_and_filters(self, store):
+        """Тест пагинации по курсору и фильтров по хэшу и промпту"""
+        for i in range(5):
+            store.record("same" if i % 2 else f"hash{i}", "What is this?" if i < 4 else "Describe", {"t": i},
+                         f"result {i}", 0.1)
+        store.flush()
+
+        first, cursor = store.query(limit=2)
+        second, cursor = store.query(cursor=cursor, limit=2)
+        third, cursor = store.query(cursor=cursor, limit=2)
+        assert [item["output"] for item in first + second + third] == [f"result {i}" for i in range(4, -1, -1)]
+        assert cursor is None
+        assert first[0]["params"] == {"t": 4}
+
+        assert [item["output"] for item in store.query(image_hash="same")[0]] == ["result 3", "result 1"]
+        assert len(store.query(prompt="  What is   this? ")[0]) == 4
+        assert [item["output"] for item in store.query(prompt_prefix="Desc")[0]] == ["result 4"]
+        assert store.query(since=time.time() + 60)[0] == []
+
+    def test_lookups_use_indexes(self, store):
+        """Тест: поиск потребителя по хэшу и промпту и страница по курсору идут по индексу без сортировки"""
+        store.record("hash", "prompt", DEFAULT_PARAMS, "result")
+        store.flush()
+
+        with sqlite3.connect(store.path) as conn:
+            for column in ("image_hash", "prompt"):
+                plan = " ".join(row[-1] for row in conn.execute(
+                    f"EXPLAIN QUERY PLAN SELECT * FROM results WHERE tenant = ? AND {column} = ? "
+                    f"AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 51",
+                    ("t", "x", time.time(), 100)))
+                assert f"results_tenant_{column}" in plan
+                assert "TEMP B-TREE" not in plan
+
+    def test_expired_records_are_pruned(self, tmp_path):
+        """Тест: записи старше срока хранения удаляются порциями, свежие остаются"""
+        store = ResultHistory(str(tmp_path / "history.db"), batch_size=2, flush_interval=0.05, retention=60)
+        for i in range(5):
+            store.record(f"hash{i}", "p", {}, f"result {i}")
+        store.flush()
+
+        assert store.prune() == 0
+        assert store.prune(now=time.time() + 120) == 5
+        assert store.query() == ([], None)
+        assert store.stats()["pruned"] == 5
+
+    def test_old_database_is_migrated(self, tmp_path):
+        """Тест: база без столбца tenant дополняется, старые записи не видны потребителям"""
+        path = str(tmp_path / "history.db")
+        conn = sqlite3.connect(path)
+        conn.executescript("""
+            CREATE TABLE results (id INTEGER PRIMARY KEY, created_at REAL NOT NULL, image_hash TEXT NOT NULL,
+                                  prompt TEXT NOT NULL, params TEXT NOT NULL, output TEXT NOT NULL, latency REAL);
+            CREATE INDEX results_image_hash ON results (image_hash, created_at);
+            INSERT INTO results VALUES (1, 1.0, 'old', 'p', '{}', '"old result"', NULL);
+        """)
+        conn.close()
+        store = ResultHistory(path, flush_interval=0.05, retention=0)
+        store.record("new", "p", {}, "new result", tenant="ci")
+        store.flush()
+
+        assert [item["output"] for item in store.query(tenant="ci")[0]] == ["new result"]
+        assert [item["output"] for item in store.query()[0]] == ["new result", "old result"]
+        assert store.get(1, "ci") is None
+
+    def test_full_queue_drops_instead_of_blocking(self, tmp_path):
+        """Тест: переполненная очередь не задерживает запрос"""
+        store = ResultHistory(str(tmp_path / "history.db"), batch_size=100, flush_interval=60, max_pending=2)
+        assert store.record("a", "p", {}, "1")
+        assert store.record("b", "p", {}, "2")
+        assert not store.record("c", "p", {}, "3")
+        assert store.stats()["dropped"] == 1
+
+    def test_disabled_history(self):
+        """Тест отключенной истории"""
+        store = ResultHistory('')
+        assert not store.record("a", "p", {}, "1")
+        assert store.query() == ([], None)
+
+    @patch('main.client_pool')
+    @patch('main.handle_file')
+    def test_model_results_are_saved_and_served(self, mock_handle_file, mock_pool, test_client, store, tmp_path):
+        """Тест: ответ модели попадает в историю и отдается через /history"""
+        mock_client = Mock()
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+        mock_handle_file.return_value = "mocked_file"
+        mock_client.predict.return_value = "history result"
+        image_path = tmp_path / "image.png"
+        image_path.write_bytes(image_bytes(b"history"))
+
+        token = main.tenant_context.set(main.tenants.resolve(api_key="owner-key"))
+        try:
+            assert analyze_image(str(image_path), "history prompt")["success"]
+        finally:
+            main.tenant_context.reset(token)
+        store.flush()
+
+        image_hash = main.hash_file(str(image_path))
+        owner = {'X-API-Key': 'owner-key'}
+        response = test_client.get(f"/history?image_hash={image_hash}", headers=owner)
+        data = response.get_json()
+        assert response.status_code == 200
+        assert data["next_cursor"] is None
+        [item] = data["items"]
+        assert item["output"] == "history result"
+        assert item["prompt"] == "history prompt"
+        assert item["params"] == DEFAULT_PARAMS
+        assert item["latency"] >= 0
+        assert test_client.get(f"/history/{item['id']}", headers=owner).get_json()["output"] == "history result"
+        assert test_client.get("/history/999", headers=owner).status_code == 404
+        assert test_client.get("/history?cursor=abc").status_code == 400
+
+        # Другие потребители и клиенты без ключа и сессии чужих записей не видят
+        for headers in ({'X-API-Key': 'other-key'}, {}):
+            assert test_client.get("/history", headers=headers).get_json()["items"] == []
+            assert test_client.get(f"/history/{item['id']}", headers=headers).status_code == 404
+
+    def test_anonymous_callers_see_only_their_session(self, store, monkeypatch):
+        """Тест: без ключа видна только история своей сессии, записи общего адреса не видны никому"""
+        monkeypatch.setattr('main.history', store)
+        shared = main.tenants.resolve(address='127.0.0.1', agent='curl/8.0').name
+        store.record("a", "p", {}, "shared result", tenant=shared)
+        store.record("b", "p", {}, "session result", tenant="session_abc")
+        store.flush()
+        app.config['TESTING'] = True
+
+        with app.test_client(use_cookies=False) as client:
+            response = client.get("/history", headers={'User-Agent': 'curl/8.0'})
+            assert response.get_json()["items"] == []
+            assert client.get("/history/1", headers={'User-Agent': 'curl/8.0'}).status_code == 404
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['tenant_id'] = 'abc'
+            [item] = client.get("/history").get_json()["items"]
+            assert item["output"] == "session result"
+            assert client.get("/history/1").status_code == 404
+
+
+class TestTracing:
+    """Тесты трассировки запросов"""
+
+    @staticmethod
+    def logged_traces(capsys):
+        return [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"trace_id"')]
+
+    def test_parse_traceparent(self):
+        """Тест разбора заголовка W3C traceparent"""
+        header = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+        assert parse_traceparent(header) == ("0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331", True)
+        assert parse_traceparent(header[:-1] + "0")[2] is False
+        assert parse_traceparent("00-" + "0" * 32 + "-b7ad6b7169203331-01") is None
+        assert parse_traceparent("garbage") is None
+        assert parse_traceparent(None) is None
+
+    def test_every_response_has_trace_id(self, test_client, monkeypatch, capsys):
+        """Тест: идентификатор трассы есть у каждого ответа, а в журнал попадает только выборка"""
+        monkeypatch.setattr('main.tracer', Tracer(0))
+
+        first = test_client.get('/')
+        second = test_client.get('/', headers={'X-Trace-Id': 'ab' * 16})
+
+        assert len(first.headers['X-Trace-Id']) == 32
+        assert first.headers['traceparent'].endswith('-00')
+        assert second.headers['X-Trace-Id'] == 'ab' * 16
+        assert self.logged_traces(capsys) == []
+
+    def test_incoming_traceparent_is_continued(self, test_client, monkeypatch, capsys):
+        """Тест: трасса вызывающего продолжается, его решение о выборке соблюдается"""
+        monkeypatch.setattr('main.tracer', Tracer(0))
+        trace_id, parent_id = "0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331"
+
+        response = test_client.get('/', headers={'traceparent': f"00-{trace_id}-{parent_id}-01"})
+
+        [trace] = self.logged_traces(capsys)
+        assert response.headers['X-Trace-Id'] == trace_id
+        assert response.headers['traceparent'] == f"00-{trace_id}-{trace['span_id']}-01"
+        assert trace["parent_id"] == parent_id
+        assert trace["name"] == "GET /"
+        assert trace["attributes"]["http.status_code"] == 200
+        assert [span["name"] for span in trace["spans"]] == ["render"]
+
+    def test_slow_requests_are_logged_without_sampling(self, test_client, monkeypatch, capsys):
+        """Тест: медленный запрос попадает в журнал, даже если не попал в выборку"""
+        monkeypatch.setattr('main.tracer', Tracer(0, slow_threshold=1e-9))
+
+        test_client.get('/')
+
+        [trace] = self.logged_traces(capsys)
+        assert trace["duration_ms"] > 0
+        assert main.tracer.stats()["slow"] == 1
+
+    def test_form_request_breakdown(self, test_client, monkeypatch, capsys):
+        """Тест: трасса POST / раскладывает время по этапам, включая этапы на стороне Space"""
+        monkeypatch.setenv('TOKEN_HUGGI', 'test_token')
+        monkeypatch.setenv('HF_HUB_DISABLE_TELEMETRY', '1')
+        monkeypatch.setattr('main.tracer', Tracer(1.0))
+        server, url = fake_gradio.start_in_thread(latency=0.3)
+        monkeypatch.setattr('main.GRADIO_SRC', url)
+        monkeypatch.setattr('main.client_pool', ClientPool(size=1))
+        result_cache.clear()
+        try:
+            response = test_client.post('/', data={
+                'image': (io.BytesIO(image_bytes(b"traced")), 'traced.png'),
+                'prompt': 'Что на картинке?',
+            }, content_type='multipart/form-data')
+        finally:
+            server.shutdown()
+            result_cache.clear()
+
+        assert response.status_code == 200
+        [trace] = self.logged_traces(capsys)
+        assert trace["trace_id"] == response.headers['X-Trace-Id']
+        spans = {span["name"]: span for span in trace["spans"]}
+        assert {"upload.parse", "upload.save", "cache.lookup", "upstream.admission", "preprocess", "model.call",
+                "client.acquire", "model.attempt", "space.upload", "space.queue", "space.generate",
+                "render"} <= set(spans)
+        assert spans["cache.lookup"]["attributes"] == {"hit": False}
+        assert spans["model.attempt"]["parent_id"] == spans["model.call"]["span_id"]
+        assert spans["model.attempt"]["attributes"] == {"backend": "default"}
+        for name in ("space.upload", "space.queue", "space.generate"):
+            assert spans[name]["parent_id"] == spans["model.attempt"]["span_id"]
+        space_end = spans["space.generate"]["offset_ms"] + spans["space.generate"]["duration_ms"]
+        assert space_end - spans["space.upload"]["offset_ms"] >= 300
+        assert spans["space.generate"]["duration_ms"] > 0
+        assert spans["render"]["offset_ms"] > spans["space.generate"]["offset_ms"]
+
+    def test_exporter_sends_otlp_json(self):
+        """Тест отправки трасс в коллектор по OTLP/HTTP"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        received = []
+
+        class Collector(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Collector)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        exporter = OtlpExporter(f"http://127.0.0.1:{server.server_address[1]}/v1/traces", interval=0.05)
+        tracer = Tracer(1.0, log=False, exporter=exporter)
+        try:
+            trace = tracer.start('POST /', {})
+            trace.add('render', 'a' * 16, trace.span_id, trace.start, 0.01, {"images": 1})
+            tracer.finish(trace)
+            assert exporter.flush()
+        finally:
+            server.shutdown()
+
+        [payload] = received
+        spans = payload["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        assert [span["name"] for span in spans] == ['POST /', 'render']
+        assert {span["traceId"] for span in spans} == {trace.trace_id}
+        assert spans[1]["parentSpanId"] == spans[0]["spanId"]
+        assert spans[1]["attributes"] == [{"key": "images", "value": {"intValue": "1"}}]
+        assert tracer.stats()["export_exported"] == 1
+
+
+class TestRemoteFiles:
+    """Тесты повторного использования файлов, уже загруженных в Space"""
+
+    @pytest.fixture
+    def fake_space(self, fake_space, monkeypatch):
+        monkeypatch.setattr('main.remote_files', ResultCache(16, 60))
+        return fake_space
+
+    @pytest.fixture
+    def image_path(self, tmp_path):
+        path = tmp_path / "photo.png"
+        path.write_bytes(image_bytes(b"remote", size=(64, 64)))
+        return str(path)
+
+    def test_upload_through_real_client(self, fake_space, image_path):
+        """Тест: загрузка работает с настоящим Client закрепленной версии gradio_client"""
+        client = main.get_client()
+        remote_path = main.upload_to_space(client, image_path)
+
+        assert os.path.dirname(remote_path) == fake_space.upload_dir
+        with open(remote_path, 'rb') as copy, open(image_path, 'rb') as original:
+            assert copy.read() == original.read()
+        assert fake_space.uploads == 1
+
+    def test_follow_up_prompts_send_only_text(self, fake_space, image_path):
+        """Тест: второй вопрос о том же изображении не загружает его заново"""
+        first = analyze_image(image_path, "Что на картинке?")
+        second = analyze_image(image_path, "Какого цвета фон?")
+        events = list(stream_analyze_image(image_path, "Сколько здесь предметов?"))
+
+        assert first == {"success": True, "result": "Фейковый ответ на «Что на картинке?» для 1 файл(ов)."}
+        assert second["result"] == "Фейковый ответ на «Какого цвета фон?» для 1 файл(ов)."
+        assert events[-1] == ("done", "Фейковый ответ на «Сколько здесь предметов?» для 1 файл(ов).")
+        assert fake_space.uploads == 1
+        assert main.remote_files.stats()["hits"] == 2
+        # Ссылка на копию — полноценная FileData, которую gradio_client не загружает заново
+        [sent] = fake_space.last_files
+        assert sent["meta"] == {"_type": "gradio.FileData"}
+        assert sent["path"].startswith(main.GRADIO_SRC + "file=" + fake_space.upload_dir)
+
+    def test_files_removed_by_space_are_uploaded_again(self, fake_space, image_path):
+        """Тест: если Space удалил файл, он загружается заново, а запрос выполняется"""
+        reuploads = metrics.upstream_attempts.value('reupload')
+        assert analyze_image(image_path, "Что на картинке?")["success"]
+        for name in os.listdir(fake_space.upload_dir):
+            os.remove(os.path.join(fake_space.upload_dir, name))
+
+        with patch('main.hash_file', wraps=main.hash_file) as hash_file:
+            result = analyze_image(image_path, "Какого цвета фон?")
+
+        assert result == {"success": True, "result": "Фейковый ответ на «Какого цвета фон?» для 1 файл(ов)."}
+        # Один хэш для ключа кэша и один для ссылок в Space, хотя файл загружался дважды
+        assert hash_file.call_count == 2
+        assert fake_space.uploads == 2
+        assert metrics.upstream_attempts.value('reupload') == reuploads + 1
+
+    def test_references_are_per_backend(self, fake_space, image_path, monkeypatch):
+        """Тест: ссылка на файл одного Space не передается в другой"""
+        other_server, other_url = fake_gradio.start_in_thread(latency=0.01)
+        try:
+            assert analyze_image(image_path, "Что на картинке?")["success"]
+            backends = load_backends(f'[{{"name": "other", "src": "{other_url}"}}]')
+            monkeypatch.setattr('main.router', BackendRouter(backends))
+
+            assert analyze_image(image_path, "Какого цвета фон?")["success"]
+        finally:
+            other_server.shutdown()
+
+        assert fake_space.uploads == 1
+        assert other_server.RequestHandlerClass.state.uploads == 1
+
+
+class TestProfiles:
+    """Тесты профилей генерации"""
+
+    @pytest.fixture
+    def fake_space(self, start_fake_space, monkeypatch):
+        # Фейковый Space отвечает одной строкой, поэтому стоп — слово из середины ответа
+        profiles = load_profiles('{"short": {"max_tokens": 8, "temperature": 0, "stop": ["на"]}}')
+        monkeypatch.setattr('main.generation_profiles', profiles)
+        return start_fake_space(latency=0.01, chunks=7, chunk_delay=0.2)
+
+    @pytest.fixture
+    def image_path(self, tmp_path):
+        path = tmp_path / "photo.png"
+        path.write_bytes(image_bytes(b"profiles"))
+        return str(path)
+
+    def test_load_profiles(self):
+        """Тест: настройки переопределяют встроенные профили, новые наследуют describe"""
+        profiles = load_profiles('{"tag": {"max_tokens": "8"}, "ocr": {"system": "Transcribe.", "stop": [""]}}')
+
+        assert profiles["tag"]["max_tokens"] == 8
+        assert profiles["tag"]["stop"] == ["\n"]
+        assert profiles["ocr"]["system"] == "Transcribe."
+        assert profiles["ocr"]["max_tokens"] == DEFAULT_PARAMS["param_3"]
+        assert profiles["ocr"]["stop"] == []
+        assert set(load_profiles('')) == {"tag", "caption", "describe"}
+
+    def test_profile_params(self):
+        """Тест: describe совпадает с прежними параметрами, стоп-строки в /chat не уходят"""
+        tag = profile_params("tag")
+
+        assert profile_params("describe") == DEFAULT_PARAMS
+        assert tag["param_3"] < DEFAULT_PARAMS["param_3"]
+        assert tag["stop"] == ["\n"]
+        assert "stop" not in Backend().chat_params(tag)
+
+    def test_cut_at_stop(self):
+        """Тест обрезки ответа по первой стоп-строке"""
+        assert cut_at_stop("Кот\nи собака", ["\n"]) == ("Кот", True)
+        assert cut_at_stop("\nКот\n", ["\n"]) == ("\nКот", True)
+        assert cut_at_stop("a. b, c", [",", "."]) == ("a", True)
+        assert cut_at_stop("Кот", ["\n"]) == ("Кот", False)
+        assert cut_at_stop(None, ["\n"]) == (None, False)
+
+    def test_stop_cancels_generation(self, fake_space, image_path):
+        """Тест: ответ обрезается по стоп-строке, а генерация в Space отменяется"""
+        result = analyze_image(image_path, "Что это?", "short")
+        events = list(stream_analyze_image(image_path, "Какой цвет?", "short"))
+
+        assert result == {"success": True, "result": "Фейковый ответ "}
+        assert events[-1] == ("done", "Фейковый ответ ")
+        assert "".join(text for event, text in events[:-1]) == "Фейковый ответ "
+        deadline = time.monotonic() + 2
+        while len(fake_space.cancelled) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(fake_space.cancelled) == 2
+
+    def test_profiles_do_not_share_cache(self, fake_space, image_path):
+        """Тест: одинаковый вопрос с разными профилями — разные вызовы модели"""
+        assert analyze_image(image_path, "Что это?", "short")["result"] == "Фейковый ответ "
+        assert analyze_image(image_path, "Что это?")["result"] == "Фейковый ответ на «Что это?» для 1 файл(ов)."
+        assert analyze_image(image_path, "Что это?", "short")["result"] == "Фейковый ответ "
+
+        assert fake_space.requests == 2
+        stats = main.profile_stats.stats()
+        assert stats["short"]["requests"] == 1
+        assert stats["short"]["output_words_p50"] == 2
+        assert stats["describe"]["output_words_total"] == 8
+
+    def test_unknown_profile_rejected(self, test_client):
+        """Тест: неизвестный профиль отклоняется до вызова модели"""
+        response = test_client.post('/analyze_stream', data={
+            'image': (io.BytesIO(image_bytes(b"x")), 'a.png'), 'prompt': 'p', 'profile': 'nope'})
+        page = test_client.post('/', data={
+            'image': (io.BytesIO(image_bytes(b"x")), 'a.png'), 'prompt': 'p', 'profile': 'nope'})
+
+        assert response.status_code == 400
+        assert "nope" in response.get_json()["error"]
+        assert "Неизвестный профиль генерации: nope" in page.get_data(as_text=True)
+
+    @patch('main.analyze_image')
+    def test_profile_selected_in_form_and_jobs(self, mock_analyze, test_client, monkeypatch):
+        """Тест: профиль из формы и из API задач доходит до analyze_image"""
+        monkeypatch.setattr('main.job_queue', JobQueue(workers=1))
+        mock_analyze.return_value = {"success": True, "result": "ok"}
+
+        page = test_client.get('/').get_data(as_text=True)
+        test_client.post('/', data={'image': (io.BytesIO(image_bytes(b"a")), 'a.png'), 'prompt': 'p',
+                                    'profile': 'tag'})
+        form_call = mock_analyze.call_args.args
+        response = test_client.post('/jobs', data={'image': (io.BytesIO(image_bytes(b"b")), 'b.png'),
+                                                   'prompt': 'p', 'profile': 'caption'})
+        job_id = response.get_json()["job_id"]
+        deadline = time.monotonic() + 2
+        while main.job_queue.get(job_id)["status"] != "done" and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert '<select id="profile" name="profile">' in page
+        assert '<option value="describe" selected>' in page
+        assert form_call[2] == "tag"
+        assert mock_analyze.call_args.args[2] == "caption"
+        assert main.job_queue.get(job_id)["profile"] == "caption"
+
+    def test_profiles_endpoint_and_metrics(self, test_client):
+        """Тест: /profiles и /metrics показывают статистику по профилям"""
+        main.profile_stats.record("tag", 0.5, "Красный")
+
+        body = test_client.get('/profiles').get_json()
+        metrics_text = test_client.get('/metrics').get_data(as_text=True)
+
+        assert body["default"] == "describe"
+        assert body["profiles"]["tag"]["stats"]["latency_p50"] == 0.5
+        assert body["profiles"]["caption"]["stats"] is None
+        assert 'paligemma_profile_requests{profile="tag"} 1' in metrics_text
+        assert '# TYPE paligemma_profile_output_words_total counter' in metrics_text
+
+
+class TestMetrics:
+    """Тесты для метрик Prometheus"""
+
+    def test_histogram_render(self):
+        """Тест кумулятивных корзин гистограммы"""
+        histogram = Histogram('test_seconds', 'Тест', buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+
+        lines = histogram.render()
+        assert 'test_seconds_bucket{le="0.1"} 1' in lines
+        assert 'test_seconds_bucket{le="1"} 2' in lines
+        assert 'test_seconds_bucket{le="+Inf"} 3' in lines
+        assert 'test_seconds_count 3' in lines
+
+    def test_counter_labels(self):
+        """Тест счетчика с меткой"""
+        counter = Counter('test_total', 'Тест', 'type')
+        counter.inc('ValueError')
+        counter.inc('ValueError')
+        counter.inc('Time"out')
+
+        lines = counter.render()
+        assert 'test_total{type="ValueError"} 2' in lines
+        assert 'test_total{type="Time\\"out"} 1' in lines
+
+    @patch('main.client_pool')
+    @patch('main.handle_file')
+    def test_metrics_endpoint_after_analysis(self, mock_handle_file, mock_pool, test_client):
+        """Тест: после анализа метрики этапов и ошибок видны в /metrics"""
+        result_cache.clear()
+        mock_client = Mock()
+        mock_pool.acquire.return_value.__enter__.return_value = mock_client
+        mock_pool.stats.return_value = {"size": 4, "idle": 4}
+        mock_handle_file.return_value = "mocked_file"
+        mock_client.predict.side_effect = TimeoutError("upstream timeout")
+        predict_count = metrics.predict.count
+        errors_before = metrics.errors.value('TimeoutError')
+
+        test_client.post('/', data={'image': (io.BytesIO(image_bytes(b"metrics_image")), 'a.jpg'), 'prompt': 'metrics'},
+                         content_type='multipart/form-data')
+        body = test_client.get('/metrics').get_data(as_text=True)
+
+        # Таймаут — сетевой сбой, поэтому вызов повторяется, а ошибка учитывается один раз
+        assert metrics.predict.count == predict_count + 3
+        assert metrics.errors.value('TimeoutError') == errors_before + 1
+        assert 'paligemma_upstream_attempts_total{kind="retry"}' in body
+        for name in ('paligemma_upload_receive_seconds_count', 'paligemma_file_save_seconds_count',
+                     'paligemma_predict_seconds_count', 'paligemma_render_seconds_count',
+                     'paligemma_upload_bytes_bucket', 'paligemma_requests_in_flight 1',
+                     'paligemma_client_pool_idle 4', 'paligemma_cache_hits'):
+            assert name in body
+
+
+class TestFakeGradioServer:
+    """Сквозные тесты с настоящим gradio_client и локальной заменой Space"""
+
+    def test_analyze_image_end_to_end(self, fake_space, tmp_path):
+        """Тест полного вызова /chat с загрузкой файла"""
+        image_path = tmp_path / "image.jpg"
+        image_path.write_bytes(b"fake_space_image")
+
+        result = analyze_image(str(image_path), "Что на картинке?")
+
+        assert result == {"success": True, "result": "Фейковый ответ на «Что на картинке?» для 1 файл(ов)."}
+        assert fake_space.uploads == 1
+
+    def test_images_and_gif_keyframes_end_to_end(self, fake_space, tmp_path):
+        """Тест: изображение и ключевые кадры GIF уходят одним вызовом /chat"""
+        image_path = tmp_path / "image.jpg"
+        image_path.write_bytes(b"fake_space_image")
+        gif_path = TestMultiImage.make_gif(tmp_path / "anim.gif", [(255, 0, 0)] * 3 + [(0, 0, 255)] * 3)
+
+        result = analyze_image([str(image_path), gif_path], "Что изменилось?")
+
+        assert result == {"success": True, "result": "Фейковый ответ на «Что изменилось?» для 3 файл(ов)."}
+
+    def test_stream_end_to_end(self, fake_space, tmp_path):
+        """Тест потоковой генерации через настоящий Job"""
+        image_path = tmp_path / "image.jpg"
+        image_path.write_bytes(b"fake_space_stream_image")
+
+        events = list(stream_analyze_image(str(image_path), "поток"))
+
+        assert events[-1] == ("done", "Фейковый ответ на «поток» для 1 файл(ов).")
+        assert sum(1 for event, _ in events if event == "delta") > 1
+        assert "".join(text for event, text in events if event == "delta") == events[-1][1]
+
+    def test_stream_endpoint_end_to_end(self, fake_space, test_client):
+        """Тест: загруженный файл доступен до конца потокового ответа"""
+        response = test_client.post('/analyze_stream',
+                                    data={'image': (io.BytesIO(image_bytes(b"fake_space_endpoint_image")), 'a.jpg'), 'prompt': 'p'},
+                                    content_type='multipart/form-data')
+        body = response.get_data(as_text=True)
+
+        assert 'event: done' in body
+        assert 'event: error' not in body
+
+    def test_upstream_error(self, fake_space, tmp_path):
+        """Тест ошибки Space"""
+        fake_space.error_rate = 1.0
+        image_path = tmp_path / "image.jpg"
+        image_path.write_bytes(b"fake_space_error_image")
+
+        result = analyze_image(str(image_path), "ошибка")
+
+        assert result["success"] is False
+        assert "Fake upstream error" in result["error"]
+
+
+class TestIntegration:
+    """Интеграционные тесты"""
+
+    @patch.dict(os.environ, {'TOKEN_HUGGI': 'test_token'})
+    @patch('gradio_client.Client')
+    def test_full_workflow_mock(self, mock_client_class):
+        """Интеграционный тест полного workflow с моками"""
+        client_pool.reset()  # Сбрасываем пул клиентов
+        result_cache.clear()
+
+        mock_client = Mock()
+        mock_client_class.return_value = mock_client
+        mock_client.predict.return_value = "mocked_result"
+
+        # Создаем временный файл
+        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_file:
+            temp_file.write(b"fake_image_data")
+            temp_file_path = temp_file.name
+
+        try:
+            # Тестируем полный workflow
+            result = analyze_image(temp_file_path, "test prompt")
+
+            assert result == {"success": True, "result": "mocked_result"}
+            mock_client.predict.assert_called_once()
+        finally:
+            # Очистка
+            os.unlink(temp_file_path)
+            client_pool.reset()
+            result_cache.clear()
+
+    @patch('main.analyze_image')
+    def test_full_flask_workflow(self, mock_analyze, test_client):
+        """Интеграционный тест полного Flask workflow"""
+        mock_analyze.return_value = {"success": True, "result": "integration_test_result"}
+
+        # Создаем временный файл изображения
+        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
+            tmp.write(image_bytes())
+            tmp_path = tmp.name
+
+        try:
+            with open(tmp_path, 'rb') as f:
+                data = {
+                    'image': (f, 'integration_test.jpg'),
+                    'prompt': 'integration test prompt'
+                }
+                response = test_client.post('/', data=data)
+
+                assert response.status_code == 200
+                assert "integration_test_result" in response.data.decode()
+                mock_analyze.assert_called_once()
+        finally:
+            try:
+                os.remove(tmp_path)
+            except:
+                pass